@@ -0,0 +1,249 @@
+import collections
+from typing import Iterator
+
+
+class EvictionPolicy(object):
+    """Order in which cached chunks are evicted, fed with the inserts, accesses and removals of the cache.
+
+    An access is a reader entering a chunk, not every read inside it, and inserting a chunk is no access.
+    """
+
+    name = ""
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+
+    def insert(self, id: str, size: int) -> None:
+        raise NotImplementedError
+
+    def access(self, id: str) -> None:
+        raise NotImplementedError
+
+    def remove(self, id: str) -> None:
+        raise NotImplementedError
+
+    def victims(self) -> Iterator[str]:
+        # every chunk, best victim first, the cache skips the ones it can not drop
+        raise NotImplementedError
+
+    def get_status(self) -> dict[str, any]:
+        return {"policy": self.name}
+
+
+class LruPolicy(EvictionPolicy):
+    name = "lru"
+    # chunk id -> size, least recently used first
+    entries: collections.OrderedDict[str, int]
+
+    def __init__(self, capacity: int) -> None:
+        super().__init__(capacity)
+        self.entries = collections.OrderedDict()
+
+    def insert(self, id: str, size: int) -> None:
+        self.entries[id] = size
+        self.entries.move_to_end(id)
+
+    def access(self, id: str) -> None:
+        if id in self.entries:
+            self.entries.move_to_end(id)
+
+    def remove(self, id: str) -> None:
+        self.entries.pop(id, None)
+
+    def victims(self) -> Iterator[str]:
+        return iter(list(self.entries))
+
+
+class SlruPolicy(EvictionPolicy):
+    """Segmented lru, chunks read once stay in probation and are evicted before the protected ones."""
+
+    name = "slru"
+    PROTECTED_RATIO = 0.8  # share of the capacity the protected segment may hold
+    PROMOTE_HITS = 2  # accesses in probation before a chunk is protected
+    # chunk id -> [size, hits], least recently used first
+    probation: collections.OrderedDict[str, list[int]]
+    # chunk id -> size, least recently used first
+    protected: collections.OrderedDict[str, int]
+
+    def __init__(self, capacity: int, promote_hits: int = PROMOTE_HITS) -> None:
+        super().__init__(capacity)
+        self.promote_hits = promote_hits
+        self.probation = collections.OrderedDict()
+        self.protected = collections.OrderedDict()
+        self.protected_size = 0
+
+    def insert(self, id: str, size: int) -> None:
+        self.remove(id)
+        self.probation[id] = [size, 0]
+
+    def access(self, id: str) -> None:
+        if id in self.protected:
+            self.protected.move_to_end(id)
+            return
+        entry = self.probation.get(id)
+        if entry is None:
+            return
+        entry[1] += 1
+        if entry[1] < self.promote_hits:
+            self.probation.move_to_end(id)
+            return
+        self.probation.pop(id)
+        self._protect(id, entry[0])
+
+    def _protect(self, id: str, size: int) -> None:
+        self.protected[id] = size
+        self.protected_size += size
+        while self.protected_size > self.capacity * self.PROTECTED_RATIO and len(self.protected) > 1:
+            # demoted chunks go back to the head of probation, one more access protects them again
+            old_id, old_size = self.protected.popitem(last=False)
+            self.protected_size -= old_size
+            self.probation[old_id] = [old_size, self.promote_hits - 1]
+
+    def remove(self, id: str) -> None:
+        if self.probation.pop(id, None) is not None:
+            return
+        size = self.protected.pop(id, None)
+        if size is not None:
+            self.protected_size -= size
+
+    def victims(self) -> Iterator[str]:
+        return iter(list(self.probation) + list(self.protected))
+
+    def get_status(self) -> dict[str, any]:
+        return {
+            "policy": self.name,
+            "probation": len(self.probation),
+            "protected": len(self.protected),
+            "protected_size": self.protected_size,
+        }
+
+
+class FrequencySketch(object):
+    """Count-min sketch of 4 bit counters, halved every SAMPLE_FACTOR * width increments so old popularity fades."""
+
+    DEPTH = 4
+    MAX_COUNT = 15
+    SAMPLE_FACTOR = 10
+
+    def __init__(self, width: int) -> None:
+        self.width = width
+        self.table = [0] * (self.DEPTH * width)
+        self.additions = 0
+
+    def _indexes(self, id: str) -> list[int]:
+        return [row * self.width + hash((row, id)) % self.width for row in range(self.DEPTH)]
+
+    def increment(self, id: str) -> None:
+        indexes = self._indexes(id)
+        low = min(self.table[i] for i in indexes)
+        if low >= self.MAX_COUNT:
+            return
+        for i in indexes:
+            if self.table[i] == low:
+                self.table[i] += 1
+        self.additions += 1
+        if self.additions >= self.SAMPLE_FACTOR * self.width:
+            self.table = [count // 2 for count in self.table]
+            self.additions //= 2
+
+    def frequency(self, id: str) -> int:
+        return min(self.table[i] for i in self._indexes(id))
+
+
+class TinyLfuPolicy(EvictionPolicy):
+    """W-TinyLFU, new chunks wait in a small lru window and only enter the main slru if they are accessed
+    more often than the chunk they would push out, so a one-off scan can not flush the popular chunks."""
+
+    name = "tinylfu"
+    WINDOW_RATIO = 0.01
+    SKETCH_WIDTH = 4096
+    # chunk id -> size, least recently used first
+    window: collections.OrderedDict[str, int]
+    # chunk id -> size, window chunks that lost admission, evicted first
+    rejected: collections.OrderedDict[str, int]
+
+    def __init__(self, capacity: int) -> None:
+        super().__init__(capacity)
+        self.window = collections.OrderedDict()
+        self.window_size = 0
+        self.rejected = collections.OrderedDict()
+        # admitted chunks were read in the window already, the next read protects them
+        self.main = SlruPolicy(capacity, promote_hits=1)
+        self.main_size = 0
+        self.sketch = FrequencySketch(self.SKETCH_WIDTH)
+        self.admitted = 0
+        self.rejections = 0
+
+    def insert(self, id: str, size: int) -> None:
+        self.remove(id)
+        self.window[id] = size
+        self.window_size += size
+        window_capacity = self.capacity * self.WINDOW_RATIO
+        while self.window_size > window_capacity and len(self.window) > 1:
+            candidate, candidate_size = self.window.popitem(last=False)
+            self.window_size -= candidate_size
+            self._admit(candidate, candidate_size)
+
+    def _admit(self, candidate: str, size: int) -> None:
+        if self.main_size + size > self.capacity * (1 - self.WINDOW_RATIO):
+            victim = next(iter(self.main.probation or self.main.protected), None)
+            if victim is not None and self.sketch.frequency(candidate) < self.sketch.frequency(victim):
+                self.rejected[candidate] = size
+                self.rejections += 1
+                return
+        self.main.insert(candidate, size)
+        self.main_size += size
+        self.admitted += 1
+
+    def access(self, id: str) -> None:
+        self.sketch.increment(id)
+        if id in self.window:
+            self.window.move_to_end(id)
+            return
+        size = self.rejected.pop(id, None)
+        if size is not None:
+            # read again before it was dropped, give it another chance in the window
+            self.insert(id, size)
+            return
+        self.main.access(id)
+
+    def remove(self, id: str) -> None:
+        size = self.window.pop(id, None)
+        if size is not None:
+            self.window_size -= size
+            return
+        if self.rejected.pop(id, None) is not None:
+            return
+        entry = self.main.probation.get(id)
+        size = entry[0] if entry is not None else self.main.protected.get(id)
+        if size is not None:
+            self.main.remove(id)
+            self.main_size -= size
+
+    def victims(self) -> Iterator[str]:
+        return iter(list(self.rejected) + list(self.main.victims()) + list(self.window))
+
+    def get_status(self) -> dict[str, any]:
+        return {
+            "policy": self.name,
+            "window": len(self.window),
+            "rejected": len(self.rejected),
+            "probation": len(self.main.probation),
+            "protected": len(self.main.protected),
+            "admitted": self.admitted,
+            "rejections": self.rejections,
+        }
+
+
+EVICTION_POLICIES: dict[str, type[EvictionPolicy]] = {
+    LruPolicy.name: LruPolicy,
+    SlruPolicy.name: SlruPolicy,
+    TinyLfuPolicy.name: TinyLfuPolicy,
+}
+
+
+def create_eviction_policy(name: str, capacity: int) -> EvictionPolicy:
+    policy = EVICTION_POLICIES.get(name)
+    if policy is None:
+        raise ValueError(f"unknown eviction policy {name}, choose from {list(EVICTION_POLICIES)}")
+    return policy(capacity)
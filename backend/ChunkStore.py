@@ -0,0 +1,481 @@
+import io
+import os
+import mmap
+import ctypes
+import ctypes.util
+import logging
+import threading
+from typing import IO, TYPE_CHECKING, Iterator, Optional
+
+import diskcache
+
+if TYPE_CHECKING:
+    from backend.MediaCacheManager import ChunkInfo
+
+logger = logging.getLogger(__file__.split("/")[-1])
+
+
+class ChunkStore(object):
+    """Where the bytes of stored chunks live in one cache directory, the chunk index stays with the manager.
+
+    Entries are the unit the store keeps on disk, reconcile drops entries no indexed chunk refers to.
+    Methods may run in worker threads during eviction.
+    """
+
+    name = ""
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+
+    def set(self, info: "ChunkInfo", data: bytes) -> None:
+        raise NotImplementedError
+
+    def get(self, info: "ChunkInfo") -> Optional[bytes]:
+        return self.read(info, 0, info.length)
+
+    def read(self, info: "ChunkInfo", offset: int, size: int) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def open(self, info: "ChunkInfo") -> Optional[tuple[IO[bytes], int]]:
+        # file holding the chunk and the position of its first byte in the file
+        raise NotImplementedError
+
+    def delete(self, info: "ChunkInfo") -> bool:
+        raise NotImplementedError
+
+    def contains(self, info: "ChunkInfo") -> bool:
+        raise NotImplementedError
+
+    def get_file_path(self, infos: list["ChunkInfo"]) -> Optional[str]:
+        # plain file holding exactly the chunks of a whole media back to back, for sendfile offload
+        raise NotImplementedError
+
+    def get_range_path(self, infos: list["ChunkInfo"]) -> Optional[str]:
+        # file holding the chunks at their own offsets in the media, for sending ranges of them
+        return None
+
+    def rekey(self, info: "ChunkInfo", media_key: str) -> None:
+        # the chunk moves to another media, info included
+        info.media_key = media_key
+
+    def entry_key(self, info: "ChunkInfo") -> str:
+        raise NotImplementedError
+
+    def entries(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def trim_entry(self, key: str, infos: list["ChunkInfo"]) -> None:
+        # drop the bytes of the entry not held by any of the indexed chunks
+        pass
+
+    def hold_entry(self, key: str) -> None:
+        # the entry is read outside the store until release_entry, what is deleted meanwhile must stay readable
+        pass
+
+    def release_entry(self, key: str) -> None:
+        pass
+
+    def delete_entry(self, key: str) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class DiskcacheChunkStore(ChunkStore):
+    """One diskcache blob per chunk, keyed by chunk id."""
+
+    name = "diskcache"
+
+    def __init__(self, directory: str) -> None:
+        super().__init__(directory)
+        # eviction is done by the manager, diskcache must not cull pinned blobs on its own
+        self.cache = diskcache.Cache(directory, eviction_policy="none")
+
+    def set(self, info: "ChunkInfo", data: bytes) -> None:
+        self.cache.set(info.id, data)
+
+    def get(self, info: "ChunkInfo") -> Optional[bytes]:
+        return self.cache.get(info.id)
+
+    def read(self, info: "ChunkInfo", offset: int, size: int) -> Optional[bytes]:
+        f = self.cache.get(info.id, read=True)
+        if f is None:
+            return None
+        with f:
+            f.seek(offset)
+            return f.read(size)
+
+    def open(self, info: "ChunkInfo") -> Optional[tuple[IO[bytes], int]]:
+        f = self.cache.get(info.id, read=True)
+        if f is None:
+            return None
+        return f, 0
+
+    def delete(self, info: "ChunkInfo") -> bool:
+        return self.cache.delete(info.id)
+
+    def contains(self, info: "ChunkInfo") -> bool:
+        return info.id in self.cache
+
+    def get_file_path(self, infos: list["ChunkInfo"]) -> Optional[str]:
+        if len(infos) != 1:
+            return None
+        f = self.cache.get(infos[0].id, read=True)
+        if f is None:
+            return None
+        with f:
+            # small blobs live inside the diskcache db and have no file of their own
+            path = getattr(f, "name", None)
+        return path if isinstance(path, str) else None
+
+    def get_range_path(self, infos: list["ChunkInfo"]) -> Optional[str]:
+        # a blob starts at its chunk, only the first chunk is at its media offset
+        if len(infos) != 1 or infos[0].start != 0:
+            return None
+        return self.get_file_path(infos)
+
+    def entry_key(self, info: "ChunkInfo") -> str:
+        return info.id
+
+    def entries(self) -> Iterator[str]:
+        return self.cache.iterkeys()
+
+    def delete_entry(self, key: str) -> None:
+        self.cache.delete(key)
+
+    def close(self) -> None:
+        self.cache.close()
+
+
+class SparseFileReader(io.FileIO):
+    """Data file of a media opened for reading, the store punches no hole in it until it is closed."""
+
+    def __init__(self, store: "SparseFileChunkStore", media_key: str) -> None:
+        self.store = store
+        self.media_key = media_key
+        super().__init__(store._data_path(media_key), "rb")
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        super().close()
+        self.store.release_entry(self.media_key)
+
+
+class SparseFileChunkStore(ChunkStore):
+    """One sparse file per media with every chunk written at its offset in the file, and a presence bitmap.
+
+    Chunks of a media never hold the same byte twice, a fully cached media is a plain file that a web
+    server can send itself, and range reads slice a mmap of the file instead of loading whole chunks.
+    Chunks start on BLOCK_SIZE boundaries and only the tail of a file ends off one, so a block is present
+    once any chunk wrote to it.
+    """
+
+    name = "sparse"
+    BLOCK_SIZE = 4096  # telegram file offsets are multiples of it
+    SUB_DIRECTORY = "sparse"
+    FALLOC_FL_KEEP_SIZE = 0x01
+    FALLOC_FL_PUNCH_HOLE = 0x02
+    # media key -> presence bitmap, a bit per block
+    bitmaps: dict[str, bytearray]
+    # media key -> read only map of the data file
+    maps: dict[str, mmap.mmap]
+    # media key -> readers of the data file outside the store
+    readers: dict[str, int]
+    # media key -> blocks deleted under a reader, a bit per block, punched once the last reader is gone
+    pending_holes: dict[str, int]
+
+    def __init__(self, directory: str) -> None:
+        super().__init__(directory)
+        self.data_dir = os.path.join(directory, self.SUB_DIRECTORY)
+        os.makedirs(self.data_dir, exist_ok=True)
+        self.bitmaps = {}
+        self.maps = {}
+        self.readers = {}
+        self.pending_holes = {}
+        # eviction writes and deletes from worker threads
+        self.lock = threading.RLock()
+        self.fallocate = self._load_fallocate()
+
+    @staticmethod
+    def _load_fallocate():
+        # punching holes frees the disk space of evicted chunks before the whole file goes, linux only
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fallocate = libc.fallocate
+            fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+            return fallocate
+        except Exception:
+            return None
+
+    def _file_name(self, media_key: str) -> str:
+        # media keys are colon separated ids, no underscore in them
+        return os.path.join(self.data_dir, media_key.replace(":", "_"))
+
+    def _data_path(self, media_key: str) -> str:
+        return f"{self._file_name(media_key)}.data"
+
+    def _bitmap_path(self, media_key: str) -> str:
+        return f"{self._file_name(media_key)}.map"
+
+    def _block_range(self, start: int, length: int) -> range:
+        return range(start // self.BLOCK_SIZE, (start + length + self.BLOCK_SIZE - 1) // self.BLOCK_SIZE)
+
+    def _get_bitmap(self, media_key: str) -> bytearray:
+        bitmap = self.bitmaps.get(media_key)
+        if bitmap is None:
+            try:
+                with open(self._bitmap_path(media_key), "rb") as f:
+                    bitmap = bytearray(f.read())
+            except FileNotFoundError:
+                bitmap = bytearray()
+            self.bitmaps[media_key] = bitmap
+        return bitmap
+
+    @staticmethod
+    def _block_bits(blocks: range) -> tuple[int, int, int]:
+        # bitmap bytes [first, last) holding the blocks, and the bits of the blocks in them
+        first, last = blocks.start // 8, (blocks.stop + 7) // 8
+        return first, last, ((1 << len(blocks)) - 1) << (blocks.start - first * 8)
+
+    def _mark_blocks(self, media_key: str, blocks: range, present: bool) -> None:
+        bitmap = self._get_bitmap(media_key)
+        if len(blocks) == 0:
+            return
+        if present and len(bitmap) * 8 < blocks.stop:
+            bitmap.extend(bytes((blocks.stop + 7) // 8 - len(bitmap)))
+        first, last, bits = self._block_bits(blocks)
+        last = min(last, len(bitmap))
+        if first >= last:
+            return
+        # the changed bytes as one int rather than a bit at a time, bit i is block first * 8 + i
+        value = int.from_bytes(bitmap[first:last], "little")
+        value = value | bits if present else value & ~bits
+        bitmap[first:last] = (value & ((1 << (last - first) * 8) - 1)).to_bytes(last - first, "little")
+        # rewrite only the bytes of the bitmap that changed
+        path = self._bitmap_path(media_key)
+        with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+            f.seek(first)
+            f.write(bitmap[first:last])
+
+    def _has_blocks(self, media_key: str, blocks: range) -> bool:
+        bitmap = self._get_bitmap(media_key)
+        if len(blocks) == 0:
+            return True
+        first, last, bits = self._block_bits(blocks)
+        if last > len(bitmap):
+            return False
+        return int.from_bytes(bitmap[first:last], "little") & bits == bits
+
+    def _get_map(self, media_key: str, end: int) -> Optional[mmap.mmap]:
+        mm = self.maps.get(media_key)
+        if mm is not None and len(mm) >= end:
+            return mm
+        if mm is not None:
+            # the file grew since it was mapped
+            mm.close()
+            self.maps.pop(media_key)
+        try:
+            with open(self._data_path(media_key), "rb") as f:
+                if os.fstat(f.fileno()).st_size < end:
+                    return None
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return None
+        self.maps[media_key] = mm
+        return mm
+
+    def _drop_file(self, media_key: str) -> None:
+        if self.readers.get(media_key):
+            # only the bitmap goes for now, the file is dropped or punched when the readers are done
+            bitmap = self._get_bitmap(media_key)
+            self.pending_holes[media_key] = self.pending_holes.get(media_key, 0) | int.from_bytes(bitmap, "little")
+            bitmap[:] = bytes(len(bitmap))
+            if os.path.exists(self._bitmap_path(media_key)):
+                with open(self._bitmap_path(media_key), "r+b") as f:
+                    f.write(bitmap)
+            return
+        mm = self.maps.pop(media_key, None)
+        if mm is not None:
+            mm.close()
+        self.bitmaps.pop(media_key, None)
+        for path in (self._data_path(media_key), self._bitmap_path(media_key)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _punch_blocks(self, media_key: str, blocks: int) -> None:
+        # a hole per run of the blocks, a bit per block
+        if self.readers.get(media_key):
+            # a reader would get zeros where it expects the chunk it opened
+            self.pending_holes[media_key] = self.pending_holes.get(media_key, 0) | blocks
+            return
+        if self.fallocate is None or not blocks:
+            return
+        try:
+            fd = os.open(self._data_path(media_key), os.O_WRONLY)
+        except FileNotFoundError:
+            return
+        try:
+            while blocks:
+                first = (blocks & -blocks).bit_length() - 1
+                run = ((blocks >> first) ^ ((blocks >> first) + 1)).bit_length() - 1
+                mode = self.FALLOC_FL_PUNCH_HOLE | self.FALLOC_FL_KEEP_SIZE
+                if self.fallocate(fd, mode, first * self.BLOCK_SIZE, run * self.BLOCK_SIZE) != 0:
+                    logger.debug(f"punch hole of {media_key}, errno:{ctypes.get_errno()}")
+                blocks &= ~(((1 << run) - 1) << first)
+        finally:
+            os.close(fd)
+
+    def set(self, info: "ChunkInfo", data: bytes) -> None:
+        with self.lock:
+            path = self._data_path(info.media_key)
+            with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+                # writing past the end leaves a hole, the file only takes the space of written blocks
+                f.seek(info.start)
+                f.write(data)
+            self._mark_blocks(info.media_key, self._block_range(info.start, len(data)), True)
+
+    def read(self, info: "ChunkInfo", offset: int, size: int) -> Optional[bytes]:
+        start = info.start + offset
+        with self.lock:
+            if not self._has_blocks(info.media_key, self._block_range(start, size)):
+                return None
+            mm = self._get_map(info.media_key, start + size)
+            if mm is None:
+                return None
+            return mm[start : start + size]
+
+    def open(self, info: "ChunkInfo") -> Optional[tuple[IO[bytes], int]]:
+        with self.lock:
+            if not self._has_blocks(info.media_key, self._block_range(info.start, info.length)):
+                return None
+            # held before the file is opened, no delete can punch the chunk in between
+            self.hold_entry(info.media_key)
+            try:
+                return SparseFileReader(self, info.media_key), info.start
+            except FileNotFoundError:
+                self.release_entry(info.media_key)
+                return None
+
+    def delete(self, info: "ChunkInfo") -> bool:
+        with self.lock:
+            blocks = self._block_range(info.start, info.length)
+            if not self._has_blocks(info.media_key, blocks):
+                return False
+            self._mark_blocks(info.media_key, blocks, False)
+            if not any(self._get_bitmap(info.media_key)):
+                self._drop_file(info.media_key)
+                return True
+            self._punch_blocks(info.media_key, ((1 << len(blocks)) - 1) << blocks.start)
+            return True
+
+    def contains(self, info: "ChunkInfo") -> bool:
+        with self.lock:
+            return self._has_blocks(info.media_key, self._block_range(info.start, info.length))
+
+    def get_file_path(self, infos: list["ChunkInfo"]) -> Optional[str]:
+        if not infos or any(info.media_key != infos[0].media_key for info in infos):
+            return None
+        path = self._data_path(infos[0].media_key)
+        # holes past the last chunk would be sent as zeros
+        end = max(info.start + info.length for info in infos)
+        try:
+            if os.path.getsize(path) != end:
+                return None
+        except FileNotFoundError:
+            return None
+        return path
+
+    def get_range_path(self, infos: list["ChunkInfo"]) -> Optional[str]:
+        if not infos or any(info.media_key != infos[0].media_key for info in infos):
+            return None
+        with self.lock:
+            if not all(self._has_blocks(info.media_key, self._block_range(info.start, info.length)) for info in infos):
+                return None
+            path = self._data_path(infos[0].media_key)
+            return path if os.path.exists(path) else None
+
+    def rekey(self, info: "ChunkInfo", media_key: str) -> None:
+        # files are named after the media, the chunk's blocks go to the file of the new one
+        with self.lock:
+            data = self.get(info)
+            if data is not None:
+                self.delete(info)
+            info.media_key = media_key
+            if data is not None:
+                self.set(info, data)
+
+    def entry_key(self, info: "ChunkInfo") -> str:
+        return info.media_key
+
+    def entries(self) -> Iterator[str]:
+        for name in os.listdir(self.data_dir):
+            if name.endswith(".map"):
+                yield name[: -len(".map")].replace("_", ":")
+
+    def trim_entry(self, key: str, infos: list["ChunkInfo"]) -> None:
+        with self.lock:
+            bitmap = self._get_bitmap(key)
+            held = 0
+            for info in infos:
+                blocks = self._block_range(info.start, info.length)
+                held |= ((1 << len(blocks)) - 1) << blocks.start
+            # the whole bitmap as one int with block n at bit n, present blocks no chunk holds are stray
+            present = int.from_bytes(bitmap, "little")
+            if not present & held:
+                self._drop_file(key)
+                return
+            stray = present & ~held
+            if not stray:
+                return
+            bitmap[:] = (present & held).to_bytes(len(bitmap), "little")
+            with open(self._bitmap_path(key), "r+b") as f:
+                f.write(bitmap)
+            self._punch_blocks(key, stray)
+
+    def hold_entry(self, key: str) -> None:
+        with self.lock:
+            self.readers[key] = self.readers.get(key, 0) + 1
+
+    def release_entry(self, key: str) -> None:
+        with self.lock:
+            count = self.readers.get(key, 0) - 1
+            if count > 0:
+                self.readers[key] = count
+                return
+            self.readers.pop(key, None)
+            pending = self.pending_holes.pop(key, None)
+            if pending is None:
+                return
+            bitmap = self._get_bitmap(key)
+            if not any(bitmap):
+                self._drop_file(key)
+                return
+            # blocks stored again since they were deleted keep their bytes
+            self._punch_blocks(key, pending & ~int.from_bytes(bitmap, "little"))
+
+    def delete_entry(self, key: str) -> None:
+        with self.lock:
+            self._drop_file(key)
+
+    def close(self) -> None:
+        with self.lock:
+            for mm in self.maps.values():
+                mm.close()
+            self.maps.clear()
+
+
+CHUNK_STORES: dict[str, type[ChunkStore]] = {
+    DiskcacheChunkStore.name: DiskcacheChunkStore,
+    SparseFileChunkStore.name: SparseFileChunkStore,
+}
+
+
+def create_chunk_store(name: str, directory: str) -> ChunkStore:
+    store = CHUNK_STORES.get(name)
+    if store is None:
+        raise ValueError(f"unknown chunk store {name}, choose from {list(CHUNK_STORES)}")
+    return store(directory)
@@ -0,0 +1,51 @@
+import bisect
+import collections
+
+
+class DownloadHedger(object):
+    """Stall threshold of a client's downloads from its recent inter-chunk gaps, with hedge outcome counters."""
+
+    GAP_SAMPLES = 256
+    MIN_GAP_SAMPLES = 20  # DEFAULT_THRESHOLD until this many gaps are known
+    GAP_QUANTILE = 0.95
+    DEFAULT_THRESHOLD = 3.0
+    MIN_THRESHOLD = 1.0
+    MAX_THRESHOLD = 10.0
+
+    def __init__(self) -> None:
+        # recent gaps in arrival order, and the same window kept sorted for the quantile
+        self.gaps = collections.deque()
+        self.sorted_gaps = []
+        self.threshold = self.DEFAULT_THRESHOLD
+        self.downloads = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def on_chunk_gap(self, gap: float) -> None:
+        if len(self.gaps) == self.GAP_SAMPLES:
+            oldest = self.gaps.popleft()
+            del self.sorted_gaps[bisect.bisect_left(self.sorted_gaps, oldest)]
+        self.gaps.append(gap)
+        bisect.insort(self.sorted_gaps, gap)
+        if len(self.gaps) < self.MIN_GAP_SAMPLES:
+            return
+        quantile = self.sorted_gaps[min(len(self.sorted_gaps) - 1, int(len(self.sorted_gaps) * self.GAP_QUANTILE))]
+        self.threshold = min(self.MAX_THRESHOLD, max(self.MIN_THRESHOLD, quantile))
+
+    def on_download(self) -> None:
+        self.downloads += 1
+
+    def on_hedge(self) -> None:
+        self.hedges += 1
+
+    def on_hedge_won(self) -> None:
+        self.hedge_wins += 1
+
+    def get_status(self) -> dict[str, any]:
+        return {
+            "threshold": round(self.threshold, 3),
+            "downloads": self.downloads,
+            "hedges": self.hedges,
+            "hedge_rate": round(self.hedges / self.downloads, 3) if self.downloads > 0 else 0.0,
+            "win_rate": round(self.hedge_wins / self.hedges, 3) if self.hedges > 0 else 0.0,
+        }
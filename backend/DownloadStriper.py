@@ -0,0 +1,127 @@
+import time
+import logging
+import collections
+from typing import TYPE_CHECKING, Optional
+
+from telethon import types, errors
+
+if TYPE_CHECKING:
+    from backend.TgFileSystemClient import TgFileSystemClient
+
+logger = logging.getLogger(__file__.split("/")[-1])
+
+
+class StripeAccount(object):
+    def __init__(self, client: "TgFileSystemClient") -> None:
+        self.client = client
+        self.chunks = 0
+        self.bytes = 0
+        self.failures = 0
+        self.benched_until = 0.0
+
+    def is_benched(self, now: float) -> bool:
+        return self.benched_until > now
+
+
+class DownloadStriper(object):
+    """Spreads the chunk downloads of a file over every account that can see it."""
+
+    FAILURE_PENALTY = 30  # seconds out of rotation, doubled on every consecutive failure
+    MAX_FAILURE_PENALTY = 600
+    # seconds an account that cannot see a chat is not asked again
+    DENIED_TTL = 600
+    # session_name -> StripeAccount, in rotation order
+    accounts: collections.OrderedDict[str, StripeAccount]
+    # (session_name, chat_id) -> monotonic time the account may be asked again
+    denied: dict[tuple[str, int], float]
+
+    def __init__(self) -> None:
+        self.accounts = collections.OrderedDict()
+        self.denied = {}
+
+    def register(self, client: "TgFileSystemClient") -> None:
+        account = self.accounts.get(client.session_name)
+        if account is None or account.client is not client:
+            self.accounts[client.session_name] = StripeAccount(client)
+
+    def unregister(self, session_name: str) -> None:
+        self.accounts.pop(session_name, None)
+
+    async def _get_account_message(self, account: StripeAccount, msg: types.Message) -> types.Message | None:
+        key = (account.client.session_name, msg.chat_id)
+        if self.denied.get(key, 0) > time.monotonic():
+            return None
+        try:
+            account_msg = await account.client.get_media_message(msg.chat_id, msg.id)
+        except Exception as err:
+            logger.info(f"{account.client.session_name} can not see {msg.chat_id=},{err=}")
+            account_msg = None
+        # message ids outside channels are per account, only the same document counts
+        if (
+            account_msg is None
+            or not isinstance(account_msg.media, types.MessageMediaDocument)
+            or account_msg.media.document.id != msg.media.document.id
+        ):
+            self.denied[key] = time.monotonic() + self.DENIED_TTL
+            return None
+        return account_msg
+
+    async def pick_account(
+        self, origin: "TgFileSystemClient", msg: types.Message, exclude: Optional["TgFileSystemClient"] = None
+    ) -> tuple["TgFileSystemClient", types.Message]:
+        # next account in rotation that is healthy and sees the file, the origin when none does
+        if origin.session_name not in self.accounts or len(self.accounts) < 2:
+            return origin, msg
+        now = time.monotonic()
+        for _ in range(len(self.accounts)):
+            session_name, account = next(iter(self.accounts.items()))
+            self.accounts.move_to_end(session_name)
+            if account.client is exclude or account.is_benched(now) or not account.client.is_valid():
+                continue
+            if account.client is origin:
+                return origin, msg
+            account_msg = await self._get_account_message(account, msg)
+            if account_msg is not None:
+                return account.client, account_msg
+        return origin, msg
+
+    def on_account_done(self, client: "TgFileSystemClient", size: int) -> None:
+        account = self.accounts.get(client.session_name)
+        if account is None:
+            return
+        account.chunks += 1
+        account.bytes += size
+        account.failures = 0
+
+    def on_account_error(self, client: "TgFileSystemClient", err: Exception, chat_id: int) -> bool:
+        # take the account out of rotation, True if another account may carry on right away
+        account = self.accounts.get(client.session_name)
+        if account is None:
+            return False
+        account.failures += 1
+        if isinstance(err, errors.FloodWaitError):
+            penalty = err.seconds
+        else:
+            penalty = min(self.FAILURE_PENALTY * 2 ** (account.failures - 1), self.MAX_FAILURE_PENALTY)
+        now = time.monotonic()
+        account.benched_until = now + penalty
+        logger.warning(f"bench {client.session_name} for {penalty}s:{err=}")
+        return any(
+            other is not account
+            and not other.is_benched(now)
+            and other.client.is_valid()
+            and self.denied.get((other.client.session_name, chat_id), 0) <= now
+            for other in self.accounts.values()
+        )
+
+    def get_status(self) -> dict[str, dict[str, any]]:
+        now = time.monotonic()
+        return {
+            session_name: {
+                "chunks": account.chunks,
+                "bytes": account.bytes,
+                "failures": account.failures,
+                "benched": round(max(0.0, account.benched_until - now), 1),
+            }
+            for session_name, account in self.accounts.items()
+        }
@@ -1,4 +1,7 @@
 import os
+import time
+import shutil
+import sqlite3
 import functools
 import logging
 import bisect
@@ -6,26 +9,46 @@ import collections
 import asyncio
 import traceback
 import hashlib
-from typing import Union, Optional
+from typing import IO, Callable, Union, Optional
 
 import diskcache
 from fastapi import Request
 from telethon import types
 
+from backend.TaskScheduler import ScheduledTask, EnumTaskPriority
+from backend.ChunkEvictionPolicy import EvictionPolicy, create_eviction_policy
+from backend.ChunkStore import ChunkStore, create_chunk_store
+
 logger = logging.getLogger(__file__.split("/")[-1])
 
 
 @functools.total_ordering
 class ChunkInfo(object):
-    def __init__(self, md5id: str, chat_id: int, msg_id: int, start: int, length: int) -> None:
+    def __init__(self, md5id: str, media_key: str, chat_id: int, msg_id: int, start: int, length: int) -> None:
         self.id = md5id
+        # the chunk belongs to the media, chat_id and msg_id are the message it was first downloaded through
+        self.media_key = media_key
         self.chat_id = chat_id
         self.msg_id = msg_id
         self.start = start
         self.length = length
+        # index of the disk tier holding the blob
+        self.tier = 0
 
     def __repr__(self) -> str:
-        return f"chunkinfo:id:{self.id},cid:{self.chat_id},mid:{self.msg_id},offset:{self.start},len:{self.length}"
+        return f"chunkinfo:id:{self.id},key:{self.media_key},cid:{self.chat_id},mid:{self.msg_id},offset:{self.start},len:{self.length}"
+
+    # a ChunkInfo handed out by the manager stands for a completed chunk stored on disk
+    def is_completed(self) -> bool:
+        return True
+
+    @property
+    def chunk_id(self) -> str:
+        return self.id
+
+    @property
+    def target_len(self) -> int:
+        return self.length
 
     def __eq__(self, other: Union["ChunkInfo", int]):
         if isinstance(other, int):
@@ -44,16 +67,28 @@ class MediaChunkHolder(object):
     requesters: list[Request]
     unique_id: str
     info: ChunkInfo
+    mem: bytearray
+    # set when the download gave up, waiters raise it instead of waiting forever
+    error: Optional[Exception] = None
+    # handle of the task filling the holder, cancelled once the last requester leaves
+    download_task: Optional["ScheduledTask"] = None
 
     @staticmethod
-    def generate_id(chat_id: int, msg_id: int, start: int) -> str:
-        return f"{chat_id}:{msg_id}:{start}"
-
-    def __init__(self, chat_id: int, msg_id: int, start: int, target_len: int) -> None:
-        self.unique_id = MediaChunkHolder.generate_id(chat_id, msg_id, start)
-        self.info = ChunkInfo(hashlib.md5(self.unique_id.encode()).hexdigest(), chat_id, msg_id, start, target_len)
-        self.mem = bytes()
-        self.length = len(self.mem)
+    def generate_id(media_key: str, start: int) -> str:
+        return f"{media_key}:{start}"
+
+    def __init__(self, media_key: str, chat_id: int, msg_id: int, start: int, target_len: int) -> None:
+        self.unique_id = MediaChunkHolder.generate_id(media_key, start)
+        self.info = ChunkInfo(
+            hashlib.md5(self.unique_id.encode()).hexdigest(), media_key, chat_id, msg_id, start, target_len
+        )
+        # preallocated, net chunks are written in place and readers get memoryview slices
+        self.mem = bytearray(target_len)
+        # contiguous prefix visible to readers
+        self.length = 0
+        # relative offset -> end of out of order data already written into mem
+        self.pending_mem: dict[int, int] = {}
+        self.error = None
         self.waiters = collections.deque()
         self.requesters = []
 
@@ -97,32 +132,65 @@ class MediaChunkHolder(object):
                 waiter.set_result(None)
 
     def append_chunk_mem(self, mem: bytes) -> None:
-        self.mem = self.mem + mem
-        self.length = len(self.mem)
-        if self.length > self.target_len:
-            logger.warning(RuntimeWarning(f"MeidaChunk Overflow:start:{self.start},len:{self.length},tlen:{self.target_len}"))
+        self.write_chunk_mem(self.length, mem)
+
+    def write_chunk_mem(self, offset: int, mem: bytes) -> None:
+        # offset is relative to holder start, only the contiguous prefix is visible to readers
+        end = offset + len(mem)
+        if end > self.target_len:
+            logger.warning(RuntimeWarning(f"MeidaChunk Overflow:start:{self.start},len:{end},tlen:{self.target_len}"))
+            end = self.target_len
+        begin = max(offset, self.length)
+        if end <= begin:
+            return
+        self.mem[begin:end] = memoryview(mem)[begin - offset : end - offset]
+        if offset > self.length:
+            self.pending_mem[offset] = max(end, self.pending_mem.get(offset, 0))
+            return
+        self.length = end
+        advanced = True
+        while advanced and self.pending_mem:
+            advanced = False
+            for pending_offset in [k for k in self.pending_mem if k <= self.length]:
+                pending_end = self.pending_mem.pop(pending_offset)
+                if pending_end > self.length:
+                    self.length = pending_end
+                    advanced = True
         self.notify_waiters()
         self.try_clear_waiter_and_requester()
 
+    def get_mem_view(self, offset: int, size: int) -> memoryview:
+        return memoryview(self.mem)[offset : offset + size]
+
+    def discard_pending_mem(self) -> None:
+        self.pending_mem.clear()
+
+    def set_error(self, err: Exception) -> None:
+        self.error = err
+        self.discard_pending_mem()
+        self.notify_waiters()
+        self.requesters.clear()
+
     def add_chunk_requester(self, req: Request) -> None:
-        if self.is_completed():
+        if self.is_completed() or req in self.requesters:
             return
         self.requesters.append(req)
 
-    async def is_disconneted(self) -> bool:
-        while self.requesters:
-            try:
-                req = self.requesters[0]
-                if not await req.is_disconnected():
-                    return False
-                self.requesters.remove(req)
-                logger.info(f"remove req:{id(req)=},{self}")
-            except Exception as err:
-                logger.warning(f"{err=}, trace:{traceback.format_exc()}")
-                return False
-        return True
+    def remove_chunk_requester(self, req: Request) -> bool:
+        # True if nobody is left waiting for the holder
+        try:
+            self.requesters.remove(req)
+        except ValueError:
+            pass
+        return len(self.requesters) == 0
+
+    def is_disconneted(self) -> bool:
+        # every requester releases itself when it leaves, nobody left means nobody waits for the bytes
+        return len(self.requesters) == 0
 
     async def wait_chunk_update(self) -> None:
+        if self.error is not None:
+            raise self.error
         if self.is_completed():
             return
         waiter = asyncio.Future()
@@ -136,6 +204,8 @@ class MediaChunkHolder(object):
                 self.waiters.remove(waiter)
             except ValueError:
                 pass
+        if self.error is not None:
+            raise self.error
 
     def try_clear_waiter_and_requester(self) -> bool:
         if not self.is_completed():
@@ -146,119 +216,922 @@ class MediaChunkHolder(object):
         return True
 
 
+class MemoryChunkTier(object):
+    """Recently read chunks kept in memory as immutable bytes, readers share them through memoryview slices."""
+
+    # chunk id -> chunk bytes, in lru order
+    chunks: collections.OrderedDict[str, bytes]
+
+    def __init__(self, budget: int) -> None:
+        self.budget = budget
+        self.size = 0
+        self.chunks = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.promotions = 0
+        self.demotions = 0
+
+    def get(self, id: str) -> Optional[bytes]:
+        data = self.chunks.get(id)
+        if data is None:
+            self.misses += 1
+            return None
+        self.chunks.move_to_end(id)
+        self.hits += 1
+        return data
+
+    def put(self, id: str, data: bytes) -> None:
+        self.pop(id)
+        if len(data) > self.budget:
+            return
+        self.chunks[id] = data
+        self.size += len(data)
+        while self.size > self.budget:
+            # the disk tier keeps every chunk, demotion just drops the memory copy
+            _, old = self.chunks.popitem(last=False)
+            self.size -= len(old)
+            self.demotions += 1
+
+    def pop(self, id: str) -> None:
+        data = self.chunks.pop(id, None)
+        if data is not None:
+            self.size -= len(data)
+
+    def get_status(self) -> dict[str, any]:
+        lookups = self.hits + self.misses
+        return {
+            "budget": self.budget,
+            "size": self.size,
+            "chunks": len(self.chunks),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups > 0 else 0.0,
+            "promotions": self.promotions,
+            "demotions": self.demotions,
+        }
+
+
+class DiskChunkTier(object):
+    """One cache directory, past the high watermark its chunks move to the next tier, or are deleted in the last one."""
+
+    store: ChunkStore
+
+    def __init__(self, directory: str, capacity: int, high_watermark: float, low_watermark: float, store: str) -> None:
+        self.directory = directory
+        self.capacity = capacity
+        self.high_watermark = int(capacity * high_watermark)
+        self.low_watermark = int(capacity * low_watermark)
+        os.makedirs(directory, exist_ok=True)
+        self.store = create_chunk_store(store, directory)
+        # bytes of the chunks indexed in this tier, downloading ones included
+        self.size = 0
+        self.demoted = 0
+        self.evicted = 0
+
+    def get_status(self) -> dict[str, any]:
+        return {
+            "directory": self.directory,
+            "capacity": self.capacity,
+            "size": self.size,
+            "demoted": self.demoted,
+            "evicted": self.evicted,
+        }
+
+
+class ChunkIntervalIndex(object):
+    """Chunks of one media sorted by start, answers which chunks overlap a byte range.
+
+    The longest chunk bounds how far back an overlapping chunk can start, so a lookup is a bisect
+    plus a short backward scan, also when a chunk is shorter than the grid or overlaps another.
+    """
+
+    chunks: list[ChunkInfo]
+
+    def __init__(self) -> None:
+        self.chunks = []
+        # never shrinks on remove, it only bounds the backward scan
+        self.max_length = 0
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def insert(self, info: ChunkInfo) -> None:
+        bisect.insort_right(self.chunks, info)
+        self.max_length = max(self.max_length, info.length)
+
+    def remove(self, info: ChunkInfo) -> None:
+        pos = bisect.bisect_left(self.chunks, info.start)
+        while pos < len(self.chunks) and self.chunks[pos].start == info.start:
+            if self.chunks[pos] is info:
+                self.chunks.pop(pos)
+                return
+            pos += 1
+
+    def get(self, start: int) -> Optional[ChunkInfo]:
+        # chunk starting exactly at start
+        pos = bisect.bisect_left(self.chunks, start)
+        if pos < len(self.chunks) and self.chunks[pos].start == start:
+            return self.chunks[pos]
+        return None
+
+    def overlap(self, start: int, end: int) -> list[ChunkInfo]:
+        # chunks holding any byte of [start, end], by start
+        res = []
+        pos = bisect.bisect_right(self.chunks, end) - 1
+        while pos >= 0 and self.chunks[pos].start + self.max_length > start:
+            info = self.chunks[pos]
+            if info.start + info.length > start:
+                res.append(info)
+            pos -= 1
+        res.reverse()
+        return res
+
+    def find(self, pos: int) -> Optional[ChunkInfo]:
+        # the chunk reaching furthest past pos among those holding it
+        infos = self.overlap(pos, pos)
+        if not infos:
+            return None
+        return max(infos, key=lambda info: info.start + info.length)
+
+
 class MediaChunkHolderManager(object):
-    MAX_CACHE_SIZE = 2**31  # 2GB
+    MAX_CACHE_SIZE = 2**31  # 2GB, capacity of the default cache directory
+    HIGH_WATERMARK = 0.95  # share of a tier's capacity that starts background eviction
+    LOW_WATERMARK = 0.9  # share it is evicted down to
+    EVICT_BATCH = 32  # blobs moved or deleted per worker thread call
+    DEFAULT_CHUNK_SIZE = 5 * 1024 * 1024  # 5mb
+    DEFAULT_MEM_CACHE_SIZE = 256 * 1024 * 1024
+    DEFAULT_EVICTION_POLICY = "slru"
+    DEFAULT_CHUNK_STORE = "diskcache"
+    CHUNK_ALIGN = 256 * 1024  # keep grid aligned to net chunk
+    MIN_PARTIAL_CHUNK_SIZE = 256 * 1024  # shorter prefixes of a cancelled download are dropped
+    INDEX_VERSION = 2  # 1: blob + diskcache.Index meta, 2: sqlite chunk index
+    ACCESS_FLUSH_INTERVAL = 30
+    RECONCILE_BATCH = 256
+    chunk_size: int
     current_cache_size: int = 0
-    # chunk unique id -> ChunkHolder
-    disk_chunk_cache: diskcache.Cache
+    # raw chunk bytes by chunk id, new chunks land in the first tier, hot chunks are also in mem_tier
+    disk_tiers: list[DiskChunkTier]
+    mem_tier: MemoryChunkTier
+    evict_task: Optional[asyncio.Task]
+    # chunk ids whose blobs are queued for deletion off the event loop
+    deleting_chunks: set[str]
+    # chunk id -> (chat_id, msg_id, start, length, last_access, tier, media_key)
+    index_con: sqlite3.Connection
+    # chunk id -> last access time not yet written to the index
+    dirty_access: dict[str, float]
     # incompleted chunk
     incompleted_chunk: dict[str, MediaChunkHolder] = {}
-    # chunk id -> ChunkInfo
+    # chunk id -> ChunkInfo, the eviction order is kept by eviction
     chunk_lru: collections.OrderedDict[str, ChunkInfo]
-    # chat_id -> msg_id -> list[ChunkInfo]
-    chunk_cache: dict[int, dict[int, list[ChunkInfo]]] = {}
+    eviction: EvictionPolicy
+    # "time,media_key,start,length" per chunk access for backend/script/replay_eviction.py
+    access_trace: Optional[IO[str]]
+    # media key -> chunks of the media
+    chunk_cache: dict[str, ChunkIntervalIndex] = {}
+    # media key -> (chat_id, msg_id) -> pinned [start, end] ranges, exempt from lru eviction
+    pinned_files: dict[str, dict[tuple[int, int], list[tuple[int, int]]]]
 
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        mem_cache_size: int = DEFAULT_MEM_CACHE_SIZE,
+        eviction_policy: str = DEFAULT_EVICTION_POLICY,
+        access_trace: str = "",
+        cache_dirs: Optional[list[tuple[str, int]]] = None,
+        high_watermark: float = HIGH_WATERMARK,
+        low_watermark: float = LOW_WATERMARK,
+        chunk_store: str = DEFAULT_CHUNK_STORE,
+    ) -> None:
+        self.chunk_size = max(chunk_size // self.CHUNK_ALIGN * self.CHUNK_ALIGN, self.CHUNK_ALIGN)
+        if self.chunk_size != chunk_size:
+            logger.warning(f"chunk size {chunk_size} not aligned to {self.CHUNK_ALIGN}, use {self.chunk_size}")
+        db_dir = f"{os.path.dirname(__file__)}/db"
+        os.makedirs(db_dir, exist_ok=True)
+        # (directory, capacity) fastest first, an empty directory is the default one
+        cache_dirs = cache_dirs or [("", self.MAX_CACHE_SIZE)]
+        low_watermark = min(low_watermark, high_watermark)
+        self.disk_tiers = [
+            DiskChunkTier(directory or f"{db_dir}/cache_media", capacity, high_watermark, low_watermark, chunk_store)
+            for directory, capacity in cache_dirs
+        ]
+        self.evict_task = None
+        # bumped when a chunk joins the index or moves to another entry, reconcile refreshes its snapshot on it
+        self.index_version = 0
+        self.deleting_chunks = set()
         self.chunk_lru = collections.OrderedDict()
-        self.disk_chunk_cache = diskcache.Cache(
-            f"{os.path.dirname(__file__)}/db/cache_media", size_limit=MediaChunkHolderManager.MAX_CACHE_SIZE * 2
+        self.eviction = create_eviction_policy(eviction_policy, sum(tier.capacity for tier in self.disk_tiers))
+        self.access_trace = open(access_trace, "a", buffering=1) if access_trace else None
+        self.dirty_access = {}
+        self.pinned_files = {}
+        self.mem_tier = MemoryChunkTier(mem_cache_size)
+        self.disk_hits = 0
+        self.disk_misses = 0
+        self.index_con = sqlite3.connect(f"{db_dir}/cache_media_index.db")
+        self.index_con.execute(
+            "CREATE TABLE IF NOT EXISTS chunk(id TEXT PRIMARY KEY, chat_id INTEGER, msg_id INTEGER, start INTEGER, length INTEGER, last_access REAL, tier INTEGER DEFAULT 0)"
         )
+        if "tier" not in [row[1] for row in self.index_con.execute("PRAGMA table_info(chunk)")]:
+            self.index_con.execute("ALTER TABLE chunk ADD COLUMN tier INTEGER DEFAULT 0")
+        self.index_con.execute(
+            "CREATE TABLE IF NOT EXISTS pin(chat_id INTEGER, msg_id INTEGER, start INTEGER, end INTEGER, PRIMARY KEY(chat_id, msg_id, start, end))"
+        )
+        # rows written before chunks were keyed by media have no media_key, they are remapped on first access
+        for table in ("chunk", "pin"):
+            if "media_key" not in [row[1] for row in self.index_con.execute(f"PRAGMA table_info({table})")]:
+                self.index_con.execute(f"ALTER TABLE {table} ADD COLUMN media_key TEXT")
+        self.index_con.commit()
+        begin = time.perf_counter()
         self._restore_cache()
+        logger.info(f"restore {len(self.chunk_lru)} chunks in {time.perf_counter() - begin:.3f}s")
+
+    def __del__(self) -> None:
+        try:
+            self.flush_chunk_access()
+            self.index_con.close()
+            if self.access_trace is not None:
+                self.access_trace.close()
+            for tier in self.disk_tiers:
+                tier.store.close()
+        except Exception:
+            pass
 
     def _restore_cache(self) -> None:
-        for id in self.disk_chunk_cache.iterkeys():
+        version = self.index_con.execute("PRAGMA user_version").fetchone()[0]
+        if version < self.INDEX_VERSION:
+            meta_dir = f"{os.path.dirname(__file__)}/db/cache_media_meta"
+            if os.path.isdir(meta_dir):
+                self._migrate_meta_index(meta_dir)
+            else:
+                self._migrate_pickled_chunks()
+            self.index_con.execute(f"PRAGMA user_version = {self.INDEX_VERSION}")
+            self.index_con.commit()
+        for chat_id, msg_id, start, end, media_key in self.index_con.execute(
+            "SELECT chat_id, msg_id, start, end, media_key FROM pin"
+        ):
+            media_key = media_key or self.get_legacy_media_key(chat_id, msg_id)
+            self.pinned_files.setdefault(media_key, {}).setdefault((chat_id, msg_id), []).append((start, end))
+        # media key -> chunks not on the current grid
+        unaligned_chunks: dict[str, list[ChunkInfo]] = {}
+        # oldest access first, so the eviction policy sees the chunks in access order
+        rows = self.index_con.execute(
+            "SELECT id, media_key, chat_id, msg_id, start, length, tier FROM chunk ORDER BY last_access"
+        ).fetchall()
+        for id, media_key, chat_id, msg_id, start, length, tier in rows:
             try:
-                holder: MediaChunkHolder = self.disk_chunk_cache.get(id)
-                if holder is not None:
-                    self._set_media_chunk_index(holder.info)
+                media_key = media_key or self.get_legacy_media_key(chat_id, msg_id)
+                info = ChunkInfo(id, media_key, chat_id, msg_id, start, length)
+                # a directory dropped from the config leaves its rows behind, reconcile clears them
+                info.tier = min(tier, len(self.disk_tiers) - 1)
+                if self._is_aligned_chunk(info):
+                    self._set_media_chunk_index(info)
+                else:
+                    unaligned_chunks.setdefault(info.media_key, []).append(info)
             except Exception as err:
                 logger.warning(f"restore, {err=},{traceback.format_exc()}")
-        while self.current_cache_size > self.MAX_CACHE_SIZE:
-            self._remove_pop_chunk()
+        for infos in unaligned_chunks.values():
+            try:
+                self._migrate_unaligned_chunks(infos)
+            except Exception as err:
+                logger.warning(f"migrate, {err=},{traceback.format_exc()}")
+        self._schedule_eviction()
+
+    def _migrate_meta_index(self, meta_dir: str) -> None:
+        # chunk meta used to live in a diskcache.Index next to the blobs
+        logger.info("migrate media chunk meta to sqlite index")
+        meta_index = diskcache.Index(meta_dir)
+        now = time.time()
+        rows = []
+        for id, meta in meta_index.items():
+            if not isinstance(meta, tuple):
+                continue
+            rows.append((id, *meta, now))
+        self.index_con.executemany(
+            "INSERT OR REPLACE INTO chunk(id, chat_id, msg_id, start, length, last_access) VALUES(?, ?, ?, ?, ?, ?)", rows
+        )
+        self.index_con.commit()
+        meta_index.cache.close()
+        shutil.rmtree(meta_dir, ignore_errors=True)
+
+    def _migrate_pickled_chunks(self) -> None:
+        # chunks used to be stored as pickled MediaChunkHolder, split them into raw blob and meta
+        directory = self.disk_tiers[0].directory
+        if not os.path.exists(os.path.join(directory, diskcache.core.DBNAME)):
+            # no legacy diskcache there, do not create one next to another store
+            return
+        logger.info("migrate pickled media chunks to raw blobs")
+        with diskcache.Cache(directory, eviction_policy="none") as cache:
+            for id in list(cache.iterkeys()):
+                try:
+                    value = cache.get(id)
+                    if isinstance(value, MediaChunkHolder):
+                        value.info.media_key = self.get_legacy_media_key(value.info.chat_id, value.info.msg_id)
+                        self._store_chunk(value)
+                        if self.disk_tiers[0].store.entry_key(value.info) == id:
+                            # rewritten in place as a raw blob
+                            continue
+                    cache.delete(id)
+                except Exception as err:
+                    logger.warning(f"migrate pickled chunk, {err=},{traceback.format_exc()}")
+
+    def _store_chunk(self, holder: MediaChunkHolder) -> None:
+        # a background download has no reader, keep it off the memory tier
+        hot = holder.download_task is None or holder.download_task.priority != EnumTaskPriority.BACKGROUND
+        self._store_chunk_data(holder.info, holder.get_mem_view(0, holder.length), hot)
+
+    def _store_chunk_data(self, info: ChunkInfo, mem: bytes, hot: bool = True) -> None:
+        data = bytes(mem)
+        # a re-downloaded chunk must not lose its new blob to a queued deletion
+        self.deleting_chunks.discard(info.id)
+        self.disk_tiers[0].store.set(info, data)
+        if hot:
+            self.mem_tier.put(info.id, data)
+        else:
+            self.mem_tier.pop(info.id)
+        self.dirty_access.pop(info.id, None)
+        self.index_con.execute(
+            "INSERT OR REPLACE INTO chunk(id, chat_id, msg_id, start, length, last_access, tier, media_key) VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
+            (info.id, info.chat_id, info.msg_id, info.start, info.length, time.time(), 0, info.media_key),
+        )
+        self.index_con.commit()
+
+    def _delete_chunk(self, info: ChunkInfo) -> bool:
+        self.dirty_access.pop(info.id, None)
+        self.mem_tier.pop(info.id)
+        self.index_con.execute("DELETE FROM chunk WHERE id = ?", (info.id,))
+        self.index_con.commit()
+        return self.disk_tiers[info.tier].store.delete(info)
+
+    def flush_chunk_access(self) -> None:
+        if not self.dirty_access:
+            return
+        rows = [(ts, id) for id, ts in self.dirty_access.items()]
+        self.dirty_access.clear()
+        self.index_con.executemany("UPDATE chunk SET last_access = ? WHERE id = ?", rows)
+        self.index_con.commit()
+
+    async def _reconcile_chunk_index(self) -> None:
+        # drop index rows without blob and blobs without index row, a batch per loop turn
+        ids = list(self.chunk_lru.keys())
+        lost = 0
+        for i in range(0, len(ids), self.RECONCILE_BATCH):
+            for id in ids[i : i + self.RECONCILE_BATCH]:
+                info = self.chunk_lru.get(id)
+                if info is None or id in self.incompleted_chunk or self.disk_tiers[info.tier].store.contains(info):
+                    continue
+                self.cancel_media_chunk(info)
+                lost += 1
+            await asyncio.sleep(0)
+        orphan = 0
+        for index, tier in enumerate(self.disk_tiers):
+            keys = list(tier.store.entries())
+            held, version = {}, None
+            for i in range(0, len(keys), self.RECONCILE_BATCH):
+                if self.evict_task is not None and not self.evict_task.done():
+                    # eviction copies and deletes blobs in worker threads, trimming meanwhile loses them
+                    await asyncio.wait([self.evict_task])
+                if version != self.index_version:
+                    # chunks stored or moved since the last batch are not stray
+                    held, version = self._get_tier_entries(index), self.index_version
+                for key in keys[i : i + self.RECONCILE_BATCH]:
+                    infos = held.get(key)
+                    if infos is not None:
+                        tier.store.trim_entry(key, infos)
+                        continue
+                    tier.store.delete_entry(key)
+                    orphan += 1
+                await asyncio.sleep(0)
+        logger.info(f"reconcile chunk index, {lost=},{orphan=}")
+
+    def _get_tier_entries(self, index: int) -> dict[str, list[ChunkInfo]]:
+        # store entry -> indexed chunks kept in it, downloading ones included
+        tier = self.disk_tiers[index]
+        held: dict[str, list[ChunkInfo]] = {}
+        for info in self.chunk_lru.values():
+            if info.tier == index:
+                held.setdefault(tier.store.entry_key(info), []).append(info)
+        return held
+
+    async def maintain_routine(self) -> None:
+        try:
+            await self._reconcile_chunk_index()
+        except Exception as err:
+            logger.warning(f"reconcile, {err=},{traceback.format_exc()}")
+        self._schedule_eviction()
+        while True:
+            await asyncio.sleep(self.ACCESS_FLUSH_INTERVAL)
+            try:
+                self.flush_chunk_access()
+            except Exception as err:
+                logger.warning(f"flush chunk access, {err=},{traceback.format_exc()}")
+
+    def read_media_chunk(self, chunk: Union[MediaChunkHolder, ChunkInfo], offset: int, size: int) -> Optional[bytes]:
+        # read only [offset, offset + size) of the chunk, None if the blob is gone
+        if isinstance(chunk, MediaChunkHolder):
+            return chunk.get_mem_view(offset, size)
+        data = self.mem_tier.get(chunk.id)
+        if data is not None:
+            return memoryview(data)[offset : offset + size]
+        store = self.disk_tiers[chunk.tier].store
+        if chunk.length > self.mem_tier.budget:
+            data = store.read(chunk, offset, size)
+            if data is None:
+                self.disk_misses += 1
+                return None
+            self.disk_hits += 1
+            return data
+        # promote the whole chunk, the rest of it is likely read next
+        data = store.get(chunk)
+        if data is None:
+            self.disk_misses += 1
+            return None
+        self.disk_hits += 1
+        self.mem_tier.put(chunk.id, data)
+        self.mem_tier.promotions += 1
+        return memoryview(data)[offset : offset + size]
 
-    def get_chunk_holder_by_info(self, info: ChunkInfo) -> MediaChunkHolder:
+    def open_cached_range(self, msg: types.Message, start: int, end: int) -> Optional[list[tuple[ChunkInfo, IO[bytes], int, int]]]:
+        # (chunk, blob, offset, size) covering [start, end] if it is all on disk, None otherwise
+        infos: list[ChunkInfo] = []
+        pos = start
+        while pos <= end:
+            chunk = self.get_media_chunk(msg, pos, lru=False)
+            if not isinstance(chunk, ChunkInfo):
+                return None
+            infos.append(chunk)
+            pos = chunk.start + chunk.length
+        segments = []
+        for info in infos:
+            blob = self.disk_tiers[info.tier].store.open(info)
+            if blob is None:
+                self.disk_misses += 1
+                logger.warning(f"blob lost, {info}")
+                self.cancel_media_chunk(info)
+                for segment in segments:
+                    segment[1].close()
+                return None
+            f, base = blob
+            offset = max(start - info.start, 0)
+            size = min(info.length, end - info.start + 1) - offset
+            self.disk_hits += 1
+            segments.append((info, f, base + offset, size))
+            self.touch_media_chunk(info)
+        return segments
+
+    def get_cached_range_path(self, msg: types.Message, start: int, end: int) -> Optional[tuple[str, Callable[[], None]]]:
+        # file holding [start, end] at the media offsets and the release of its hold, None if there is none
+        infos: list[ChunkInfo] = []
+        pos = start
+        while pos <= end:
+            chunk = self.get_media_chunk(msg, pos, lru=False)
+            if not isinstance(chunk, ChunkInfo):
+                return None
+            infos.append(chunk)
+            pos = chunk.start + chunk.length
+        if any(info.tier != infos[0].tier for info in infos):
+            return None
+        store = self.disk_tiers[infos[0].tier].store
+        key = store.entry_key(infos[0])
+        # held before the chunks are checked, an eviction in between must not punch them under the sender
+        store.hold_entry(key)
+        path = store.get_range_path(infos)
+        if path is None:
+            store.release_entry(key)
+            return None
+        for info in infos:
+            self.disk_hits += 1
+            self.touch_media_chunk(info)
+        return path, functools.partial(store.release_entry, key)
+
+    def _is_aligned_chunk(self, info: ChunkInfo) -> bool:
+        # a shorter chunk on the grid is the tail of the file
+        return info.start % self.chunk_size == 0 and info.length <= self.chunk_size
+
+    def _migrate_unaligned_chunks(self, infos: list[ChunkInfo]) -> None:
+        # rebuild every grid cell fully covered by old chunks, then drop the old chunks
+        infos.sort(key=lambda info: info.start)
+        media_key, chat_id, msg_id = infos[0].media_key, infos[0].chat_id, infos[0].msg_id
+        cell_start = (infos[0].start + self.chunk_size - 1) // self.chunk_size * self.chunk_size
+        max_end = max(info.start + info.length for info in infos)
+        while cell_start + self.chunk_size <= max_end:
+            cell_end = cell_start + self.chunk_size
+            if media_key in self.chunk_cache and self.chunk_cache[media_key].get(cell_start) is not None:
+                cell_start = cell_end
+                continue
+            holder = self._create_chunk_holder(media_key, chat_id, msg_id, cell_start, self.chunk_size)
+            for info in infos:
+                pos = cell_start + holder.length
+                if info.start > pos or info.start + info.length <= pos:
+                    continue
+                mem = self.read_media_chunk(info, pos - info.start, cell_end - pos)
+                if mem is None:
+                    break
+                holder.append_chunk_mem(mem)
+                if holder.is_completed():
+                    break
+            if holder.is_completed():
+                self._store_chunk(holder)
+                self._set_media_chunk_index(holder.info)
+                logger.info(f"migrate unaligned chunks to {holder}")
+            cell_start = cell_end
+        # a sparse store keeps the rebuilt cells in the blocks of the old chunks, deleting those would
+        # punch them out again, so a shared entry is trimmed down to the chunks still indexed in it
+        kept = list(self.chunk_cache.get(media_key, []))
+        trimmed = set()
+        for info in infos:
+            store = self.disk_tiers[info.tier].store
+            key = store.entry_key(info)
+            held = [other for other in kept if other.tier == info.tier and store.entry_key(other) == key]
+            if not held:
+                self._delete_chunk(info)
+                continue
+            self.dirty_access.pop(info.id, None)
+            self.mem_tier.pop(info.id)
+            self.index_con.execute("DELETE FROM chunk WHERE id = ?", (info.id,))
+            if (info.tier, key) not in trimmed:
+                trimmed.add((info.tier, key))
+                store.trim_entry(key, held)
+        self.index_con.commit()
+
+    def get_status(self) -> dict[str, dict[str, any]]:
+        # memory lookups cover every read of a stored chunk, disk lookups the memory misses and file delivery
+        disk_lookups = self.disk_hits + self.disk_misses
+        return {
+            "mem": self.mem_tier.get_status(),
+            "disk": {
+                "size": self.current_cache_size,
+                "chunks": len(self.chunk_lru),
+                "hits": self.disk_hits,
+                "misses": self.disk_misses,
+                "hit_ratio": round(self.disk_hits / disk_lookups, 3) if disk_lookups > 0 else 0.0,
+                "eviction": self.eviction.get_status(),
+                "tiers": [tier.get_status() for tier in self.disk_tiers],
+            },
+        }
+
+    def get_chunk_span(self, pos: int, file_size: int) -> tuple[int, int]:
+        start = pos // self.chunk_size * self.chunk_size
+        return start, min(self.chunk_size, file_size - start)
+
+    def get_chunk_holder_by_info(self, info: ChunkInfo) -> Union[MediaChunkHolder, ChunkInfo]:
         holder = self.incompleted_chunk.get(info.id)
         if holder is not None:
             return holder
-        holder = self.disk_chunk_cache.get(info.id)
-        return holder
+        return info
 
-    def _get_media_msg_cache(self, msg: types.Message) -> Optional[list[ChunkInfo]]:
-        chat_cache = self.chunk_cache.get(msg.chat_id)
-        if chat_cache is None:
+    @staticmethod
+    def get_media_key(msg: types.Message) -> str:
+        # every message carrying the same document, forwards and re-uploads by file id included, shares its chunks
+        if isinstance(msg.media, types.MessageMediaDocument):
+            doc = msg.media.document
+            return f"doc:{doc.id}:{doc.size}:{doc.dc_id}"
+        return MediaChunkHolderManager.get_legacy_media_key(msg.chat_id, msg.id)
+
+    @staticmethod
+    def get_legacy_media_key(chat_id: int, msg_id: int) -> str:
+        return f"msg:{chat_id}:{msg_id}"
+
+    def _get_media_msg_cache(self, msg: types.Message) -> Optional[ChunkIntervalIndex]:
+        media_key = self.get_media_key(msg)
+        legacy_key = self.get_legacy_media_key(msg.chat_id, msg.id)
+        if media_key != legacy_key and (legacy_key in self.chunk_cache or legacy_key in self.pinned_files):
+            self._remap_legacy_media(legacy_key, media_key)
+        return self.chunk_cache.get(media_key)
+
+    def _remap_legacy_media(self, legacy_key: str, media_key: str) -> None:
+        # chunks and pins stored per message before they were keyed by media, moved once the document is known
+        for info in list(self.chunk_cache.get(legacy_key, [])):
+            media_cache = self.chunk_cache.setdefault(media_key, ChunkIntervalIndex())
+            if media_cache.get(info.start) is not None:
+                # another message of the same document cached this chunk too, keep one copy
+                self._remove_chunk_index(info)
+                self._delete_chunk(info)
+                continue
+            self.chunk_cache[legacy_key].remove(info)
+            self.disk_tiers[info.tier].store.rekey(info, media_key)
+            self.index_version += 1
+            media_cache.insert(info)
+            self.index_con.execute("UPDATE chunk SET media_key = ? WHERE id = ?", (media_key, info.id))
+        self.chunk_cache.pop(legacy_key, None)
+        pins = self.pinned_files.pop(legacy_key, {})
+        for msg_key, ranges in pins.items():
+            self.pinned_files.setdefault(media_key, {}).setdefault(msg_key, []).extend(ranges)
+            self.index_con.execute("UPDATE pin SET media_key = ? WHERE chat_id = ? AND msg_id = ?", (media_key, *msg_key))
+        self.index_con.commit()
+        logger.info(f"remap {legacy_key} to {media_key}")
+
+    def _get_media_chunk_cache(self, msg: types.Message, start: int) -> Optional[Union[MediaChunkHolder, ChunkInfo]]:
+        msg_cache = self._get_media_msg_cache(msg)
+        if msg_cache is None:
+            return None
+        info = msg_cache.find(start)
+        if info is None:
             return None
-        return chat_cache.get(msg.id)
+        return self.get_chunk_holder_by_info(info)
 
-    def _get_media_chunk_cache(self, msg: types.Message, start: int) -> Optional[MediaChunkHolder]:
+    def pin_media(self, msg: types.Message, start: int, end: int) -> None:
+        media_key = self.get_media_key(msg)
+        ranges = self.pinned_files.setdefault(media_key, {}).setdefault((msg.chat_id, msg.id), [])
+        if (start, end) in ranges:
+            return
+        ranges.append((start, end))
+        self.index_con.execute(
+            "INSERT OR REPLACE INTO pin(chat_id, msg_id, start, end, media_key) VALUES(?, ?, ?, ?, ?)",
+            (msg.chat_id, msg.id, start, end, media_key),
+        )
+        self.index_con.commit()
+
+    def unpin_media(self, chat_id: int, msg_id: int) -> bool:
+        # the other messages of the same media keep their pins
+        for media_key, pins in self.pinned_files.items():
+            if pins.pop((chat_id, msg_id), None) is None:
+                continue
+            if len(pins) == 0:
+                self.pinned_files.pop(media_key)
+            self.index_con.execute("DELETE FROM pin WHERE chat_id = ? AND msg_id = ?", (chat_id, msg_id))
+            self.index_con.commit()
+            self._schedule_eviction()
+            return True
+        return False
+
+    def is_chunk_pinned(self, info: ChunkInfo) -> bool:
+        for ranges in self.pinned_files.get(info.media_key, {}).values():
+            for start, end in ranges:
+                if info.start <= end and info.start + info.length > start:
+                    return True
+        return False
+
+    def get_cached_spans(self, msg: types.Message, start: int, end: int) -> tuple[list[tuple[int, int]], list[tuple[int, int]]]:
+        # cached and missing [start, end] spans of the range, a chunk still downloading covers its completed prefix
+        msg_cache = self._get_media_msg_cache(msg)
+        cached: list[list[int]] = []
+        for info in msg_cache.overlap(start, end) if msg_cache is not None else []:
+            holder = self.incompleted_chunk.get(info.id)
+            length = info.length if holder is None else holder.length
+            span_start, span_end = max(info.start, start), min(info.start + length - 1, end)
+            if span_start > span_end:
+                continue
+            if cached and cached[-1][1] + 1 >= span_start:
+                cached[-1][1] = max(cached[-1][1], span_end)
+            else:
+                cached.append([span_start, span_end])
+        missing = []
+        pos = start
+        for span_start, span_end in cached:
+            if span_start > pos:
+                missing.append((pos, span_start - 1))
+            pos = span_end + 1
+        if pos <= end:
+            missing.append((pos, end))
+        return [tuple(span) for span in cached], missing
+
+    def get_cached_size(self, msg: types.Message, start: int, end: int) -> int:
+        cached, _ = self.get_cached_spans(msg, start, end)
+        return sum(span_end - span_start + 1 for span_start, span_end in cached)
+
+    def get_chunk_directory(self, info: ChunkInfo) -> str:
+        return self.disk_tiers[info.tier].directory
+
+    def get_media_file_path(self, msg: types.Message) -> Optional[tuple[list[ChunkInfo], str]]:
+        # plain file holding the whole media if it is fully on disk in one, with the chunks in it
         msg_cache = self._get_media_msg_cache(msg)
-        if msg_cache is None or len(msg_cache) == 0:
+        size = msg.media.document.size
+        if msg_cache is None or size <= 0:
             return None
-        pos = bisect.bisect_left(msg_cache, start)
-        if pos == len(msg_cache):
-            pos = pos - 1
-            if msg_cache[pos].start <= start and msg_cache[pos].start + msg_cache[pos].length > start:
-                return self.get_chunk_holder_by_info(msg_cache[pos])
+        infos = []
+        pos = 0
+        while pos < size:
+            info = msg_cache.find(pos)
+            if info is None or info.id in self.incompleted_chunk:
+                return None
+            infos.append(info)
+            pos = info.start + info.length
+        if any(info.tier != infos[0].tier for info in infos):
             return None
-        elif msg_cache[pos].start == start:
-            return self.get_chunk_holder_by_info(msg_cache[pos])
-        elif pos > 0:
-            pos = pos - 1
-            if msg_cache[pos].start <= start and msg_cache[pos].start + msg_cache[pos].length > start:
-                return self.get_chunk_holder_by_info(msg_cache[pos])
+        path = self.disk_tiers[infos[0].tier].store.get_file_path(infos)
+        if path is None:
             return None
-        return None
+        return infos, path
+
+    def _schedule_eviction(self) -> None:
+        # eviction runs in the background once a tier passes its high watermark, never on the request path
+        if self.evict_task is not None and not self.evict_task.done():
+            return
+        if all(tier.size <= tier.high_watermark for tier in self.disk_tiers):
+            return
+        try:
+            self.evict_task = asyncio.get_running_loop().create_task(self._evict_routine())
+        except RuntimeError:
+            # no loop yet, maintain_routine schedules it once it runs
+            pass
 
-    def _remove_pop_chunk(self, pop_chunk: ChunkInfo = None) -> None:
+    async def _evict_routine(self) -> None:
         try:
-            if pop_chunk is None:
-                dummy = self.chunk_lru.popitem(last=False)
-                pop_chunk = dummy[1]
-            self.chunk_cache[pop_chunk.chat_id][pop_chunk.msg_id].remove(pop_chunk.start)
-            self.current_cache_size -= pop_chunk.length
-            if len(self.chunk_cache[pop_chunk.chat_id][pop_chunk.msg_id]) == 0:
-                self.chunk_cache[pop_chunk.chat_id].pop(pop_chunk.msg_id)
-                if len(self.chunk_cache[pop_chunk.chat_id]) == 0:
-                    self.chunk_cache.pop(pop_chunk.chat_id)
+            while True:
+                over = [i for i, tier in enumerate(self.disk_tiers) if tier.size > tier.high_watermark]
+                if not over:
+                    return
+                for index in over:
+                    await self._evict_tier(index)
+                if all(self.disk_tiers[i].size > self.disk_tiers[i].high_watermark for i in over):
+                    # nothing left to move in those tiers until a pin or download goes away
+                    return
+        except Exception as err:
+            logger.warning(f"evict, {err=},{traceback.format_exc()}")
+
+    def _pick_tier_victims(self, index: int) -> list[ChunkInfo]:
+        # best victims of the policy down to the low watermark, downloading chunks are skipped,
+        # pinned ones too unless there is a slower tier to keep them in
+        tier = self.disk_tiers[index]
+        last = index == len(self.disk_tiers) - 1
+        excess = tier.size - tier.low_watermark
+        victims = []
+        for id in self.eviction.victims():
+            info = self.chunk_lru.get(id)
+            if info is None or info.tier != index or id in self.incompleted_chunk:
+                continue
+            if last and self.is_chunk_pinned(info):
+                continue
+            victims.append(info)
+            excess -= info.length
+            if excess <= 0:
+                break
+        if excess > 0:
+            logger.warning(f"tier {tier.directory} full of pinned or downloading chunks, {tier.size=}")
+        return victims
+
+    async def _evict_tier(self, index: int) -> None:
+        victims = self._pick_tier_victims(index)
+        for i in range(0, len(victims), self.EVICT_BATCH):
+            batch = victims[i : i + self.EVICT_BATCH]
+            if index == len(self.disk_tiers) - 1:
+                await self._delete_tier_chunks(index, batch)
+            else:
+                await self._demote_tier_chunks(index, batch)
+
+    async def _delete_tier_chunks(self, index: int, infos: list[ChunkInfo]) -> None:
+        tier = self.disk_tiers[index]
+        deleted = []
+        for info in infos:
+            if self.chunk_lru.get(info.id) is not info:
+                continue
+            self._remove_chunk_index(info)
+            self.dirty_access.pop(info.id, None)
+            self.mem_tier.pop(info.id)
+            self.deleting_chunks.add(info.id)
+            deleted.append(info)
+        ids = [info.id for info in deleted]
+        self.index_con.executemany("DELETE FROM chunk WHERE id = ?", [(id,) for id in ids])
+        self.index_con.commit()
+        await asyncio.to_thread(self._delete_blobs, tier, deleted)
+        tier.evicted += len(ids)
+        self.deleting_chunks.difference_update(ids)
+
+    def _delete_blobs(self, tier: DiskChunkTier, infos: list[ChunkInfo]) -> None:
+        # worker thread, skips chunks stored again since they were queued
+        for info in infos:
+            if info.id in self.deleting_chunks:
+                tier.store.delete(info)
+
+    async def _demote_tier_chunks(self, index: int, infos: list[ChunkInfo]) -> None:
+        tier, next_tier = self.disk_tiers[index], self.disk_tiers[index + 1]
+        moved = await asyncio.to_thread(self._copy_blobs, tier, next_tier, infos)
+        rows = []
+        demoted = []
+        for info in infos:
+            if info.id not in moved:
+                continue
+            if self.chunk_lru.get(info.id) is not info or info.tier != index:
+                # dropped or stored again while copying, the copy is an orphan
+                next_tier.store.delete(info)
+                continue
+            # readers go to the new tier from here, the old blob is dropped below
+            info.tier = index + 1
+            self.index_version += 1
+            tier.size -= info.length
+            next_tier.size += info.length
+            rows.append((info.tier, info.id))
+            demoted.append(info)
+        self.index_con.executemany("UPDATE chunk SET tier = ? WHERE id = ?", rows)
+        self.index_con.commit()
+        ids = [id for _, id in rows]
+        self.deleting_chunks.update(ids)
+        await asyncio.to_thread(self._delete_blobs, tier, demoted)
+        self.deleting_chunks.difference_update(ids)
+        tier.demoted += len(ids)
+
+    def _copy_blobs(self, tier: DiskChunkTier, next_tier: DiskChunkTier, infos: list[ChunkInfo]) -> set[str]:
+        # worker thread
+        moved = set()
+        for info in infos:
+            data = tier.store.get(info)
+            if data is None:
+                continue
+            next_tier.store.set(info, data)
+            moved.add(info.id)
+        return moved
+
+    def _remove_chunk_index(self, info: ChunkInfo) -> None:
+        self.chunk_lru.pop(info.id, None)
+        self.eviction.remove(info.id)
+        self.chunk_cache[info.media_key].remove(info)
+        self.current_cache_size -= info.length
+        self.disk_tiers[info.tier].size -= info.length
+        if len(self.chunk_cache[info.media_key]) == 0:
+            self.chunk_cache.pop(info.media_key)
+
+    def _remove_pop_chunk(self, pop_chunk: ChunkInfo) -> None:
+        try:
+            self._remove_chunk_index(pop_chunk)
             pop_holder = self.incompleted_chunk.get(pop_chunk.id)
             if pop_holder is not None:
                 self.incompleted_chunk.pop(pop_chunk.id)
                 return
-            suc = self.disk_chunk_cache.delete(pop_chunk.id)
+            suc = self._delete_chunk(pop_chunk)
             if not suc:
                 logger.warning(f"could not del, {pop_chunk}")
         except Exception as err:
             logger.warning(f"remove chunk,{err=},{traceback.format_exc()}")
 
-    def create_media_chunk_holder(self, chat_id: int, msg_id: int, start: int, target_len: int) -> MediaChunkHolder:
-        return MediaChunkHolder(chat_id, msg_id, start, target_len)
+    def create_media_chunk_holder(self, msg: types.Message, start: int, target_len: int) -> MediaChunkHolder:
+        # remap first, a partial chunk stored per message is found under the media key
+        self._get_media_msg_cache(msg)
+        return self._create_chunk_holder(self.get_media_key(msg), msg.chat_id, msg.id, start, target_len)
+
+    def _create_chunk_holder(self, media_key: str, chat_id: int, msg_id: int, start: int, target_len: int) -> MediaChunkHolder:
+        holder = MediaChunkHolder(media_key, chat_id, msg_id, start, target_len)
+        # legacy chunks keep the id they were stored with, so look the partial chunk up by offset
+        partial = self.chunk_cache[media_key].get(start) if media_key in self.chunk_cache else None
+        if partial is None or partial.id in self.incompleted_chunk or partial.length >= target_len:
+            return holder
+        # a cancelled download kept this prefix, go on from its last byte
+        mem = self.read_media_chunk(partial, 0, partial.length)
+        self._remove_chunk_index(partial)
+        self._delete_chunk(partial)
+        if mem is not None and len(mem) == partial.length:
+            holder.append_chunk_mem(mem)
+            logger.info(f"resume partial chunk:{holder}")
+        return holder
+
+    def keep_partial_chunk(self, holder: MediaChunkHolder) -> None:
+        # store the completed prefix of a cancelled download as a shorter chunk instead of dropping it
+        if self.incompleted_chunk.get(holder.chunk_id) is not holder:
+            return
+        holder.discard_pending_mem()
+        if holder.length < self.MIN_PARTIAL_CHUNK_SIZE:
+            self.cancel_media_chunk(holder)
+            return
+        self.incompleted_chunk.pop(holder.chunk_id)
+        self._remove_chunk_index(holder.info)
+        info = ChunkInfo(
+            holder.chunk_id, holder.info.media_key, holder.info.chat_id, holder.info.msg_id, holder.start, holder.length
+        )
+        self._store_chunk_data(info, holder.get_mem_view(0, holder.length))
+        self._set_media_chunk_index(info)
+        logger.info(f"keep partial chunk:{info}")
 
-    def get_media_chunk(self, msg: types.Message, start: int, lru: bool = True) -> Optional[MediaChunkHolder]:
+    def get_media_chunk(self, msg: types.Message, start: int, lru: bool = True) -> Optional[Union[MediaChunkHolder, ChunkInfo]]:
         res = self._get_media_chunk_cache(msg, start)
         logger.debug(f"get_media_chunk:{res}")
         if res is None:
             return None
         if lru:
-            self.chunk_lru.move_to_end(res.chunk_id)
+            self.touch_media_chunk(res)
         return res
 
+    def touch_media_chunk(self, chunk: Union[MediaChunkHolder, ChunkInfo]) -> None:
+        # a reader entered the chunk, once per chunk and reader rather than per read
+        self.eviction.access(chunk.chunk_id)
+        if isinstance(chunk, ChunkInfo):
+            self.dirty_access[chunk.id] = time.time()
+        if self.access_trace is not None:
+            info = chunk.info if isinstance(chunk, MediaChunkHolder) else chunk
+            self.access_trace.write(f"{time.time():.3f},{info.media_key},{info.start},{info.length}\n")
+
     def _set_media_chunk_index(self, info: ChunkInfo) -> None:
+        self.index_version += 1
         self.chunk_lru[info.id] = info
-        self.chunk_cache.setdefault(info.chat_id, {})
-        self.chunk_cache[info.chat_id].setdefault(info.msg_id, [])
-        bisect.insort(self.chunk_cache[info.chat_id][info.msg_id], info)
+        self.eviction.insert(info.id, info.length)
+        self.chunk_cache.setdefault(info.media_key, ChunkIntervalIndex()).insert(info)
         self.current_cache_size += info.length
+        self.disk_tiers[info.tier].size += info.length
 
     def set_media_chunk(self, chunk: MediaChunkHolder) -> None:
         if chunk.is_completed():
-            self.disk_chunk_cache.set(chunk.chunk_id, chunk)
+            self._store_chunk(chunk)
         else:
             self.incompleted_chunk[chunk.chunk_id] = chunk
         self._set_media_chunk_index(chunk.info)
-        while self.current_cache_size > self.MAX_CACHE_SIZE:
-            self._remove_pop_chunk()
+        self._schedule_eviction()
 
-    def cancel_media_chunk(self, chunk: MediaChunkHolder) -> None:
-        dummy = self.chunk_lru.pop(chunk.chunk_id, None)
+    def cancel_media_chunk(self, chunk: Union[MediaChunkHolder, ChunkInfo]) -> None:
+        if isinstance(chunk, MediaChunkHolder) and self.incompleted_chunk.get(chunk.chunk_id) is not chunk:
+            # already on disk, kept as a partial chunk or dropped
+            return
+        dummy = self.chunk_lru.get(chunk.chunk_id)
         if dummy is None:
             return
         self._remove_pop_chunk(dummy)
@@ -271,5 +1144,7 @@ class MediaChunkHolderManager(object):
         if not holder.is_completed():
             logger.error(f"chunk not completed, but move to disk:{holder=}")
         logger.info(f"cache new chunk:{holder}")
-        self.disk_chunk_cache.set(holder.chunk_id, holder)
+        self._store_chunk(holder)
+        # skipped by eviction while it was downloading
+        self._schedule_eviction()
         return True
@@ -0,0 +1,153 @@
+import struct
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__file__.split("/")[-1])
+
+MP4_MIME_TYPES = {"video/mp4", "video/quicktime", "video/x-m4v", "video/3gpp"}
+MKV_MIME_TYPES = {"video/x-matroska", "video/webm"}
+
+EBML_ID = 0x1A45DFA3
+MKV_SEGMENT_ID = 0x18538067
+MKV_SEEK_HEAD_ID = 0x114D9B74
+MKV_SEEK_ID = 0x4DBB
+MKV_SEEK_ID_ID = 0x53AB
+MKV_SEEK_POSITION_ID = 0x53AC
+MKV_CUES_ID = 0x1C53BB6B
+MKV_CLUSTER_ID = 0x1F43B675
+
+
+def _read_mp4_box(head: bytes, offset: int, file_size: int) -> Optional[tuple[bytes, int, int]]:
+    # (type, header size, box size) of the box at offset, None if the header is not in head
+    if offset + 8 > len(head):
+        return None
+    size, box_type = struct.unpack_from(">I4s", head, offset)
+    header = 8
+    if size == 1:
+        if offset + 16 > len(head):
+            return None
+        size = struct.unpack_from(">Q", head, offset + 8)[0]
+        header = 16
+    elif size == 0:
+        size = file_size - offset
+    if size < header:
+        return None
+    return box_type, header, size
+
+
+def probe_mp4_index(head: bytes, file_size: int) -> Optional[tuple[int, int]]:
+    """[start, end] of the moov box, or of the unread tail it has to be in."""
+    box = _read_mp4_box(head, 0, file_size)
+    if box is None or box[0] != b"ftyp":
+        return None
+    offset = 0
+    while offset < file_size:
+        box = _read_mp4_box(head, offset, file_size)
+        if box is None:
+            # the next header is past the probed bytes, moov is somewhere after it
+            return offset, file_size - 1
+        box_type, _, size = box
+        if box_type == b"moov":
+            return offset, min(offset + size, file_size) - 1
+        offset += size
+    return None
+
+
+def _read_ebml_vint(head: bytes, offset: int, keep_marker: bool) -> Optional[tuple[int, int]]:
+    # (value, length) of the variable size integer at offset, value -1 means unknown size
+    if offset >= len(head):
+        return None
+    first = head[offset]
+    length = 1
+    while length <= 8 and not first & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8 or offset + length > len(head):
+        return None
+    value = first if keep_marker else first & (0xFF >> length)
+    for b in head[offset + 1 : offset + length]:
+        value = (value << 8) | b
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        value = -1
+    return value, length
+
+
+def _read_ebml_element(head: bytes, offset: int) -> Optional[tuple[int, int, int]]:
+    # (id, header size, data size) of the element at offset
+    element_id = _read_ebml_vint(head, offset, True)
+    if element_id is None:
+        return None
+    size = _read_ebml_vint(head, offset + element_id[1], False)
+    if size is None:
+        return None
+    return element_id[0], element_id[1] + size[1], size[0]
+
+
+def _read_mkv_seek_head(head: bytes, offset: int, end: int) -> dict[int, int]:
+    # element id -> position relative to the segment data
+    positions = {}
+    while offset < end:
+        seek = _read_ebml_element(head, offset)
+        if seek is None or seek[2] < 0:
+            break
+        seek_id, seek_header, seek_size = seek
+        if seek_id == MKV_SEEK_ID:
+            target_id = None
+            position = None
+            child = offset + seek_header
+            while child < offset + seek_header + seek_size:
+                element = _read_ebml_element(head, child)
+                if element is None or element[2] < 0:
+                    break
+                data = head[child + element[1] : child + element[1] + element[2]]
+                if element[0] == MKV_SEEK_ID_ID:
+                    target_id = int.from_bytes(data, "big")
+                elif element[0] == MKV_SEEK_POSITION_ID:
+                    position = int.from_bytes(data, "big")
+                child += element[1] + element[2]
+            if target_id is not None and position is not None:
+                positions[target_id] = position
+        offset += seek_header + seek_size
+    return positions
+
+
+def probe_mkv_index(head: bytes, file_size: int) -> Optional[tuple[int, int]]:
+    """[start, end] of the Cues element found through the SeekHead."""
+    ebml = _read_ebml_element(head, 0)
+    if ebml is None or ebml[0] != EBML_ID or ebml[2] < 0:
+        return None
+    segment_offset = ebml[1] + ebml[2]
+    segment = _read_ebml_element(head, segment_offset)
+    if segment is None or segment[0] != MKV_SEGMENT_ID:
+        return None
+    data_start = segment_offset + segment[1]
+    offset = data_start
+    while offset < len(head):
+        element = _read_ebml_element(head, offset)
+        if element is None or element[2] < 0 or element[0] == MKV_CLUSTER_ID:
+            return None
+        element_id, header, size = element
+        if element_id == MKV_SEEK_HEAD_ID:
+            cues_position = _read_mkv_seek_head(head, offset + header, min(offset + header + size, len(head))).get(MKV_CUES_ID)
+            if cues_position is None:
+                return None
+            cues_offset = data_start + cues_position
+            if cues_offset >= file_size:
+                return None
+            cues = _read_ebml_element(head, cues_offset)
+            if cues is not None and cues[0] == MKV_CUES_ID and cues[2] >= 0:
+                return cues_offset, min(cues_offset + cues[1] + cues[2], file_size) - 1
+            return cues_offset, file_size - 1
+        offset += header + size
+    return None
+
+
+def probe_index_range(head: bytes, file_size: int) -> Optional[tuple[int, int]]:
+    """Byte range holding the seek index of an MP4 or Matroska file, judged from its first bytes."""
+    try:
+        if head[4:8] == b"ftyp":
+            return probe_mp4_index(head, file_size)
+        if head[:4] == EBML_ID.to_bytes(4, "big"):
+            return probe_mkv_index(head, file_size)
+    except Exception as err:
+        logger.warning(f"probe container,{err=}")
+    return None
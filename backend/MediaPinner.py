@@ -0,0 +1,154 @@
+import time
+import asyncio
+import logging
+import traceback
+from typing import TYPE_CHECKING, Optional, Union
+
+from telethon import types
+
+from backend.MediaCacheManager import ChunkInfo, MediaChunkHolder
+from backend.TaskScheduler import EnumTaskPriority
+
+if TYPE_CHECKING:
+    from backend.TgFileSystemClient import TgFileSystemClient
+
+logger = logging.getLogger(__file__.split("/")[-1])
+
+
+class PinProgress(object):
+    def __init__(self, msg: types.Message, start: int, end: int, stream_id: int) -> None:
+        self.msg = msg
+        self.start = start
+        self.end = end
+        self.stream_id = stream_id
+        self.state = "queued"
+        self.error = ""
+        self.begin_ts = time.monotonic()
+        self.downloaded = 0
+        self.cancelled = False
+        self.requester = PinRequester(self)
+        self.holders: list[MediaChunkHolder] = []
+        self.task: Optional[asyncio.Task] = None
+
+    def __repr__(self) -> str:
+        return f"pin:{self.msg.chat_id}:{self.msg.id},[{self.start}:{self.end}],{self.state}"
+
+    @property
+    def rate(self) -> float:
+        cost = time.monotonic() - self.begin_ts
+        return self.downloaded / cost if cost > 0 else 0.0
+
+
+class PinRequester(object):
+    """Keeps the holders of a pin alive until it is unpinned."""
+
+    def __init__(self, progress: PinProgress) -> None:
+        self.progress = progress
+
+
+class MediaPinner(object):
+    # chunks of one pin downloaded at the same time
+    PIN_WINDOW = 2
+    client: "TgFileSystemClient"
+    # (chat_id, msg_id) -> PinProgress
+    pins: dict[tuple[int, int], PinProgress]
+
+    def __init__(self, client: "TgFileSystemClient") -> None:
+        self.client = client
+        self.pins = {}
+
+    def pin(self, msg: types.Message, start: int, end: int) -> PinProgress:
+        key = (msg.chat_id, msg.id)
+        progress = self.pins.get(key)
+        if progress is not None and progress.start == start and progress.end == end and progress.state != "error":
+            return progress
+        if progress is not None:
+            self._cancel(progress)
+        self.client.media_chunk_manager.pin_media(msg, start, end)
+        progress = PinProgress(msg, start, end, self.client._get_unique_task_id())
+        self.pins[key] = progress
+        progress.task = self.client.client.loop.create_task(self._pin_routine(progress))
+        logger.info(f"pin {progress}")
+        return progress
+
+    def unpin(self, chat_id: int, msg_id: int) -> bool:
+        progress = self.pins.pop((chat_id, msg_id), None)
+        if progress is not None:
+            self._cancel(progress)
+        return self.client.media_chunk_manager.unpin_media(chat_id, msg_id) or progress is not None
+
+    def _cancel(self, progress: PinProgress) -> None:
+        progress.cancelled = True
+        if progress.task is not None and not progress.task.done():
+            progress.task.cancel()
+        for holder in progress.holders:
+            self.client.release_chunk_requester(holder, progress.requester)
+        progress.holders.clear()
+        logger.info(f"unpin {progress}")
+
+    def get_progress(self, progress: PinProgress) -> dict[str, any]:
+        total = progress.end - progress.start + 1
+        cached = self.client.media_chunk_manager.get_cached_size(progress.msg, progress.start, progress.end)
+        rate = progress.rate
+        eta = (total - cached) / rate if rate > 0 else None
+        return {
+            "chat_id": progress.msg.chat_id,
+            "msg_id": progress.msg.id,
+            "start": progress.start,
+            "end": progress.end,
+            "state": progress.state,
+            "error": progress.error,
+            "total": total,
+            "cached": cached,
+            "downloaded": progress.downloaded,
+            "rate": round(rate),
+            "eta": None if eta is None else round(eta, 1),
+        }
+
+    def get_status(self) -> list[dict[str, any]]:
+        return [self.get_progress(progress) for progress in self.pins.values()]
+
+    def _post_chunk(self, progress: PinProgress, pos: int) -> Union[MediaChunkHolder, ChunkInfo]:
+        # chunk covering pos, a new holder is downloaded at background priority
+        mgr = self.client.media_chunk_manager
+        chunk = mgr.get_media_chunk(progress.msg, pos, lru=False)
+        if chunk is None:
+            chunk_start, chunk_size = mgr.get_chunk_span(pos, progress.msg.media.document.size)
+            chunk = mgr.create_media_chunk_holder(progress.msg, chunk_start, chunk_size)
+            chunk.add_chunk_requester(progress.requester)
+            mgr.set_media_chunk(chunk)
+            self.client.post_download_task(progress.msg, chunk, EnumTaskPriority.BACKGROUND, progress.stream_id)
+        elif not chunk.is_completed():
+            chunk.add_chunk_requester(progress.requester)
+        return chunk
+
+    async def _wait_chunk(self, progress: PinProgress, holder: MediaChunkHolder) -> None:
+        while not holder.is_completed():
+            await holder.wait_chunk_update()
+            if holder.chunk_id not in self.client.media_chunk_manager.incompleted_chunk and not holder.is_completed():
+                raise RuntimeError(f"chunk download dropped:{holder}")
+        progress.downloaded += holder.target_len
+
+    async def _pin_routine(self, progress: PinProgress) -> None:
+        progress.state = "downloading"
+        pos = progress.start
+        try:
+            while not progress.cancelled and (pos <= progress.end or progress.holders):
+                while pos <= progress.end and len(progress.holders) < self.PIN_WINDOW:
+                    chunk = self._post_chunk(progress, pos)
+                    pos = chunk.start + chunk.target_len
+                    if not chunk.is_completed():
+                        progress.holders.append(chunk)
+                if progress.holders:
+                    await self._wait_chunk(progress, progress.holders[0])
+                    progress.holders.pop(0)
+            progress.state = "done"
+        except asyncio.CancelledError:
+            progress.state = "cancelled"
+        except Exception as err:
+            logger.error(f"pin routine:{progress},{err=},{traceback.format_exc()}")
+            progress.state = "error"
+            progress.error = f"{err}"
+            for holder in progress.holders:
+                self.client.release_chunk_requester(holder, progress.requester)
+            progress.holders.clear()
@@ -0,0 +1,280 @@
+import time
+import math
+import asyncio
+import logging
+import collections
+from typing import TYPE_CHECKING, Optional, Union
+
+from telethon import types
+
+from backend.MediaCacheManager import ChunkInfo, MediaChunkHolder
+from backend.MediaContainerProbe import MKV_MIME_TYPES, MP4_MIME_TYPES, probe_index_range
+
+if TYPE_CHECKING:
+    from backend.TgFileSystemClient import TgFileSystemClient
+
+logger = logging.getLogger(__file__.split("/")[-1])
+
+
+class PrefetchEntry(object):
+    def __init__(self, holder: MediaChunkHolder, stream_id: int) -> None:
+        self.holder = holder
+        self.stream_id = stream_id
+        self.cancelled = False
+        self.requester = PrefetchRequester(self)
+
+    def __repr__(self) -> str:
+        return f"prefetch:stream:{self.stream_id},cancelled:{self.cancelled},{self.holder}"
+
+
+class PrefetchRequester(object):
+    """Holds a prefetched holder alive until the prefetch is cancelled or a real reader joins."""
+
+    def __init__(self, entry: PrefetchEntry) -> None:
+        self.entry = entry
+
+
+class StreamCursor(object):
+    def __init__(self) -> None:
+        self.last_end = -1
+        self.seq_count = 0
+        self.consume_rate = 0.0
+        self.last_consume_ts = 0.0
+
+
+class FileAccessState(object):
+    def __init__(self) -> None:
+        # stream_id -> StreamCursor, a stream continuing where another one ended takes its cursor over
+        self.cursors: collections.OrderedDict[int, StreamCursor] = collections.OrderedDict()
+        # holder start -> PrefetchEntry
+        self.prefetched: dict[int, PrefetchEntry] = {}
+        # holder start -> PrefetchEntry of the container index, kept across seeks and stream disconnects
+        self.index_prefetched: dict[int, PrefetchEntry] = {}
+        self.index_stream_id = 0
+        self.probed = False
+        self.probe_task: Optional[asyncio.Task] = None
+
+
+class MediaPrefetcher(object):
+    MAX_FILE_STATES = 256
+    MAX_STREAM_CURSORS = 8  # per file
+    RATE_ALPHA = 0.3
+    # head bytes parsed for the container index
+    PROBE_SIZE = 64 * 1024
+    PROBE_TIMEOUT = 30
+    # an index region spanning more chunks only gets its first and last one
+    MAX_INDEX_CHUNKS = 2
+    client: "TgFileSystemClient"
+    # (chat_id, msg_id) -> FileAccessState
+    file_states: collections.OrderedDict[tuple[int, int], FileAccessState]
+
+    def __init__(self, client: "TgFileSystemClient", max_window: int, index_prefetch: bool = True) -> None:
+        self.client = client
+        self.max_window = max_window
+        self.index_prefetch = index_prefetch
+        self.download_rate = 0.0
+        self.file_states = collections.OrderedDict()
+
+    def _get_file_state(self, msg: types.Message) -> FileAccessState:
+        key = (msg.chat_id, msg.id)
+        state = self.file_states.get(key)
+        if state is None:
+            state = FileAccessState()
+            self.file_states[key] = state
+            while len(self.file_states) > self.MAX_FILE_STATES:
+                _, dummy = self.file_states.popitem(last=False)
+                if dummy.probe_task is not None:
+                    dummy.probe_task.cancel()
+                self._cancel_entries(dummy, list(dummy.prefetched.values()) + list(dummy.index_prefetched.values()))
+        self.file_states.move_to_end(key)
+        return state
+
+    def _get_cursor(self, state: FileAccessState, stream_id: int, pos: int) -> StreamCursor:
+        cursor = state.cursors.get(stream_id)
+        if cursor is not None:
+            state.cursors.move_to_end(stream_id)
+            return cursor
+        # players read a file as a series of range requests, the next one continues the cursor of the last
+        for old_id, old_cursor in state.cursors.items():
+            if old_cursor.last_end >= 0 and abs(pos - old_cursor.last_end) <= self.client.SINGLE_NET_CHUNK_SIZE:
+                state.cursors.pop(old_id)
+                for entry in state.prefetched.values():
+                    if entry.stream_id == old_id:
+                        entry.stream_id = stream_id
+                state.cursors[stream_id] = old_cursor
+                return old_cursor
+        cursor = StreamCursor()
+        state.cursors[stream_id] = cursor
+        while len(state.cursors) > self.MAX_STREAM_CURSORS:
+            old_id, _ = state.cursors.popitem(last=False)
+            self._cancel_entries(state, [entry for entry in state.prefetched.values() if entry.stream_id == old_id])
+        return cursor
+
+    def get_window(self, cursor: StreamCursor) -> int:
+        if self.max_window <= 0:
+            return 0
+        if self.download_rate <= 0 or cursor.consume_rate <= 0:
+            return 1
+        # chunks downloaded concurrently to keep up with the reader, plus one in reserve
+        window = math.ceil(cursor.consume_rate / self.download_rate) + 1
+        return max(1, min(window, self.max_window))
+
+    def on_chunk_downloaded(self, size: int, cost: float) -> None:
+        if size <= 0 or cost <= 0:
+            return
+        rate = size / cost
+        self.download_rate = rate if self.download_rate <= 0 else self.download_rate * (1 - self.RATE_ALPHA) + rate * self.RATE_ALPHA
+
+    def on_consume(self, msg: types.Message, pos: int, size: int, stream_id: int) -> None:
+        cursor = self._get_cursor(self._get_file_state(msg), stream_id, pos)
+        now = time.monotonic()
+        if cursor.last_consume_ts > 0 and now > cursor.last_consume_ts:
+            rate = size / (now - cursor.last_consume_ts)
+            cursor.consume_rate = (
+                rate if cursor.consume_rate <= 0 else cursor.consume_rate * (1 - self.RATE_ALPHA) + rate * self.RATE_ALPHA
+            )
+        cursor.last_consume_ts = now
+        cursor.last_end = pos + size
+
+    def on_access(self, msg: types.Message, holder: MediaChunkHolder, pos: int, end: int, stream_id: int) -> None:
+        if self.index_prefetch:
+            self._probe_index(msg, holder)
+        if self.max_window <= 0:
+            return
+        state = self._get_file_state(msg)
+        cursor = self._get_cursor(state, stream_id, pos)
+        file_size = msg.media.document.size
+        if cursor.last_end >= 0 and abs(pos - cursor.last_end) <= self.client.SINGLE_NET_CHUNK_SIZE:
+            cursor.seq_count += 1
+        elif cursor.last_end >= 0:
+            # seek away, drop the prefetches of this stream that the new position does not need
+            cursor.seq_count = 0
+            cursor.consume_rate = 0.0
+            cursor.last_consume_ts = 0.0
+            window_end = pos + self.max_window * self.client.media_chunk_manager.chunk_size
+            self._cancel_entries(
+                state,
+                [
+                    entry
+                    for start, entry in state.prefetched.items()
+                    if entry.stream_id == stream_id and (start < pos or start >= window_end)
+                ],
+            )
+        cursor.last_end = pos
+        state.prefetched.pop(holder.start, None)
+        # a reader asking past this chunk, or reading sequential requests, will need the following chunks
+        limit = file_size - 1 if cursor.seq_count > 1 else end
+        next_pos = holder.start + holder.target_len
+        for _ in range(self.get_window(cursor)):
+            if next_pos > limit or next_pos >= file_size:
+                break
+            cache_chunk = self.client.media_chunk_manager.get_media_chunk(msg, next_pos, lru=False)
+            if cache_chunk is not None:
+                next_pos = cache_chunk.start + cache_chunk.target_len
+                continue
+            next_start, next_size = self.client.media_chunk_manager.get_chunk_span(next_pos, file_size)
+            next_holder = self.client.media_chunk_manager.create_media_chunk_holder(msg, next_start, next_size)
+            entry = PrefetchEntry(next_holder, stream_id)
+            next_holder.add_chunk_requester(entry.requester)
+            self.client.media_chunk_manager.set_media_chunk(next_holder)
+            state.prefetched[next_holder.start] = entry
+            self.client.post_prefetch_task(msg, entry)
+            logger.info(f"post {entry}")
+            next_pos = next_holder.start + next_holder.target_len
+
+    def cancel_stream(self, msg: types.Message, stream_id: int) -> None:
+        state = self.file_states.get((msg.chat_id, msg.id))
+        if state is None:
+            return
+        # the cursor stays, a player reopening the stream where it stopped continues it
+        self._cancel_entries(state, [entry for entry in state.prefetched.values() if entry.stream_id == stream_id])
+
+    def _probe_index(self, msg: types.Message, holder: Union[MediaChunkHolder, ChunkInfo]) -> None:
+        # first request of a video at its head: fetch the container index along with it
+        state = self._get_file_state(msg)
+        if state.probed:
+            return
+        state.probed = True
+        document = msg.media.document
+        if holder.start != 0 or document.size <= holder.target_len:
+            return
+        if document.mime_type not in MP4_MIME_TYPES and document.mime_type not in MKV_MIME_TYPES:
+            return
+        state.index_stream_id = self.client._get_unique_task_id()
+        supports_streaming = any(
+            isinstance(attr, types.DocumentAttributeVideo) and attr.supports_streaming for attr in document.attributes
+        )
+        if document.mime_type in MKV_MIME_TYPES or not supports_streaming:
+            # the index is most likely at the end, start on the tail before the head tells
+            self._post_index_chunks(msg, state, document.size - 1, document.size - 1)
+        state.probe_task = self.client.client.loop.create_task(self._probe_container(msg, state, holder))
+
+    async def _read_head(self, holder: Union[MediaChunkHolder, ChunkInfo]) -> bytes:
+        size = min(self.PROBE_SIZE, holder.target_len)
+        if isinstance(holder, ChunkInfo):
+            return self.client.media_chunk_manager.read_media_chunk(holder, 0, size) or b""
+        while holder.length < size:
+            await holder.wait_chunk_update()
+        return bytes(holder.mem[:size])
+
+    async def _probe_container(self, msg: types.Message, state: FileAccessState, holder: Union[MediaChunkHolder, ChunkInfo]) -> None:
+        try:
+            head = await asyncio.wait_for(self._read_head(holder), self.PROBE_TIMEOUT)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            logger.info(f"skip container probe:{msg.chat_id=},{msg.id=},{err=}")
+            return
+        finally:
+            state.probe_task = None
+        index_range = probe_index_range(head, msg.media.document.size)
+        logger.info(f"container index:{msg.chat_id=},{msg.id=},{index_range=}")
+        if index_range is None or self.file_states.get((msg.chat_id, msg.id)) is not state:
+            return
+        index_start, index_end = index_range
+        self._cancel_entries(
+            state,
+            [
+                entry
+                for entry in state.index_prefetched.values()
+                if entry.holder.start > index_end or entry.holder.start + entry.holder.target_len <= index_start
+            ],
+        )
+        self._post_index_chunks(msg, state, index_start, index_end)
+
+    def _post_index_chunks(self, msg: types.Message, state: FileAccessState, start: int, end: int) -> None:
+        mgr = self.client.media_chunk_manager
+        file_size = msg.media.document.size
+        chunk_starts = list(range(mgr.get_chunk_span(start, file_size)[0], end + 1, mgr.chunk_size))
+        if len(chunk_starts) > self.MAX_INDEX_CHUNKS:
+            chunk_starts = [chunk_starts[0], chunk_starts[-1]]
+        for chunk_start in chunk_starts:
+            span = mgr.get_chunk_span(chunk_start, file_size)
+            chunk = mgr.get_media_chunk(msg, chunk_start, lru=False)
+            # a kept prefix shorter than the span is resumed by the new holder
+            if chunk is not None and (not chunk.is_completed() or chunk.target_len >= span[1]):
+                continue
+            holder = mgr.create_media_chunk_holder(msg, *span)
+            entry = PrefetchEntry(holder, state.index_stream_id)
+            holder.add_chunk_requester(entry.requester)
+            mgr.set_media_chunk(holder)
+            state.index_prefetched[holder.start] = entry
+            self.client.post_prefetch_task(msg, entry)
+            logger.info(f"post index {entry}")
+
+    def _cancel_entries(self, state: FileAccessState, entries: list[PrefetchEntry]) -> None:
+        for entry in entries:
+            entry.cancelled = True
+            self._pop_entry(state, entry)
+            logger.info(f"cancel {entry}")
+            self.client.release_chunk_requester(entry.holder, entry.requester)
+
+    def done_entry(self, msg: types.Message, entry: PrefetchEntry) -> None:
+        state = self.file_states.get((msg.chat_id, msg.id))
+        if state is not None:
+            self._pop_entry(state, entry)
+
+    def _pop_entry(self, state: FileAccessState, entry: PrefetchEntry) -> None:
+        for prefetched in (state.prefetched, state.index_prefetched):
+            if prefetched.get(entry.holder.start) is entry:
+                prefetched.pop(entry.holder.start)
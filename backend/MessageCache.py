@@ -0,0 +1,53 @@
+import time
+import collections
+
+from telethon import types
+
+
+class MessageCache(object):
+    # (chat_id, msg_id) -> (expire_ts, msg)
+    cache: collections.OrderedDict[tuple[int, int], tuple[float, types.Message]]
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, chat_id: int, msg_id: int) -> types.Message | None:
+        key = (chat_id, msg_id)
+        item = self.cache.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                self.cache.pop(key)
+            self.misses += 1
+            return None
+        self.cache.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, chat_id: int, msg_id: int, msg: types.Message) -> None:
+        if self.max_size <= 0:
+            return
+        self.cache[(chat_id, msg_id)] = (time.monotonic() + self.ttl, msg)
+        self.cache.move_to_end((chat_id, msg_id))
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+    def invalidate(self, chat_id: int | None, msg_id: int) -> None:
+        if chat_id is not None:
+            self.cache.pop((chat_id, msg_id), None)
+            return
+        # deletes outside channels do not name the chat
+        for key in [key for key in self.cache if key[1] == msg_id]:
+            self.cache.pop(key)
+
+    def get_status(self) -> dict[str, any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups > 0 else 0.0,
+        }
@@ -0,0 +1,95 @@
+import logging
+
+logger = logging.getLogger(__file__.split("/")[-1])
+
+
+class DcThroughput(object):
+    def __init__(self) -> None:
+        self.requests = 0
+        self.bytes = 0
+        self.rate = 0.0
+        # request size -> bytes per second
+        self.size_rate: dict[int, float] = {}
+
+    def best_size(self) -> int:
+        if not self.size_rate:
+            return 0
+        return max(self.size_rate.items(), key=lambda item: item[1])[0]
+
+
+class NetChunkSizer(object):
+    """Per DC getFile request sizing, grows the request while the measured throughput keeps rising."""
+
+    # power of two sizes, an offset aligned to the size never crosses a 1MB boundary
+    MIN_NET_CHUNK_SIZE = 64 * 1024
+    MAX_NET_CHUNK_SIZE = 512 * 1024  # telethon caps upload.getFile at 512kb
+    SAMPLE_REQUESTS = 2  # requests measured before deciding to grow
+    GROWTH_GAIN = 0.1  # a larger request has to be at least 10% faster
+    RATE_ALPHA = 0.3
+    # dc_id -> DcThroughput
+    dc_stats: dict[int, DcThroughput]
+
+    def __init__(self) -> None:
+        self.dc_stats = {}
+
+    def _get_dc_stats(self, dc_id: int) -> DcThroughput:
+        stats = self.dc_stats.get(dc_id)
+        if stats is None:
+            stats = DcThroughput()
+            self.dc_stats[dc_id] = stats
+        return stats
+
+    @classmethod
+    def align_size(cls, size: int, offset: int) -> int:
+        # largest size not above the given one whose multiple the offset is
+        while size > cls.MIN_NET_CHUNK_SIZE and offset % size != 0:
+            size //= 2
+        return size
+
+    def initial_size(self, dc_id: int, offset: int) -> int:
+        # small first request for time to first byte, skip most of the ramp once the dc is known
+        size = max(self.MIN_NET_CHUNK_SIZE, self._get_dc_stats(dc_id).best_size() // 2)
+        return self.align_size(size, offset)
+
+    def can_grow(self, size: int) -> bool:
+        return size < self.MAX_NET_CHUNK_SIZE
+
+    def sample_requests(self, size: int, offset: int) -> int:
+        # end the sample on an offset the next larger size can start at
+        requests = self.SAMPLE_REQUESTS
+        if (offset + requests * size) % (size * 2) != 0:
+            requests += 1
+        return requests
+
+    def next_size(self, dc_id: int, size: int, offset: int) -> int:
+        if not self.can_grow(size) or offset % (size * 2) != 0:
+            return size
+        size_rate = self._get_dc_stats(dc_id).size_rate
+        rate = size_rate.get(size, 0.0)
+        smaller_rate = size_rate.get(size // 2)
+        if smaller_rate is not None and rate < smaller_rate * (1 + self.GROWTH_GAIN):
+            return size
+        return size * 2
+
+    def on_requests_done(self, dc_id: int, size: int, requests: int, total: int, cost: float) -> None:
+        if requests <= 0 or cost <= 0:
+            return
+        stats = self._get_dc_stats(dc_id)
+        rate = total / cost
+        stats.requests += requests
+        stats.bytes += total
+        stats.rate = rate if stats.rate <= 0 else stats.rate * (1 - self.RATE_ALPHA) + rate * self.RATE_ALPHA
+        old_rate = stats.size_rate.get(size)
+        stats.size_rate[size] = rate if old_rate is None else old_rate * (1 - self.RATE_ALPHA) + rate * self.RATE_ALPHA
+
+    def get_status(self) -> dict[int, dict[str, any]]:
+        return {
+            dc_id: {
+                "requests": stats.requests,
+                "bytes": stats.bytes,
+                "rate": round(stats.rate),
+                "best_size": stats.best_size(),
+                "size_rate": {size: round(rate) for size, rate in sorted(stats.size_rate.items())},
+            }
+            for dc_id, stats in self.dc_stats.items()
+        }
@@ -0,0 +1,150 @@
+import math
+import time
+import asyncio
+import logging
+from enum import IntEnum, unique
+from typing import Optional
+
+from telethon import errors
+
+logger = logging.getLogger(__file__.split("/")[-1])
+
+
+@unique
+class EnumRequestClass(IntEnum):
+    HISTORY = 0  # messages.getHistory pages of a chat backfill or search
+    FILE = 1  # upload.getFile
+    MESSAGES = 2  # getMessages by id and the other metadata lookups
+
+
+class TokenBucket(object):
+    # a flood wait halves the rate, every quiet RECOVER_INTERVAL doubles it back toward the base
+    RECOVER_INTERVAL = 60
+    MIN_RATE = 0.05
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last_ts = time.monotonic()
+        self.blocked_until = 0.0
+        self.last_flood_ts = 0.0
+        self.waiting = 0
+        self.acquired = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.floods = 0
+
+    def _refill(self, now: float) -> None:
+        if self.rate < self.base_rate and now - self.last_flood_ts >= self.RECOVER_INTERVAL:
+            self.rate = min(self.base_rate, self.rate * 2)
+            self.last_flood_ts = now
+        if math.isinf(self.rate):
+            self.tokens = float(self.burst)
+        else:
+            self.tokens = min(float(self.burst), self.tokens + (now - self.last_ts) * self.rate)
+        self.last_ts = now
+
+    def _reserve(self, now: float) -> float:
+        # take the next token at the time it will be there, slots go out in call order so nobody is overtaken
+        ready = max(now, self.last_ts, self.blocked_until)
+        self._refill(ready)
+        if self.tokens < 1:
+            ready += (1 - self.tokens) / self.rate
+            self._refill(ready)
+        self.tokens -= 1
+        return ready
+
+    async def acquire(self, max_wait: Optional[float] = None) -> float:
+        # seconds spent waiting for the token, waits are slept without holding anything
+        begin = time.monotonic()
+        self.waiting += 1
+        try:
+            while True:
+                now = time.monotonic()
+                if max_wait is not None and self.blocked_until - now > max_wait:
+                    raise errors.FloodWaitError(None, capture=math.ceil(self.blocked_until - now))
+                floods = self.floods
+                ready = self._reserve(now)
+                if ready <= now:
+                    break
+                try:
+                    await asyncio.sleep(ready - now)
+                except asyncio.CancelledError:
+                    if floods == self.floods:
+                        self.tokens = min(float(self.burst), self.tokens + 1)
+                    raise
+                # a flood wait voids the slots handed out before it, queue again behind the block
+                if floods == self.floods:
+                    break
+        finally:
+            self.waiting -= 1
+        wait = time.monotonic() - begin
+        self.acquired += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        return wait
+
+    def on_flood_wait(self, seconds: float) -> None:
+        now = time.monotonic()
+        self.floods += 1
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.rate = max(self.MIN_RATE, (self.burst if math.isinf(self.rate) else self.rate) / 2)
+        self.tokens = 0.0
+        self.last_ts = now
+        self.last_flood_ts = now + seconds
+
+    def get_status(self) -> dict[str, any]:
+        now = time.monotonic()
+        return {
+            "rate": None if math.isinf(self.rate) else round(self.rate, 2),
+            "base_rate": None if math.isinf(self.base_rate) else round(self.base_rate, 2),
+            "waiting": self.waiting,
+            "acquired": self.acquired,
+            "avg_wait": round(self.total_wait / self.acquired, 3) if self.acquired > 0 else 0.0,
+            "max_wait": round(self.max_wait, 3),
+            "floods": self.floods,
+            "blocked": round(max(0.0, self.blocked_until - now), 1),
+        }
+
+
+class RequestRateLimiter(object):
+    """Per client token buckets, one per request class, paced by the client interval."""
+
+    # request class -> (requests per interval, burst)
+    CLASS_LIMITS = {
+        EnumRequestClass.HISTORY: (1, 1),
+        EnumRequestClass.FILE: (20, 20),
+        EnumRequestClass.MESSAGES: (1, 5),
+    }
+    # longer flood waits fail an interactive request instead of holding it
+    MAX_INTERACTIVE_WAIT = 60
+    buckets: dict[EnumRequestClass, TokenBucket]
+
+    def __init__(self, interval: float) -> None:
+        self.buckets = {}
+        for request_class, (requests, burst) in self.CLASS_LIMITS.items():
+            rate = requests / interval if interval > 0 else math.inf
+            self.buckets[request_class] = TokenBucket(rate, burst)
+
+    async def acquire(self, request_class: EnumRequestClass, max_wait: Optional[float] = None) -> float:
+        return await self.buckets[request_class].acquire(max_wait)
+
+    def on_flood_wait(self, request_class: EnumRequestClass, err: errors.FloodWaitError) -> None:
+        logger.warning(f"flood wait {request_class.name.lower()}:{err.seconds}s")
+        self.buckets[request_class].on_flood_wait(err.seconds)
+
+    async def call(self, request_class: EnumRequestClass, func, *args, **kwargs) -> any:
+        # one rpc behind a token, a short flood wait is waited out and the call made again, a long one fails it
+        while True:
+            await self.acquire(request_class, self.MAX_INTERACTIVE_WAIT)
+            try:
+                return await func(*args, **kwargs)
+            except errors.FloodWaitError as err:
+                self.on_flood_wait(request_class, err)
+                if err.seconds > self.MAX_INTERACTIVE_WAIT:
+                    raise
+
+    def get_status(self) -> dict[str, dict[str, any]]:
+        return {request_class.name.lower(): bucket.get_status() for request_class, bucket in self.buckets.items()}
@@ -0,0 +1,61 @@
+import asyncio
+import logging
+from typing import Callable, Optional
+
+from fastapi import Request
+
+logger = logging.getLogger(__file__.split("/")[-1])
+
+
+class StreamRequester(object):
+    """A streaming http request, its disconnect is delivered once by a receive watcher instead of polled."""
+
+    callbacks: list[Callable[[], None]]
+    watch_task: Optional[asyncio.Task]
+
+    def __init__(self, req: Request) -> None:
+        self.req = req
+        self.disconnected = False
+        self.callbacks = []
+        self.watch_task = None
+
+    def __repr__(self) -> str:
+        return f"stream requester:{id(self)},disconnected:{self.disconnected}"
+
+    def watch(self, loop: asyncio.AbstractEventLoop) -> None:
+        if self.watch_task is None and not self.disconnected:
+            self.watch_task = loop.create_task(self._watch_routine())
+
+    def close(self) -> None:
+        if self.watch_task is not None and not self.watch_task.done():
+            self.watch_task.cancel()
+
+    def on_disconnect(self, callback: Callable[[], None]) -> None:
+        if self.disconnected:
+            callback()
+            return
+        self.callbacks.append(callback)
+
+    def set_disconnected(self) -> None:
+        if self.disconnected:
+            return
+        self.disconnected = True
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as err:
+                logger.warning(f"disconnect callback:{err=}")
+
+    async def _watch_routine(self) -> None:
+        try:
+            # a media GET has no body, the server answers receive with the disconnect once the client is gone
+            while True:
+                message = await self.req.receive()
+                if message.get("type") == "http.disconnect":
+                    break
+        except asyncio.CancelledError:
+            return
+        except Exception as err:
+            logger.warning(f"watch disconnect:{err=}")
+        self.set_disconnected()
@@ -0,0 +1,231 @@
+import asyncio
+import functools
+import logging
+import traceback
+import collections
+from enum import IntEnum, unique
+from typing import Callable, Coroutine, Optional
+
+logger = logging.getLogger(__file__.split("/")[-1])
+
+
+@unique
+class EnumTaskPriority(IntEnum):
+    INTERACTIVE = 0
+    PREFETCH = 1
+    BACKGROUND = 2
+
+
+class ScheduledTask(object):
+    def __init__(
+        self,
+        scheduler: "TaskScheduler",
+        task_id: int,
+        priority: EnumTaskPriority,
+        stream_id: int,
+        factory: Callable[[], Coroutine],
+        on_cancel: Optional[Callable[[], None]] = None,
+    ) -> None:
+        # holders are shared by the accounts, so a task is changed through the scheduler that runs it
+        self.scheduler = scheduler
+        self.task_id = task_id
+        self.priority = priority
+        self.stream_id = stream_id
+        # a new coroutine for every run, a preempted task is started again from scratch
+        self.factory = factory
+        self.on_cancel = on_cancel
+        self.task: Optional[asyncio.Task] = None
+        self.preempted = False
+        self.started = False
+        self.cancelled = False
+        self.finished = False
+
+    def __repr__(self) -> str:
+        return f"task:{self.task_id},{self.priority.name},stream:{self.stream_id},running:{self.task is not None},cancelled:{self.cancelled}"
+
+
+class TaskScheduler(object):
+    """Priority task runner, background work is held to max_background workers while a viewer is active."""
+
+    loop: asyncio.AbstractEventLoop
+    # priority -> stream_id -> queued tasks of the stream
+    queues: list[collections.OrderedDict[int, collections.deque[ScheduledTask]]]
+    # task_id -> running task
+    running: dict[int, ScheduledTask]
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, max_workers: int, background_share: float) -> None:
+        self.loop = loop
+        self.max_workers = max(1, max_workers)
+        self.max_background = max(1, min(self.max_workers, int(self.max_workers * background_share)))
+        self.queues = [collections.OrderedDict() for _ in EnumTaskPriority]
+        self.queued_count = [0 for _ in EnumTaskPriority]
+        self.running = {}
+        self.running_count = [0 for _ in EnumTaskPriority]
+        self.task_id = 0
+        self.closed = False
+
+    def submit(
+        self,
+        factory: Callable[[], Coroutine],
+        priority: EnumTaskPriority,
+        stream_id: Optional[int] = None,
+        on_cancel: Optional[Callable[[], None]] = None,
+    ) -> ScheduledTask:
+        self.task_id += 1
+        task = ScheduledTask(self, self.task_id, priority, stream_id if stream_id is not None else -self.task_id, factory, on_cancel)
+        if self.closed:
+            logger.warning(f"scheduler closed, drop {task}")
+            return task
+        self._enqueue(task)
+        self._dispatch()
+        return task
+
+    def cancel(self, task: Optional[ScheduledTask]) -> None:
+        # O(1): a queued task is skipped when it reaches the head of its stream, a running one is cancelled
+        if task is None or task.cancelled or task.finished:
+            return
+        task.cancelled = True
+        if task.task is not None:
+            task.task.cancel()
+            return
+        self.queued_count[task.priority] -= 1
+        task.factory = None
+        self._call_on_cancel(task)
+
+    def raise_priority(self, task: Optional[ScheduledTask], priority: EnumTaskPriority, stream_id: int) -> None:
+        # someone of a higher class waits on the task now, it must not queue behind or be preempted by the lower class
+        if task is None or task.cancelled or task.finished or task.priority <= priority:
+            return
+        logger.info(f"raise {task} to {priority.name}")
+        if task.task is None:
+            queues = self.queues[task.priority]
+            queues[task.stream_id].remove(task)
+            if len(queues[task.stream_id]) == 0:
+                queues.pop(task.stream_id)
+            self.queued_count[task.priority] -= 1
+            task.priority = priority
+            task.stream_id = stream_id
+            self._enqueue(task)
+            self._dispatch()
+            return
+        self.running_count[task.priority] -= 1
+        self.running_count[priority] += 1
+        task.priority = priority
+        task.stream_id = stream_id
+
+    def close(self) -> None:
+        self.closed = True
+        for priority in EnumTaskPriority:
+            for stream_queue in self.queues[priority].values():
+                for task in stream_queue:
+                    if not task.cancelled:
+                        task.cancelled = True
+                        self._call_on_cancel(task)
+            self.queues[priority].clear()
+            self.queued_count[priority] = 0
+        for task in list(self.running.values()):
+            task.task.cancel()
+
+    def get_status(self) -> dict[str, any]:
+        return {
+            priority.name.lower(): {"queued": self.queued_count[priority], "running": self.running_count[priority]}
+            for priority in EnumTaskPriority
+        }
+
+    def _call_on_cancel(self, task: ScheduledTask) -> None:
+        if task.on_cancel is None:
+            return
+        try:
+            task.on_cancel()
+        except Exception as err:
+            logger.warning(f"on cancel {task}, {err=},{traceback.format_exc()}")
+
+    def _enqueue(self, task: ScheduledTask, front: bool = False) -> None:
+        stream_queue = self.queues[task.priority].setdefault(task.stream_id, collections.deque())
+        if front:
+            stream_queue.appendleft(task)
+        else:
+            stream_queue.append(task)
+        self.queued_count[task.priority] += 1
+
+    def _viewer_active(self) -> bool:
+        return any(
+            self.queued_count[priority] + self.running_count[priority] > 0
+            for priority in (EnumTaskPriority.INTERACTIVE, EnumTaskPriority.PREFETCH)
+        )
+
+    def _pop_next(self) -> Optional[ScheduledTask]:
+        for priority in EnumTaskPriority:
+            if self.queued_count[priority] == 0:
+                continue
+            if (
+                priority == EnumTaskPriority.BACKGROUND
+                and self._viewer_active()
+                and self.running_count[priority] >= self.max_background
+            ):
+                return None
+            # round robin over streams: take the head of the first stream, then send the stream to the back
+            queues = self.queues[priority]
+            while True:
+                stream_id, stream_queue = next(iter(queues.items()))
+                task = stream_queue.popleft()
+                if len(stream_queue) == 0:
+                    queues.pop(stream_id)
+                else:
+                    queues.move_to_end(stream_id)
+                if task.cancelled:
+                    continue
+                self.queued_count[priority] -= 1
+                return task
+        return None
+
+    def _preempt_background(self) -> None:
+        waiting = self.queued_count[EnumTaskPriority.INTERACTIVE] + self.queued_count[EnumTaskPriority.PREFETCH]
+        background = [task for task in self.running.values() if task.priority == EnumTaskPriority.BACKGROUND and not task.preempted]
+        excess = len(background) - self.max_background
+        if waiting == 0 or excess <= 0:
+            return
+        for task in sorted(background, key=lambda t: t.task_id, reverse=True)[: min(waiting, excess)]:
+            logger.info(f"preempt {task}")
+            task.preempted = True
+            task.task.cancel()
+
+    def _dispatch(self) -> None:
+        while not self.closed and len(self.running) < self.max_workers:
+            task = self._pop_next()
+            if task is None:
+                break
+            self.running[task.task_id] = task
+            self.running_count[task.priority] += 1
+            task.started = False
+            task.task = self.loop.create_task(self._run(task))
+            # bookkeeping in a callback, a task cancelled before its first step never enters _run
+            task.task.add_done_callback(functools.partial(self._on_task_done, task))
+        if len(self.running) >= self.max_workers:
+            self._preempt_background()
+
+    async def _run(self, task: ScheduledTask) -> None:
+        task.started = True
+        try:
+            await task.factory()
+        except asyncio.CancelledError:
+            if not task.preempted or task.cancelled:
+                logger.info(f"cancelled {task}")
+        except Exception as err:
+            logger.error(f"{err=}")
+            logger.error(traceback.format_exc())
+
+    def _on_task_done(self, task: ScheduledTask, _: asyncio.Task) -> None:
+        self.running.pop(task.task_id, None)
+        self.running_count[task.priority] -= 1
+        task.task = None
+        if task.preempted and not task.cancelled and not self.closed:
+            task.preempted = False
+            self._enqueue(task, front=True)
+        else:
+            if not task.started:
+                task.cancelled = True
+                self._call_on_cancel(task)
+            task.finished = True
+            task.factory = None
+        self._dispatch()
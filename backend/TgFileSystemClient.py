@@ -8,7 +8,7 @@ import traceback
 import logging
 from typing import Union, Optional, Literal, Callable
 
-from telethon import TelegramClient, types, hints, events
+from telethon import TelegramClient, types, hints, events, errors
 from telethon.custom import QRLogin
 from fastapi import Request
 
@@ -16,26 +16,45 @@ import configParse
 from backend import apiutils
 from backend.UserManager import UserManager
 from backend.MediaCacheManager import MediaChunkHolder, MediaChunkHolderManager
+from backend.MediaPrefetcher import MediaPrefetcher, PrefetchEntry
+from backend.MessageCache import MessageCache
+from backend.TaskScheduler import TaskScheduler, EnumTaskPriority
+from backend.NetChunkSizer import NetChunkSizer
+from backend.MediaPinner import MediaPinner
+from backend.DownloadStriper import DownloadStriper
+from backend.RequestRateLimiter import RequestRateLimiter, EnumRequestClass
+from backend.DownloadHedger import DownloadHedger
+from backend.StreamRequester import StreamRequester
 
 logger = logging.getLogger(__file__.split("/")[-1])
 
 
 class TgFileSystemClient(object):
     MAX_WORKER_ROUTINE = 8
+    MAX_DOWNLOAD_RETRY = 5
+    DOWNLOAD_RETRY_BACKOFF = 0.5  # seconds, doubled on every retry
+    MAX_DOWNLOAD_RETRY_BACKOFF = 8
     SINGLE_NET_CHUNK_SIZE = 256 * 1024  # 256kb
-    SINGLE_MEDIA_SIZE = 5 * 1024 * 1024  # 5mb
+    MAX_DISK_READ_SIZE = 1024 * 1024  # 1mb, bound memory of a stream served from disk
+    HISTORY_PAGE_SIZE = 100  # messages per getHistory request of iter_messages
+    HEDGE_POLL_DIVISOR = 4  # stall checks per hedge threshold
     api_id: int
     api_hash: str
     session_name: str
     proxy_param: dict[str, any]
     client: TelegramClient
     media_chunk_manager: MediaChunkHolderManager
+    prefetcher: MediaPrefetcher
+    msg_cache: MessageCache
+    net_sizer: NetChunkSizer
+    pinner: MediaPinner
+    striper: DownloadStriper
+    limiter: RequestRateLimiter
+    hedger: DownloadHedger
     dialogs_cache: Optional[hints.TotalList] = None
-    worker_routines: list[asyncio.Task]
     qr_login: QRLogin | None = None
     login_task: asyncio.Task | None = None
-    # task should: (task_id, callabledFunc)
-    task_queue: asyncio.Queue
+    scheduler: TaskScheduler
     task_id: int = 0
     me: Union[types.User, types.InputPeerUser] = None
     # client config
@@ -47,6 +66,7 @@ class TgFileSystemClient(object):
         param: configParse.TgToFileSystemParameter,
         db: UserManager,
         chunk_manager: MediaChunkHolderManager,
+        striper: Optional[DownloadStriper] = None,
     ) -> None:
         self.api_id = param.tgApi.api_id
         self.api_hash = param.tgApi.api_hash
@@ -64,16 +84,25 @@ class TgFileSystemClient(object):
             (client_param for client_param in param.clients if client_param.name == session_name),
             configParse.TgToFileSystemParameter.ClientConfigPatameter(name="__tmp__"),
         )
-        self.task_queue = asyncio.Queue()
         self.client = TelegramClient(
             f"{os.path.dirname(__file__)}/db/{self.session_name}.session",
             self.api_id,
             self.api_hash,
             proxy=self.proxy_param,
+            # every flood wait reaches the rate limiter instead of being slept away inside telethon
+            flood_sleep_threshold=0,
         )
         self.media_chunk_manager = chunk_manager
+        self.prefetcher = MediaPrefetcher(self, self.client_param.prefetch_window, self.client_param.index_prefetch)
+        self.msg_cache = MessageCache(param.cache.msg_cache_size, param.cache.msg_cache_ttl)
+        self.net_sizer = NetChunkSizer()
+        self.pinner = MediaPinner(self)
+        # shared by the accounts of a manager, a lone client only ever picks itself
+        self.striper = striper if striper is not None else DownloadStriper()
+        self.limiter = RequestRateLimiter(self.client_param.interval)
+        self.hedger = DownloadHedger()
         self.db = db
-        self.worker_routines = []
+        self.scheduler = TaskScheduler(self.client.loop, self.MAX_WORKER_ROUTINE, self.client_param.background_share)
 
     def __del__(self) -> None:
         if self.client.loop.is_running():
@@ -122,6 +151,20 @@ class TgFileSystemClient(object):
             msg: types.Message = event.message
             self.db.insert_by_message(self.me, msg)
 
+    @_check_before_call
+    def _register_msg_cache_event(self) -> None:
+        @self.client.on(events.MessageEdited())
+        async def _message_edited_handler(event) -> None:
+            msg: types.Message = event.message
+            self.msg_cache.invalidate(msg.chat_id, msg.id)
+            if msg.chat_id in self.client_param.whitelist_chat:
+                self.db.update_msg_js_by_message(self.me, msg)
+
+        @self.client.on(events.MessageDeleted())
+        async def _message_deleted_handler(event) -> None:
+            for msg_id in event.deleted_ids:
+                self.msg_cache.invalidate(event.chat_id, msg_id)
+
     async def login(self, mode: Literal["phone", "qrcode"] = "qrcode") -> str:
         if self.is_valid():
             return ""
@@ -149,33 +192,46 @@ class TgFileSystemClient(object):
             return
         if not self.client.is_connected():
             await self.client.connect()
-        self.me = await self.client.get_me()
+        self.me = await self.limiter.call(EnumRequestClass.MESSAGES, self.client.get_me)
         if self.me is None:
             raise RuntimeError(f"The {self.session_name} Client Does Not Login")
-        for _ in range(self.MAX_WORKER_ROUTINE):
-            worker_routine = self.client.loop.create_task(self._worker_routine_handler())
-            self.worker_routines.append(worker_routine)
+        self._register_msg_cache_event()
         if len(self.client_param.whitelist_chat) > 0:
             self._register_update_event(from_users=self.client_param.whitelist_chat)
-            await self.task_queue.put((self._get_unique_task_id(), self._cache_whitelist_chat()))
+            self._cache_whitelist_chat()
 
     async def stop(self) -> None:
-        await self.client.loop.create_task(self._cancel_tasks())
-        while not self.task_queue.empty():
-            self.task_queue.get_nowait()
-            self.task_queue.task_done()
+        self.scheduler.close()
         await self.client.disconnect()
 
-    async def _cancel_tasks(self) -> None:
-        for t in self.worker_routines:
+    async def _iter_history(self, chat_id: int, offset_id: int = 0, max_wait: Optional[float] = None):
+        # iter_messages behind the history bucket, a flood wait is waited out and the walk resumed where it stopped,
+        # one longer than max_wait fails the walk for an interactive caller
+        while True:
+            await self.limiter.acquire(EnumRequestClass.HISTORY, max_wait)
+            pacing = False
             try:
-                t.cancel()
-            except Exception as err:
-                logger.error(f"{err=}")
-                logger.error(traceback.format_exc())
+                count = 0
+                async for msg in self.client.iter_messages(chat_id, offset_id=offset_id):
+                    yield msg
+                    offset_id = msg.id
+                    count += 1
+                    if count % self.HISTORY_PAGE_SIZE == 0:
+                        # the next message comes from a new page
+                        pacing = True
+                        await self.limiter.acquire(EnumRequestClass.HISTORY, max_wait)
+                        pacing = False
+                return
+            except errors.FloodWaitError as err:
+                if pacing:
+                    # the bucket failed the wait, the flood behind it is counted already
+                    raise
+                self.limiter.on_flood_wait(EnumRequestClass.HISTORY, err)
+                if max_wait is not None and err.seconds > max_wait:
+                    raise
 
     async def _cache_whitelist_chat_full_policy(self, chat_id: int, callback: Callable = None):
-        async for msg in self.client.iter_messages(chat_id):
+        async for msg in self._iter_history(chat_id):
             if len(self.db.get_msg_by_unique_id(UserManager.generate_unique_id_by_msg(self.me, msg))) != 0:
                 continue
             self.db.insert_by_message(self.me, msg)
@@ -188,7 +244,7 @@ class TgFileSystemClient(object):
         newest_msg = self.db.get_newest_msg_by_chat_id(chat_id)
         if len(newest_msg) > 0:
             newest_msg = newest_msg[0]
-            async for msg in self.client.iter_messages(chat_id):
+            async for msg in self._iter_history(chat_id):
                 if msg.id <= self.db.get_column_msg_id(newest_msg):
                     break
                 self.db.insert_by_message(self.me, msg)
@@ -197,58 +253,69 @@ class TgFileSystemClient(object):
         if len(oldest_msg) > 0:
             oldest_msg = oldest_msg[0]
             offset = self.db.get_column_msg_id(oldest_msg)
-            async for msg in self.client.iter_messages(chat_id, offset_id=offset):
+            async for msg in self._iter_history(chat_id, offset_id=offset):
                 self.db.insert_by_message(self.me, msg)
         else:
-            async for msg in self.client.iter_messages(chat_id):
+            async for msg in self._iter_history(chat_id):
                 self.db.insert_by_message(self.me, msg)
         if callback is not None:
             callback()
         logger.info(f"{chat_id} quit cache task.")
 
-    async def _cache_whitelist_chat(self):
-        max_cache_tasks_num = TgFileSystemClient.MAX_WORKER_ROUTINE // 2
-        tasks_sem = asyncio.Semaphore(value=max_cache_tasks_num)
-
-        def _sem_release_callback():
-            tasks_sem.release()
-
+    def _cache_whitelist_chat(self):
+        # the lazy policy resumes from the db, so a preempted chat just starts over
         for chat_id in self.client_param.whitelist_chat:
-            await tasks_sem.acquire()
-            await self.task_queue.put(
-                (self._get_unique_task_id(), self._cache_whitelist_chat_lazy_policy(chat_id, callback=_sem_release_callback))
+            self.scheduler.submit(
+                functools.partial(self._cache_whitelist_chat_lazy_policy, chat_id), EnumTaskPriority.BACKGROUND, stream_id=chat_id
             )
 
     @_acheck_before_call
     async def get_message(self, chat_id: int | str, msg_id: int) -> types.Message:
-        msg = await self.client.get_messages(chat_id, ids=msg_id)
+        msg = await self.limiter.call(EnumRequestClass.MESSAGES, self.client.get_messages, chat_id, ids=msg_id)
+        return msg
+
+    def _get_message_from_db(self, chat_id: int, msg_id: int) -> types.Message | None:
+        if chat_id not in self.client_param.whitelist_chat:
+            return None
+        for row in self.db.get_msg_by_chat_id_and_msg_id(chat_id, msg_id):
+            # access_hash is only valid for the account who saw the message
+            if self.db.get_column_by_enum(row, UserManager.ColumnEnum.USER_ID) != self.me.id:
+                continue
+            try:
+                msg = apiutils.get_message_from_dict(json.loads(self.db.get_column_msg_js(row)))
+            except Exception as err:
+                logger.warning(f"load msg from db:{err=},{chat_id=},{msg_id=}")
+                continue
+            if msg is not None:
+                return msg
+        return None
+
+    @_acheck_before_call
+    async def get_media_message(self, chat_id: int, msg_id: int) -> types.Message:
+        msg = self.msg_cache.get(chat_id, msg_id)
+        if msg is not None:
+            return msg
+        msg = self._get_message_from_db(chat_id, msg_id)
+        if msg is None:
+            msg = await self.limiter.call(EnumRequestClass.MESSAGES, self.client.get_messages, chat_id, ids=msg_id)
+        if msg is not None and msg.media is not None:
+            self.msg_cache.set(chat_id, msg_id, msg)
         return msg
 
     @_acheck_before_call
     async def get_dialogs(self, limit: int = 10, offset: int = 0, refresh: bool = False) -> hints.TotalList:
         if self.dialogs_cache is not None and refresh is False:
             return self.dialogs_cache[offset : offset + limit]
-        self.dialogs_cache = await self.client.get_dialogs()
+        self.dialogs_cache = await self.limiter.call(EnumRequestClass.MESSAGES, self.client.get_dialogs)
         return self.dialogs_cache[offset : offset + limit]
 
-    async def _worker_routine_handler(self) -> None:
-        while self.client.is_connected():
-            try:
-                task = await self.task_queue.get()
-                await task[1]
-            except Exception as err:
-                logger.error(f"{err=}")
-                logger.error(traceback.format_exc())
-            finally:
-                self.task_queue.task_done()
-
     def _get_unique_task_id(self) -> int:
         self.task_id += 1
         return self.task_id
 
     async def _get_offset_msg_id(self, chat_id: int, offset: int) -> int:
         if offset != 0:
-            begin = await self.client.get_messages(chat_id, limit=1)
+            begin = await self.limiter.call(EnumRequestClass.HISTORY, self.client.get_messages, chat_id, limit=1)
             if len(begin) == 0:
                 return hints.TotalList()
             first_id = begin[0].id
@@ -257,12 +324,12 @@ class TgFileSystemClient(object):
 
     @_acheck_before_call
     async def get_entity(self, chat_id_or_name) -> hints.Entity:
-        return await self.client.get_entity(chat_id_or_name)
+        return await self.limiter.call(EnumRequestClass.MESSAGES, self.client.get_entity, chat_id_or_name)
 
     @_acheck_before_call
     async def get_messages(self, chat_id: int, limit: int = 10, offset: int = 0) -> hints.TotalList:
         offset = await self._get_offset_msg_id(chat_id, offset)
-        res_list = await self.client.get_messages(chat_id, limit=limit, offset_id=offset)
+        res_list = await self.limiter.call(EnumRequestClass.HISTORY, self.client.get_messages, chat_id, limit=limit, offset_id=offset)
         return res_list
 
     @_acheck_before_call
@@ -277,12 +344,14 @@ class TgFileSystemClient(object):
     ) -> hints.TotalList:
         offset = await self._get_offset_msg_id(chat_id, offset)
         if inner_search:
-            res_list = await self.client.get_messages(chat_id, limit=limit, offset_id=offset, search=search_word)
+            res_list = await self.limiter.call(
+                EnumRequestClass.HISTORY, self.client.get_messages, chat_id, limit=limit, offset_id=offset, search=search_word
+            )
             return res_list
         # search by myself
         res_list = hints.TotalList()
         cnt = 0
-        async for msg in self.client.iter_messages(chat_id, offset_id=offset):
+        async for msg in self._iter_history(chat_id, offset_id=offset, max_wait=self.limiter.MAX_INTERACTIVE_WAIT):
             if cnt >= 1_000:
                 break
             cnt += 1
@@ -312,91 +381,339 @@ class TgFileSystemClient(object):
         res = [json.dumps(self.db.get_column_msg_js_expanded(v)) for v in res if self.db.get_column_msg_js_expanded(v)]
         return res
 
+    async def _download_media_range(self, msg: types.Message, media_holder: MediaChunkHolder, offset: int, size: int) -> None:
+        # download [offset, offset + size) of the file into holder, in segments whose request size adapts to throughput
+        dc_id = msg.media.document.dc_id
+        remain_size = size
+        request_size = self.net_sizer.initial_size(dc_id, offset)
+        while remain_size > 0:
+            while request_size > NetChunkSizer.MIN_NET_CHUNK_SIZE and request_size > remain_size:
+                request_size //= 2
+            if self.net_sizer.can_grow(request_size):
+                requests = self.net_sizer.sample_requests(request_size, offset)
+            else:
+                requests = (remain_size + request_size - 1) // request_size
+            await self.limiter.acquire(EnumRequestClass.FILE)
+            begin_ts = time.monotonic()
+            request_ts = begin_ts
+            received = 0
+            done = 0
+            # telethon only hands parts through without copying if offset % limit == 0, limit defaults to the
+            # part count of the whole file, so pass one that always divides offset and stop after requests here
+            stream = self.client.iter_download(
+                msg, offset=offset, request_size=request_size, chunk_size=request_size, limit=offset or None
+            )
+            try:
+                async for chunk in stream:
+                    self.hedger.on_chunk_gap(time.monotonic() - request_ts)
+                    chunk = memoryview(chunk)
+                    received += len(chunk)
+                    done += 1
+                    if len(chunk) > remain_size:
+                        chunk = chunk[:remain_size]
+                    media_holder.write_chunk_mem(offset - media_holder.start, chunk)
+                    offset += len(chunk)
+                    remain_size -= len(chunk)
+                    if remain_size <= 0 or media_holder.is_completed() or done >= requests:
+                        break
+                    if media_holder.is_disconneted():
+                        raise asyncio.CancelledError("all requester canceled.")
+                    # iter_download sends the next request when asked for the next chunk
+                    await self.limiter.acquire(EnumRequestClass.FILE)
+                    request_ts = time.monotonic()
+            finally:
+                # hands a sender borrowed for another dc back, iter_download only does it on the last part
+                await stream.close()
+            self.net_sizer.on_requests_done(dc_id, request_size, done, received, time.monotonic() - begin_ts)
+            if media_holder.is_completed() or done < requests or received < done * request_size:
+                # completed, or the file ended before the range did
+                break
+            request_size = self.net_sizer.next_size(dc_id, request_size, offset)
+
+    def _split_media_range(self, offset: int, size: int, parallel: int) -> list[tuple[int, int]]:
+        # split into sub ranges whose bounds are aligned to net chunk
+        align = self.SINGLE_NET_CHUNK_SIZE
+        end = offset + size
+        step = (size + parallel - 1) // parallel
+        step = max(align, (step + align - 1) // align * align)
+        ranges = []
+        sub_start = offset
+        while sub_start < end:
+            sub_end = min((sub_start + step) // align * align, end)
+            if sub_end <= sub_start:
+                sub_end = min(sub_start + step, end)
+            ranges.append((sub_start, sub_end - sub_start))
+            sub_start = sub_end
+        return ranges
+
+    async def _download_media_chunk_parallel(self, msg: types.Message, media_holder: MediaChunkHolder, offset: int, size: int):
+        ranges = self._split_media_range(offset, size, self.client_param.download_parallel)
+        tasks = [
+            self.client.loop.create_task(self._download_media_range(msg, media_holder, sub_offset, sub_size))
+            for sub_offset, sub_size in ranges
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for t in tasks:
+                if not t.done():
+                    t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _refresh_media_message(self, msg: types.Message) -> None:
+        # refresh file_reference in place, so every user of this msg object sees the new one
+        new_msg = await self.limiter.call(EnumRequestClass.MESSAGES, self.client.get_messages, msg.chat_id, ids=msg.id)
+        if new_msg is None or not isinstance(new_msg.media, types.MessageMediaDocument):
+            raise RuntimeError(f"media message gone:{msg.chat_id=},{msg.id=}")
+        if new_msg.media.document.id != msg.media.document.id:
+            raise RuntimeError(f"media message document changed:{msg.chat_id=},{msg.id=}")
+        msg.media.document.file_reference = new_msg.media.document.file_reference
+        self.db.update_msg_js_by_message(self.me, new_msg)
+        logger.info(f"file reference refreshed:{msg.chat_id=},{msg.id=}")
+
+    async def _download_media_chunk_once(self, msg: types.Message, media_holder: MediaChunkHolder) -> None:
+        offset = media_holder.start + media_holder.length
+        target_size = media_holder.target_len - media_holder.length
+        if self.client_param.download_parallel > 1 and target_size > self.SINGLE_NET_CHUNK_SIZE:
+            await self._download_media_chunk_parallel(msg, media_holder, offset, target_size)
+        else:
+            await self._download_media_range(msg, media_holder, offset, target_size)
+        if not media_holder.is_completed():
+            raise RuntimeError(f"download stream ended early:{media_holder}")
+
+    async def _download_media_chunk_hedged(
+        self, account: "TgFileSystemClient", account_msg: types.Message, msg: types.Message, media_holder: MediaChunkHolder
+    ) -> None:
+        # a stalled download gets a second request for the rest of the holder, the first to complete it wins
+        hedger = account.hedger
+        hedger.on_download()
+        primary = self.client.loop.create_task(account._download_media_chunk_once(account_msg, media_holder))
+        attempts = {primary: account}
+        hedge = None
+        last_length = media_holder.length
+        last_progress_ts = time.monotonic()
+        primary_err = None
+        try:
+            while attempts:
+                timeout = hedger.threshold / self.HEDGE_POLL_DIVISOR if hedge is None else None
+                done, _ = await asyncio.wait(attempts, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task_account = attempts.pop(task)
+                    if task.cancelled():
+                        raise asyncio.CancelledError("all requester canceled.")
+                    err = task.exception()
+                    if err is None:
+                        if task is hedge:
+                            hedger.on_hedge_won()
+                            logger.info(f"hedge won on {task_account.session_name}:{media_holder}")
+                        return
+                    if task is primary:
+                        primary_err = err
+                    logger.warning(f"download attempt failed on {task_account.session_name}:{err=},{media_holder}")
+                if done or hedge is not None:
+                    continue
+                now = time.monotonic()
+                if media_holder.length != last_length:
+                    last_length = media_holder.length
+                    last_progress_ts = now
+                    continue
+                if now - last_progress_ts < hedger.threshold:
+                    continue
+                download_task = media_holder.download_task
+                if download_task is not None and download_task.priority == EnumTaskPriority.BACKGROUND:
+                    # nobody waits on a background download, until a viewer joins it and raises it
+                    continue
+                hedge_account, hedge_msg = await self.striper.pick_account(self, msg, exclude=account)
+                hedger.on_hedge()
+                logger.info(f"hedge on {hedge_account.session_name}, no bytes for {now - last_progress_ts:.2f}s:{media_holder}")
+                hedge = self.client.loop.create_task(hedge_account._download_media_chunk_once(hedge_msg, media_holder))
+                attempts[hedge] = hedge_account
+            raise primary_err
+        finally:
+            for task in attempts:
+                task.cancel()
+            if attempts:
+                await asyncio.gather(*attempts, return_exceptions=True)
+
     async def _download_media_chunk(self, msg: types.Message, media_holder: MediaChunkHolder) -> None:
         logger.info(f"start downloading new chunk:{media_holder=}")
+        begin_ts = time.monotonic()
+        retry = 0
         try:
-            offset = media_holder.start + media_holder.length
-            target_size = media_holder.target_len - media_holder.length
-            remain_size = target_size
-            async for chunk in self.client.iter_download(msg, offset=offset, chunk_size=self.SINGLE_NET_CHUNK_SIZE):
-                if not isinstance(chunk, bytes):
-                    chunk = chunk.tobytes()
-                remain_size -= len(chunk)
-                if remain_size <= 0:
-                    media_holder.append_chunk_mem(chunk[: len(chunk) + remain_size])
-                else:
-                    media_holder.append_chunk_mem(chunk)
-                if media_holder.is_completed():
+            while True:
+                account, account_msg = await self.striper.pick_account(self, msg)
+                try:
+                    # resume from the completed prefix on every try
+                    await self._download_media_chunk_hedged(account, account_msg, msg, media_holder)
+                    self.striper.on_account_done(account, media_holder.target_len)
                     break
-                if await media_holder.is_disconneted():
-                    raise asyncio.CancelledError("all requester canceled.")
+                except asyncio.CancelledError:
+                    raise
+                except Exception as err:
+                    retry += 1
+                    if retry > self.MAX_DOWNLOAD_RETRY:
+                        raise
+                    media_holder.discard_pending_mem()
+                    if isinstance(err, (errors.FileReferenceExpiredError, errors.FilerefUpgradeNeededError)):
+                        logger.warning(f"download chunk retry {retry} with new file reference:{err=},{media_holder}")
+                        await account._refresh_media_message(account_msg)
+                        continue
+                    if isinstance(err, errors.FloodWaitError):
+                        account.limiter.on_flood_wait(EnumRequestClass.FILE, err)
+                    if self.striper.on_account_error(account, err, msg.chat_id):
+                        logger.warning(f"download chunk retry {retry} on another account:{err=},{media_holder}")
+                        continue
+                    if isinstance(err, errors.FloodWaitError):
+                        # the file bucket holds the next request until the wait is over
+                        logger.warning(f"download chunk retry {retry} after flood wait:{err=},{media_holder}")
+                        continue
+                    backoff = min(self.DOWNLOAD_RETRY_BACKOFF * 2 ** (retry - 1), self.MAX_DOWNLOAD_RETRY_BACKOFF)
+                    logger.warning(f"download chunk retry {retry} in {backoff}s:{err=},{media_holder}")
+                    await asyncio.sleep(backoff)
+                    if media_holder.is_disconneted():
+                        raise asyncio.CancelledError("all requester canceled.")
         except asyncio.CancelledError as err:
+            if media_holder.download_task is not None and media_holder.download_task.preempted:
+                # queued again by the scheduler, the next run resumes from the completed prefix
+                logger.info(f"preempt holder:{media_holder}")
+                media_holder.discard_pending_mem()
+                raise
             logger.info(f"cancel holder:{media_holder}")
-            self.media_chunk_manager.cancel_media_chunk(media_holder)
+            # the next request for this chunk resumes from the completed prefix
+            self.media_chunk_manager.keep_partial_chunk(media_holder)
         except Exception as err:
-            logger.error(
-                f"_download_media_chunk err:{err=},{offset=},{target_size=},{media_holder},\r\n{err=}\r\n{traceback.format_exc()}"
-            )
+            logger.error(f"_download_media_chunk err:{err=},{media_holder},\r\n{err=}\r\n{traceback.format_exc()}")
+            self.media_chunk_manager.cancel_media_chunk(media_holder)
+            media_holder.set_error(err)
         else:
             if not self.media_chunk_manager.move_media_chunk_to_disk(media_holder):
                 logger.warning(f"move to disk failed, {media_holder=}")
-            logger.debug(f"downloaded chunk:{offset=},{target_size=},{media_holder}")
+            self.prefetcher.on_chunk_downloaded(media_holder.target_len, time.monotonic() - begin_ts)
+            logger.debug(f"downloaded chunk:{media_holder}")
+
+    def post_prefetch_task(self, msg: types.Message, entry: PrefetchEntry) -> None:
+        entry.holder.download_task = self.scheduler.submit(
+            functools.partial(self._prefetch_media_chunk, msg, entry),
+            EnumTaskPriority.PREFETCH,
+            stream_id=entry.stream_id,
+            on_cancel=functools.partial(self._drop_prefetch_task, msg, entry),
+        )
+
+    def _drop_prefetch_task(self, msg: types.Message, entry: PrefetchEntry) -> None:
+        self.media_chunk_manager.keep_partial_chunk(entry.holder)
+        self.prefetcher.done_entry(msg, entry)
+
+    def post_download_task(self, msg: types.Message, holder: MediaChunkHolder, priority: EnumTaskPriority, stream_id: int) -> None:
+        holder.download_task = self.scheduler.submit(
+            functools.partial(self._download_media_chunk, msg, holder),
+            priority,
+            stream_id=stream_id,
+            on_cancel=functools.partial(self.media_chunk_manager.keep_partial_chunk, holder),
+        )
+
+    def release_chunk_requester(self, holder: MediaChunkHolder, req: Request) -> None:
+        # stop the download right away when the last requester leaves, instead of at its next net chunk
+        if holder.remove_chunk_requester(req) and not holder.is_completed():
+            logger.info(f"no requester left, cancel download:{holder}")
+            # a shared chunk may be downloading on another client's scheduler
+            download_task = holder.download_task
+            if download_task is not None:
+                download_task.scheduler.cancel(download_task)
+
+    async def _prefetch_media_chunk(self, msg: types.Message, entry: PrefetchEntry) -> None:
+        try:
+            if entry.holder.is_disconneted():
+                logger.info(f"skip canceled prefetch:{entry}")
+                self.media_chunk_manager.keep_partial_chunk(entry.holder)
+                return
+            await self._download_media_chunk(msg, entry.holder)
+        except asyncio.CancelledError:
+            self.media_chunk_manager.keep_partial_chunk(entry.holder)
         finally:
-            pass
+            self.prefetcher.done_entry(msg, entry)
+
+    def _on_stream_disconnect(
+        self, msg: types.Message, stream_id: int, requester: StreamRequester, joined_holders: dict[str, MediaChunkHolder]
+    ) -> None:
+        for holder in joined_holders.values():
+            self.release_chunk_requester(holder, requester)
+            # wake the stream if it waits on the holder, it sees the disconnect and quits
+            holder.notify_waiters()
+        self.prefetcher.cancel_stream(msg, stream_id)
 
     async def streaming_get_iter(self, msg: types.Message, start: int, end: int, req: Request):
+        logger.debug(f"new steaming request:{msg.chat_id=},{msg.id=},[{start}:{end}]")
+        cur_task_id = self._get_unique_task_id()
+        # incompleted holders this stream waits on, chunk id -> holder
+        joined_holders: dict[str, MediaChunkHolder] = {}
+        requester = StreamRequester(req)
+        requester.on_disconnect(functools.partial(self._on_stream_disconnect, msg, cur_task_id, requester, joined_holders))
+        requester.watch(self.client.loop)
+        pos = start
         try:
-            logger.debug(f"new steaming request:{msg.chat_id=},{msg.id=},[{start}:{end}]")
-            cur_task_id = self._get_unique_task_id()
-            pos = start
-            while not await req.is_disconnected() and pos <= end:
-                cache_chunk = self.media_chunk_manager.get_media_chunk(msg, pos)
+            last_access_start = -1
+            while not requester.disconnected and pos <= end:
+                cache_chunk = self.media_chunk_manager.get_media_chunk(msg, pos, lru=False)
+                if cache_chunk is not None and cache_chunk.start != last_access_start:
+                    last_access_start = cache_chunk.start
+                    self.media_chunk_manager.touch_media_chunk(cache_chunk)
+                    self.prefetcher.on_access(msg, cache_chunk, pos, end, cur_task_id)
                 if cache_chunk is None:
                     # post download task
                     # align pos download task
                     file_size = msg.media.document.size
-                    # align_pos = pos // self.SINGLE_MEDIA_SIZE * self.SINGLE_MEDIA_SIZE
-                    align_pos = pos
-                    align_size = min(self.SINGLE_MEDIA_SIZE, file_size - align_pos)
-                    holder = self.media_chunk_manager.create_media_chunk_holder(msg.chat_id, msg.id, align_pos, align_size)
+                    align_pos, align_size = self.media_chunk_manager.get_chunk_span(pos, file_size)
+                    holder = self.media_chunk_manager.create_media_chunk_holder(msg, align_pos, align_size)
                     logger.info(f"new holder create:{holder}")
-                    holder.add_chunk_requester(req)
+                    holder.add_chunk_requester(requester)
+                    joined_holders[holder.chunk_id] = holder
                     self.media_chunk_manager.set_media_chunk(holder)
-                    self.task_queue.put_nowait((cur_task_id, self._download_media_chunk(msg, holder)))
+                    self.post_download_task(msg, holder, EnumTaskPriority.INTERACTIVE, cur_task_id)
                 elif not cache_chunk.is_completed():
                     # yield return completed part
                     # await untill completed or pos > end
-                    cache_chunk.add_chunk_requester(req)
+                    cache_chunk.add_chunk_requester(requester)
+                    joined_holders[cache_chunk.chunk_id] = cache_chunk
+                    download_task = cache_chunk.download_task
+                    if download_task is not None:
+                        # a pin or prefetch download the viewer now waits on
+                        download_task.scheduler.raise_priority(download_task, EnumTaskPriority.INTERACTIVE, cur_task_id)
                     while pos < cache_chunk.start + cache_chunk.target_len and pos <= end:
-                        if await req.is_disconnected():
+                        if requester.disconnected:
                             break
                         offset = pos - cache_chunk.start
                         if offset >= cache_chunk.length:
                             await cache_chunk.wait_chunk_update()
                             continue
                         need_len = min(cache_chunk.length - offset, end - pos + 1)
+                        self.prefetcher.on_consume(msg, pos, need_len, cur_task_id)
                         pos = pos + need_len
-                        yield cache_chunk.mem[offset : offset + need_len]
+                        yield cache_chunk.get_mem_view(offset, need_len)
                 else:
                     offset = pos - cache_chunk.start
                     if offset >= cache_chunk.length:
                         raise RuntimeError(f"lru cache missed!{pos=},{cache_chunk=}")
-                    need_len = min(cache_chunk.length - offset, end - pos + 1)
+                    need_len = min(cache_chunk.length - offset, end - pos + 1, self.MAX_DISK_READ_SIZE)
+                    mem = self.media_chunk_manager.read_media_chunk(cache_chunk, offset, need_len)
+                    if mem is None or len(mem) != need_len:
+                        # blob gone under the index, download it again
+                        logger.warning(f"chunk blob missed:{cache_chunk}")
+                        self.media_chunk_manager.cancel_media_chunk(cache_chunk)
+                        continue
+                    self.prefetcher.on_consume(msg, pos, need_len, cur_task_id)
                     pos = pos + need_len
-                    yield cache_chunk.mem[offset : offset + need_len]
+                    yield mem
         except Exception as err:
             logger.error(f"stream iter:{err=}")
             logger.error(traceback.format_exc())
         finally:
-
-            async def _cancel_task_by_id(task_id: int):
-                for _ in range(self.task_queue.qsize()):
-                    task = self.task_queue.get_nowait()
-                    self.task_queue.task_done()
-                    if task[0] != task_id:
-                        self.task_queue.put_nowait(task)
-
-            await self.client.loop.create_task(_cancel_task_by_id(cur_task_id))
+            requester.close()
+            if pos <= end:
+                # closed by the server before the range was sent, the client is gone
+                requester.set_disconnected()
+            else:
+                for holder in joined_holders.values():
+                    self.release_chunk_requester(holder, requester)
             logger.debug(f"yield quit,{msg.chat_id=},{msg.id=},[{start}:{end}]")
 
     def __enter__(self):
@@ -12,6 +12,7 @@ import logging
 from backend.TgFileSystemClient import TgFileSystemClient
 from backend.UserManager import UserManager
 from backend.MediaCacheManager import MediaChunkHolderManager
+from backend.DownloadStriper import DownloadStriper
 import configParse
 
 logger = logging.getLogger(__file__.split("/")[-1])
@@ -50,8 +51,19 @@ class TgFileSystemClientManager(object):
         self.param = param
         self.db = UserManager()
         self.loop = asyncio.get_running_loop()
-        self.media_chunk_manager = MediaChunkHolderManager()
+        self.media_chunk_manager = MediaChunkHolderManager(
+            param.cache.chunk_size,
+            param.cache.mem_cache_size,
+            param.cache.eviction_policy,
+            param.cache.access_trace,
+            [(cache_dir.path, cache_dir.max_size) for cache_dir in param.cache.dirs],
+            param.cache.high_watermark,
+            param.cache.low_watermark,
+            param.cache.store,
+        )
+        self.striper = DownloadStriper()
         self._init_secret_key()
+        self.loop.create_task(self.media_chunk_manager.maintain_routine())
         if self.loop.is_running():
             self.loop.create_task(self._start_clients())
         else:
@@ -242,10 +254,25 @@ class TgFileSystemClientManager(object):
 
     async def get_status(self) -> dict:
         clients_status = [
-            {"status": client.is_valid(), "name": client.session_name, "sign": self.generate_sign(client.session_name)}
+            {
+                "status": client.is_valid(),
+                "name": client.session_name,
+                "sign": self.generate_sign(client.session_name),
+                "tasks": client.scheduler.get_status(),
+                "net": client.net_sizer.get_status(),
+                "pins": client.pinner.get_status(),
+                "limits": client.limiter.get_status(),
+                "hedge": client.hedger.get_status(),
+                "msg_cache": client.msg_cache.get_status(),
+            }
             for _, client in self.clients.items()
         ]
-        return {"init": self.is_init, "clients": clients_status}
+        return {
+            "init": self.is_init,
+            "clients": clients_status,
+            "stripe": self.striper.get_status(),
+            "cache": self.media_chunk_manager.get_status(),
+        }
 
     async def login_clients(self) -> str:
         for _, client in self.clients.items():
@@ -259,14 +286,17 @@ class TgFileSystemClientManager(object):
         return os.path.isfile(session_file)
 
     def create_client(self, client_id: str) -> TgFileSystemClient:
-        return TgFileSystemClient(client_id, self.param, self.db, self.media_chunk_manager)
+        return TgFileSystemClient(client_id, self.param, self.db, self.media_chunk_manager, self.striper)
 
     def _register_client(self, client: TgFileSystemClient) -> bool:
         self.clients[client.session_name] = client
+        if client.client_param.stripe_download:
+            self.striper.register(client)
         return True
 
     def _unregister_client(self, client_id: str) -> bool:
         self.clients.pop(client_id, None)
+        self.striper.unregister(client_id)
         return True
 
     def get_client(self, client_id: str) -> TgFileSystemClient | None:
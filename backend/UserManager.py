@@ -489,6 +489,7 @@ class UserManager(object):
                     "duration": attr.duration,
                     "w": attr.w,
                     "h": attr.h,
+                    "supports_streaming": attr.supports_streaming,
                 })
             elif isinstance(attr, types.DocumentAttributeAudio):
                 result.append({
@@ -630,6 +631,19 @@ class UserManager(object):
         except Exception as err:
             logger.error(f"{err=},{traceback.format_exc()}")
 
+    def update_msg_js_by_message(self, me: types.User, msg: types.Message) -> bool:
+        """Refresh stored msg_js (e.g. a new file_reference), only if the message is stored."""
+        try:
+            self.cur.execute(
+                "UPDATE message SET msg_js = ? WHERE unique_id = ?",
+                (self._compact_msg_js(msg), UserManager.generate_unique_id_by_msg(me, msg)),
+            )
+            self.con.commit()
+            return True
+        except Exception as err:
+            logger.error(f"{err=},{traceback.format_exc()}")
+            return False
+
     def delete_by_unique_id(self, unique_id: str) -> bool:
         """Delete message by unique_id from both message and FTS tables."""
         try:
@@ -1048,7 +1062,13 @@ class UserManager(object):
             if "Filename" in type_str:
                 result.append({"_": type_str, "file_name": attr.get("file_name")})
             elif "Video" in type_str:
-                result.append({"_": type_str, "duration": attr.get("duration"), "w": attr.get("w"), "h": attr.get("h")})
+                result.append({
+                    "_": type_str,
+                    "duration": attr.get("duration"),
+                    "w": attr.get("w"),
+                    "h": attr.get("h"),
+                    "supports_streaming": attr.get("supports_streaming"),
+                })
             elif "Audio" in type_str:
                 result.append({"_": type_str, "duration": attr.get("duration"), "performer": attr.get("performer"), "title": attr.get("title")})
             elif "ImageSize" in type_str:
@@ -185,6 +185,64 @@ async def get_tg_file_media(chat_id: int | str, msg_id: int, file_name: str, sig
         return Response(json.dumps({"detail": f"{err=}"}), status_code=status.HTTP_404_NOT_FOUND)
 
 
+class TgToFilePinRequestBody(BaseModel):
+    sign: str
+    chat_id: int
+    msg_id: int
+    start: int = 0
+    end: int = -1
+
+
+async def verify_pin_sign(body: TgToFilePinRequestBody):
+    clients_mgr = TgFileSystemClientManager.get_instance()
+    if not clients_mgr.verify_sign(body.sign):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"{body}")
+
+
+@app.post("/tg/api/v1/file/pin", dependencies=[Depends(verify_pin_sign)])
+@apiutils.atimeit
+async def pin_tg_file(body: TgToFilePinRequestBody):
+    try:
+        res = await api.pin_media_file(body.sign, body.chat_id, body.msg_id, body.start, body.end)
+        return Response(json.dumps(res), status_code=status.HTTP_200_OK)
+    except Exception as err:
+        logger.error(f"{err=},{traceback.format_exc()}")
+        return Response(json.dumps({"detail": f"{err=}"}), status_code=status.HTTP_404_NOT_FOUND)
+
+
+@app.post("/tg/api/v1/file/unpin", dependencies=[Depends(verify_pin_sign)])
+@apiutils.atimeit
+async def unpin_tg_file(body: TgToFilePinRequestBody):
+    try:
+        res = await api.unpin_media_file(body.sign, body.chat_id, body.msg_id)
+        return Response(json.dumps({"unpinned": res}), status_code=status.HTTP_200_OK)
+    except Exception as err:
+        logger.error(f"{err=},{traceback.format_exc()}")
+        return Response(json.dumps({"detail": f"{err=}"}), status_code=status.HTTP_404_NOT_FOUND)
+
+
+@app.get("/tg/api/v1/file/pin", dependencies=[Depends(verify_get_sign)])
+async def get_tg_file_pin_progress(sign: str, chat_id: int, msg_id: int):
+    try:
+        res = await api.get_pin_progress(sign, chat_id, msg_id)
+        if res is None:
+            return Response(json.dumps({"detail": "not pinned"}), status_code=status.HTTP_404_NOT_FOUND)
+        return Response(json.dumps(res), status_code=status.HTTP_200_OK)
+    except Exception as err:
+        logger.error(f"{err=},{traceback.format_exc()}")
+        return Response(json.dumps({"detail": f"{err=}"}), status_code=status.HTTP_404_NOT_FOUND)
+
+
+@app.get("/tg/api/v1/file/cache", dependencies=[Depends(verify_get_sign)])
+async def get_tg_file_cache_info(sign: str, chat_id: int, msg_id: int, start: int = 0, end: int = -1):
+    try:
+        res = await api.get_media_cache_info(sign, chat_id, msg_id, start, end)
+        return Response(json.dumps(res), status_code=status.HTTP_200_OK)
+    except Exception as err:
+        logger.error(f"{err=},{traceback.format_exc()}")
+        return Response(json.dumps({"detail": f"{err=}"}), status_code=status.HTTP_404_NOT_FOUND)
+
+
 @app.get("/tg/api/v1/client/login")
 @apiutils.atimeit
 async def login_new_tg_file_client():
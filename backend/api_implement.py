@@ -1,3 +1,4 @@
+import os
 import traceback
 import json
 import logging
@@ -6,7 +7,8 @@ from urllib.parse import quote
 from telethon import types, hints, utils
 import fastapi
 from fastapi import Request
-from fastapi.responses import StreamingResponse, Response
+from fastapi.responses import FileResponse, StreamingResponse, Response
+from fastapi.concurrency import run_in_threadpool
 
 import configParse
 from backend import apiutils
@@ -15,6 +17,8 @@ from backend.TgFileSystemClientManager import TgFileSystemClientManager, EnumSig
 
 logger = logging.getLogger(__file__.split("/")[-1])
 
+CACHED_READ_SIZE = 1024 * 1024
+
 
 async def link_convert(link: str) -> str:
     clients_mgr = TgFileSystemClientManager.get_instance()
@@ -64,6 +68,94 @@ async def get_clients_manager_status(detail: bool) -> dict[str, any]:
     return ret
 
 
+def _read_blob(f, offset: int, size: int) -> bytes:
+    f.seek(offset)
+    return f.read(size)
+
+
+async def cached_range_iter(segments: list) -> any:
+    try:
+        for _, f, offset, size in segments:
+            while size > 0:
+                buf = await run_in_threadpool(_read_blob, f, offset, min(size, CACHED_READ_SIZE))
+                if not buf:
+                    raise RuntimeError(f"blob truncated, {f=},{offset=},{size=}")
+                offset += len(buf)
+                size -= len(buf)
+                yield buf
+    finally:
+        for _, f, _, _ in segments:
+            f.close()
+
+
+class CachedFileResponse(FileResponse):
+    """A cache file holding the media at its own offsets, sent by starlette instead of through the event loop.
+
+    The range sent is the one the api parsed, and the file stays held in the store until the response is done.
+    """
+
+    def __init__(self, path: str, start: int, end: int, file_size: int, release, headers: dict[str, str], status_code: int) -> None:
+        st = os.stat(path)
+        # a sparse file of a partly cached media ends before the media, ranges are taken against the media
+        stat_result = os.stat_result(
+            (st.st_mode, st.st_ino, st.st_dev, st.st_nlink, st.st_uid, st.st_gid, file_size, st.st_atime, st.st_mtime, st.st_ctime)
+        )
+        headers = {k: v for k, v in headers.items() if k not in ("content-length", "content-range")}
+        super().__init__(path, headers=headers, media_type=headers["content-type"], stat_result=stat_result)
+        self.range = f"bytes={start}-{end}".encode() if status_code == fastapi.status.HTTP_206_PARTIAL_CONTENT else None
+        self.release = release
+
+    async def __call__(self, scope, receive, send) -> None:
+        headers = [(k, v) for k, v in scope["headers"] if k not in (b"range", b"if-range")]
+        if self.range is not None:
+            headers.append((b"range", self.range))
+        try:
+            await super().__call__({**scope, "headers": headers}, receive, send)
+        finally:
+            self.release()
+
+
+def get_cached_range_response(
+    clients_mgr: TgFileSystemClientManager, msg: types.Message, start: int, end: int, headers: dict[str, str], status_code: int
+) -> Response | None:
+    cache_param = clients_mgr.param.cache
+    if cache_param.delivery == "stream":
+        return None
+    mgr = clients_mgr.media_chunk_manager
+    file_path = mgr.get_media_file_path(msg) if cache_param.delivery in ("x-accel-redirect", "x-sendfile") else None
+    if file_path is not None:
+        infos, path = file_path
+        # delivery_prefix maps the first cache directory only, files moved to a slower one are streamed
+        if cache_param.delivery == "x-sendfile" or infos[0].tier == 0:
+            # the whole file is on disk in one piece, let the web server handle range itself
+            for info in infos:
+                mgr.touch_media_chunk(info)
+            offload_headers = {k: v for k, v in headers.items() if k not in ("content-length", "content-range")}
+            if cache_param.delivery == "x-accel-redirect":
+                relpath = os.path.relpath(path, mgr.get_chunk_directory(infos[0]))
+                offload_headers["X-Accel-Redirect"] = f"{cache_param.delivery_prefix}/{quote(relpath)}"
+            else:
+                offload_headers["X-Sendfile"] = path
+            return Response(headers=offload_headers, media_type=headers["content-type"])
+    range_path = mgr.get_cached_range_path(msg, start, end)
+    if range_path is not None:
+        path, release = range_path
+        try:
+            return CachedFileResponse(path, start, end, msg.media.document.size, release, headers, status_code)
+        except FileNotFoundError:
+            release()
+    segments = mgr.open_cached_range(msg, start, end)
+    if segments is None:
+        return None
+    headers["content-length"] = str(end - start + 1)
+    return StreamingResponse(
+        cached_range_iter(segments),
+        headers=headers,
+        media_type=headers["content-type"],
+        status_code=status_code,
+    )
+
+
 async def get_media_file_stream(sign: str, cid: int, mid: int, request: Request) -> StreamingResponse:
     msg_id = mid
     chat_id = cid
@@ -80,7 +172,7 @@ async def get_media_file_stream(sign: str, cid: int, mid: int, request: Request)
     sign_info = clients_mgr.parse_sign(sign)
     client_id = TgFileSystemClientManager.get_sign_client_id(sign_info)
     client = await clients_mgr.get_client_force(client_id)
-    msg = await client.get_message(chat_id, msg_id)
+    msg = await client.get_media_message(chat_id, msg_id)
     if not isinstance(msg.media, types.MessageMediaDocument) and not isinstance(msg.media, types.MessageMediaPhoto):
         raise RuntimeError(f"request don't support: {msg.media=}")
     file_size = msg.media.document.size
@@ -105,9 +197,73 @@ async def get_media_file_stream(sign: str, cid: int, mid: int, request: Request)
     else:
         headers["content-length"] = str(file_size)
         headers["content-range"] = f"bytes 0-{file_size-1}/{file_size}"
+    cached_response = get_cached_range_response(clients_mgr, msg, start, end, headers, status_code)
+    if cached_response is not None:
+        return cached_response
     return StreamingResponse(
         client.streaming_get_iter(msg, start, end, request),
         headers=headers,
         media_type=mime_type,
         status_code=status_code,
     )
+
+
+async def _get_sign_client(sign: str) -> any:
+    clients_mgr = TgFileSystemClientManager.get_instance()
+    sign_info = clients_mgr.parse_sign(sign)
+    client_id = TgFileSystemClientManager.get_sign_client_id(sign_info)
+    return await clients_mgr.get_client_force(client_id)
+
+
+async def _get_sign_media_message(sign: str, chat_id: int, msg_id: int) -> tuple[any, types.Message]:
+    client = await _get_sign_client(sign)
+    msg = await client.get_media_message(chat_id, msg_id)
+    if not isinstance(msg.media, types.MessageMediaDocument):
+        raise RuntimeError(f"request don't support: {msg.media=}")
+    return client, msg
+
+
+async def pin_media_file(sign: str, chat_id: int, msg_id: int, start: int, end: int) -> dict[str, any]:
+    client, msg = await _get_sign_media_message(sign, chat_id, msg_id)
+    file_size = msg.media.document.size
+    if end < 0 or end >= file_size:
+        end = file_size - 1
+    if start < 0 or start > end:
+        raise RuntimeError(f"invalid pin range: {start=},{end=},{file_size=}")
+    progress = client.pinner.pin(msg, start, end)
+    return client.pinner.get_progress(progress)
+
+
+async def unpin_media_file(sign: str, chat_id: int, msg_id: int) -> bool:
+    # no message lookup, a pin of a deleted or unreachable message must still be removable
+    client = await _get_sign_client(sign)
+    return client.pinner.unpin(chat_id, msg_id)
+
+
+async def get_media_cache_info(sign: str, chat_id: int, msg_id: int, start: int, end: int) -> dict[str, any]:
+    client, msg = await _get_sign_media_message(sign, chat_id, msg_id)
+    file_size = msg.media.document.size
+    if end < 0 or end >= file_size:
+        end = file_size - 1
+    if start < 0 or start > end:
+        raise RuntimeError(f"invalid range: {start=},{end=},{file_size=}")
+    cached, missing = client.media_chunk_manager.get_cached_spans(msg, start, end)
+    return {
+        "chat_id": msg.chat_id,
+        "msg_id": msg.id,
+        "start": start,
+        "end": end,
+        "size": file_size,
+        "cached": sum(span_end - span_start + 1 for span_start, span_end in cached),
+        "cached_ranges": cached,
+        "missing_ranges": missing,
+        "pinned": (msg.chat_id, msg.id) in client.pinner.pins,
+    }
+
+
+async def get_pin_progress(sign: str, chat_id: int, msg_id: int) -> dict[str, any] | None:
+    client, msg = await _get_sign_media_message(sign, chat_id, msg_id)
+    progress = client.pinner.pins.get((msg.chat_id, msg.id))
+    if progress is None:
+        return None
+    return client.pinner.get_progress(progress)
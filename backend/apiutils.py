@@ -181,6 +181,56 @@ def get_message_msg_id_from_dict(msg: dict[str, any]) -> int:
     return 0
 
 
+def _get_document_attributes_from_dict(attrs: list[dict[str, any]]) -> list[any]:
+    res = []
+    for attr in attrs or []:
+        match attr.get("_"):
+            case "DocumentAttributeFilename":
+                res.append(types.DocumentAttributeFilename(file_name=attr["file_name"]))
+            case "DocumentAttributeVideo":
+                res.append(
+                    types.DocumentAttributeVideo(
+                        duration=attr["duration"], w=attr["w"], h=attr["h"], supports_streaming=attr.get("supports_streaming")
+                    )
+                )
+            case "DocumentAttributeAudio":
+                res.append(
+                    types.DocumentAttributeAudio(duration=attr["duration"], title=attr.get("title"), performer=attr.get("performer"))
+                )
+            case "DocumentAttributeImageSize":
+                res.append(types.DocumentAttributeImageSize(w=attr["w"], h=attr["h"]))
+    return res
+
+
+def get_message_from_dict(msg: dict[str, any]) -> types.Message | None:
+    """Rebuild a document message from compact msg_js, enough for streaming without get_messages."""
+    try:
+        doc = msg["media"]["document"]
+        document = types.Document(
+            id=doc["id"],
+            access_hash=doc["access_hash"],
+            file_reference=bytes.fromhex(doc["file_reference"] or ""),
+            date=None,
+            mime_type=doc["mime_type"],
+            size=doc["size"],
+            dc_id=doc["dc_id"],
+            attributes=_get_document_attributes_from_dict(doc.get("attributes")),
+        )
+        peer = msg["peer_id"]
+        match peer["_"]:
+            case "PeerChannel":
+                peer_id = types.PeerChannel(channel_id=peer["channel_id"])
+            case "PeerChat":
+                peer_id = types.PeerChat(chat_id=peer["chat_id"])
+            case "PeerUser":
+                peer_id = types.PeerUser(user_id=peer["user_id"])
+            case _:
+                return None
+        return types.Message(id=msg["id"], peer_id=peer_id, date=None, message="", media=types.MessageMediaDocument(document=document))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
 def timeit_sec(func):
     @wraps(func)
     def timeit_wrapper(*args, **kwargs):
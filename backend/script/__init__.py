@@ -4,4 +4,6 @@ Backend utility scripts.
 Scripts:
 - migrate_msg_js.py: Migrate msg_js to compact format
 - storage_stats.py: Show storage statistics
+- bench_parallel_download.py: Benchmark parallel media chunk download
+- bench_chunk_copy.py: Benchmark bytes copied per streamed GB
 """
\ No newline at end of file
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Media Chunk Copy Benchmark
+
+Streams chunks through MediaChunkHolder the way _download_media_chunk and
+streaming_get_iter do (append one net chunk, then read the newly visible part)
+and reports bytes copied and CPU time per streamed GB, comparing the old
+append-and-slice holder with the preallocated memoryview holder.
+
+Usage:
+    python backend/script/bench_chunk_copy.py
+    python backend/script/bench_chunk_copy.py --chunks 40 --net-chunk 262144
+"""
+
+import argparse
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from backend.MediaCacheManager import MediaChunkHolder, MediaChunkHolderManager
+
+GB = 1024 * 1024 * 1024
+
+
+class LegacyMediaChunkHolder(object):
+    """The holder before preallocation: mem = mem + chunk, readers slice bytes."""
+
+    def __init__(self, target_len: int) -> None:
+        self.target_len = target_len
+        self.mem = bytes()
+        self.length = 0
+        self.copied = 0
+
+    def append_chunk_mem(self, mem: bytes) -> None:
+        self.copied += self.length + len(mem)
+        self.mem = self.mem + mem
+        self.length = len(self.mem)
+
+    def read(self, offset: int, size: int) -> bytes:
+        self.copied += size
+        return self.mem[offset : offset + size]
+
+
+class CountingMediaChunkHolder(MediaChunkHolder):
+    def __init__(self, target_len: int) -> None:
+        super().__init__("", 0, 0, 0, target_len)
+        self.copied = 0
+
+    def write_chunk_mem(self, offset: int, mem: bytes) -> None:
+        self.copied += len(mem)
+        super().write_chunk_mem(offset, mem)
+
+    def read(self, offset: int, size: int) -> memoryview:
+        return self.get_mem_view(offset, size)
+
+
+def stream_chunks(holder_factory, chunks: int, chunk_size: int, net_chunk: int) -> tuple[float, int, int]:
+    net_data = os.urandom(net_chunk)
+    copied = 0
+    streamed = 0
+    begin = time.process_time()
+    for _ in range(chunks):
+        holder = holder_factory(chunk_size)
+        pos = 0
+        while holder.length < chunk_size:
+            holder.append_chunk_mem(net_data[: min(net_chunk, chunk_size - holder.length)])
+            view = holder.read(pos, holder.length - pos)
+            streamed += len(view)
+            pos = holder.length
+        copied += holder.copied
+    return time.process_time() - begin, copied, streamed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark bytes copied per streamed GB in MediaChunkHolder')
+    parser.add_argument('--chunks', type=int, default=100, help='Media chunks streamed per run')
+    parser.add_argument('--chunk-size', type=int, default=MediaChunkHolderManager.DEFAULT_CHUNK_SIZE, help='Media chunk size')
+    parser.add_argument('--net-chunk', type=int, default=256 * 1024, help='Net chunk size appended per step')
+    args = parser.parse_args()
+
+    print('=== Media Chunk Copy Benchmark ===')
+    print(f'  chunks: {args.chunks}, chunk size: {args.chunk_size}, net chunk: {args.net_chunk}')
+    print(f'\n{"holder":>12} {"copied GB/GB":>14} {"cpu s/GB":>10}')
+    for name, factory in (('legacy', LegacyMediaChunkHolder), ('preallocated', CountingMediaChunkHolder)):
+        cost, copied, streamed = stream_chunks(factory, args.chunks, args.chunk_size, args.net_chunk)
+        print(f'{name:>12} {copied / streamed:>14.2f} {cost / streamed * GB:>10.3f}')
+
+
+if __name__ == '__main__':
+    main()
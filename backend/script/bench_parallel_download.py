@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Parallel Chunk Download Benchmark
+
+Downloads media chunks through TgFileSystemClient._download_media_chunk against a
+simulated Telegram link (per request rtt, per stream bandwidth, shared uplink) and
+shows how throughput scales with download_parallel.
+
+Usage:
+    python backend/script/bench_parallel_download.py
+    python backend/script/bench_parallel_download.py --rtt 0.15 --stream-mbps 8 --link-mbps 100
+    python backend/script/bench_parallel_download.py --parallel 1 2 4 8 --chunks 4
+"""
+
+import argparse
+import asyncio
+import sys
+import os
+import time
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from telethon import TelegramClient, functions, types
+from telethon.sessions import StringSession
+
+import configParse
+from backend.TgFileSystemClient import TgFileSystemClient
+from backend.MediaCacheManager import MediaChunkHolder, MediaChunkHolderManager
+
+CHUNK_SIZE = MediaChunkHolderManager.DEFAULT_CHUNK_SIZE
+DC_ID = 2
+
+
+class SimulatedTelegramClient(TelegramClient):
+    """A TelegramClient whose getFile requests are answered locally, so iter_download runs unchanged."""
+
+    def __init__(self, rtt: float, stream_bps: float, link_bps: float, file_size: int) -> None:
+        super().__init__(StringSession(), 1, "stub")
+        # the media dc, telethon would borrow an exported sender for any other
+        self.session.set_dc(DC_ID, "127.0.0.1", 443)
+        self.rtt = rtt
+        self.stream_bps = stream_bps
+        self.link_bps = link_bps
+        self.file_size = file_size
+        self.link_busy_until = 0.0
+        self.requests = 0
+
+    async def _transfer(self, size: int) -> None:
+        now = self.loop.time()
+        start = max(now, self.link_busy_until)
+        self.link_busy_until = start + size / self.link_bps
+        self.requests += 1
+        await asyncio.sleep(max(self.rtt + size / self.stream_bps, self.link_busy_until - now))
+
+    async def _call(self, sender, request, ordered=False, flood_sleep_threshold=None):
+        if not isinstance(request, functions.upload.GetFileRequest):
+            raise NotImplementedError(f"not simulated:{request}")
+        size = max(0, min(request.limit, self.file_size - request.offset))
+        await self._transfer(size)
+        return types.upload.File(type=types.storage.FileUnknown(), mtime=0, bytes=bytes(size))
+
+
+class FakeRequester(object):
+    async def is_disconnected(self) -> bool:
+        return False
+
+
+class FakeChunkManager(object):
+    """Chunks stay in memory, the benchmark measures the download path only."""
+
+    def cancel_media_chunk(self, holder: MediaChunkHolder) -> None:
+        pass
+
+    def keep_partial_chunk(self, holder: MediaChunkHolder) -> None:
+        pass
+
+    def move_media_chunk_to_disk(self, holder: MediaChunkHolder) -> bool:
+        return True
+
+
+class BenchClient(TgFileSystemClient):
+    def __del__(self) -> None:
+        pass
+
+
+def make_client(parallel: int, sim_client: SimulatedTelegramClient) -> BenchClient:
+    param = configParse.TgToFileSystemParameter(
+        base=configParse.TgToFileSystemParameter.BaseParameter(),
+        clients=[configParse.TgToFileSystemParameter.ClientConfigPatameter(name="bench", download_parallel=parallel)],
+        tgApi=configParse.TgToFileSystemParameter.ApiParameter(api_id=1, api_hash="bench"),
+        proxy=configParse.TgToFileSystemParameter.TgProxyParameter(),
+        web=configParse.TgToFileSystemParameter.TgWebParameter(),
+    )
+    # the real client, only its TelegramClient is the simulated one
+    with mock.patch("backend.TgFileSystemClient.TelegramClient", return_value=sim_client):
+        return BenchClient("bench", param, None, FakeChunkManager())
+
+
+def make_message(file_size: int) -> types.Message:
+    document = types.Document(
+        id=0, access_hash=0, file_reference=b"", date=None, mime_type="video/mp4", size=file_size, dc_id=DC_ID, attributes=[]
+    )
+    return types.Message(id=0, peer_id=types.PeerUser(0), date=None, message="", media=types.MessageMediaDocument(document=document))
+
+
+async def run_once(parallel: int, chunks: int, args) -> tuple[float, int, dict]:
+    file_size = chunks * CHUNK_SIZE
+    sim = SimulatedTelegramClient(args.rtt, args.stream_mbps * 1024 * 1024 / 8, args.link_mbps * 1024 * 1024 / 8, file_size)
+    client = make_client(parallel, sim)
+    msg = make_message(file_size)
+    begin = time.perf_counter()
+    for i in range(chunks):
+        holder = MediaChunkHolder(MediaChunkHolderManager.get_media_key(msg), msg.chat_id, msg.id, i * CHUNK_SIZE, CHUNK_SIZE)
+        holder.add_chunk_requester(FakeRequester())
+        await client._download_media_chunk(msg, holder)
+        if not holder.is_completed():
+            raise RuntimeError(f"chunk not completed:{holder}")
+    cost = time.perf_counter() - begin
+    return cost, sim.requests, client.net_sizer.get_status()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark parallel media chunk download')
+    parser.add_argument('--parallel', type=int, nargs='+', default=[1, 2, 4, 8], help='download_parallel values to test')
+    parser.add_argument('--chunks', type=int, default=2, help='5MB chunks downloaded per run')
+    parser.add_argument('--rtt', type=float, default=0.1, help='Round trip time per getFile request (s)')
+    parser.add_argument('--stream-mbps', type=float, default=16, help='Bandwidth of a single download stream (Mbit/s)')
+    parser.add_argument('--link-mbps', type=float, default=200, help='Total uplink bandwidth (Mbit/s)')
+    args = parser.parse_args()
+
+    print('=== Parallel Chunk Download Benchmark ===')
+    print(f'  rtt: {args.rtt}s, stream: {args.stream_mbps}Mbit/s, link: {args.link_mbps}Mbit/s, chunks: {args.chunks}')
+    print(f'\n{"parallel":>8} {"seconds":>8} {"MB/s":>8} {"speedup":>8} {"requests":>8} {"best size":>10}')
+    base = None
+    for parallel in args.parallel:
+        cost, requests, net_status = asyncio.run(run_once(parallel, args.chunks, args))
+        mbps = args.chunks * CHUNK_SIZE / 1024 / 1024 / cost
+        base = base or mbps
+        best_size = max((dc["best_size"] for dc in net_status.values()), default=0)
+        print(f'{parallel:>8} {cost:>8.2f} {mbps:>8.2f} {mbps / base:>7.2f}x {requests:>8} {best_size:>10}')
+
+
+if __name__ == '__main__':
+    main()
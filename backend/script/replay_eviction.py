@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Eviction Policy Trace Replay
+
+Replays a chunk access trace (written when [cache] access_trace is set) against every
+eviction policy and cache size, and shows the hit ratio of each. A miss is downloaded
+and inserted like the real cache does, pins are not simulated.
+
+Usage:
+    python backend/script/replay_eviction.py backend/db/chunk_access.log
+    python backend/script/replay_eviction.py trace.log --capacity-mb 1024 2048 4096
+    python backend/script/replay_eviction.py trace.log --policy lru tinylfu
+"""
+
+import argparse
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from backend.ChunkEvictionPolicy import EVICTION_POLICIES, create_eviction_policy
+from backend.MediaCacheManager import MediaChunkHolderManager
+
+
+def load_trace(path: str) -> list[tuple[str, int]]:
+    trace = []
+    with open(path) as f:
+        for line in f:
+            fields = line.strip().split(",")
+            if len(fields) == 4:
+                _, media_key, start, length = fields
+            elif len(fields) == 5:
+                # traces written before chunks were keyed by media
+                _, chat_id, msg_id, start, length = fields
+                media_key = f"msg:{chat_id}:{msg_id}"
+            else:
+                continue
+            trace.append((f"{media_key}:{start}", int(length)))
+    return trace
+
+
+def replay(trace: list[tuple[str, int]], policy_name: str, capacity: int) -> dict[str, float]:
+    policy = create_eviction_policy(policy_name, capacity)
+    cached: dict[str, int] = {}
+    size = 0
+    hits = 0
+    hit_bytes = 0
+    for id, length in trace:
+        if id in cached:
+            hits += 1
+            hit_bytes += length
+        else:
+            cached[id] = length
+            size += length
+            policy.insert(id, length)
+        policy.access(id)
+        if size <= capacity:
+            continue
+        for victim in policy.victims():
+            if victim == id:
+                continue
+            policy.remove(victim)
+            size -= cached.pop(victim)
+            if size <= capacity:
+                break
+    total_bytes = sum(length for _, length in trace)
+    return {
+        "hit_ratio": hits / len(trace) if trace else 0.0,
+        "byte_hit_ratio": hit_bytes / total_bytes if total_bytes else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a chunk access trace against the eviction policies")
+    parser.add_argument("trace", help="access trace file, one time,media_key,start,length line per access")
+    parser.add_argument("--capacity-mb", type=int, nargs="+", default=[MediaChunkHolderManager.MAX_CACHE_SIZE // 1024 // 1024])
+    parser.add_argument("--policy", nargs="+", default=list(EVICTION_POLICIES), choices=list(EVICTION_POLICIES))
+    args = parser.parse_args()
+
+    trace = load_trace(args.trace)
+    unique = len({id for id, _ in trace})
+    print(f"{len(trace)} accesses of {unique} chunks")
+    print(f"{'capacity':>10} {'policy':>8} {'hit ratio':>10} {'byte hit':>10}")
+    for capacity_mb in args.capacity_mb:
+        for policy_name in args.policy:
+            result = replay(trace, policy_name, capacity_mb * 1024 * 1024)
+            print(f"{capacity_mb:>8}MB {policy_name:>8} {result['hit_ratio']:>10.3f} {result['byte_hit_ratio']:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -17,8 +17,13 @@ class TgToFileSystemParameter(BaseModel):
 
     class ClientConfigPatameter(BaseModel):
         name: str
-        interval: float = 0.1
+        interval: float = 0.1  # seconds between history requests, 0 disables pacing
         whitelist_chat: list[int] = []
+        download_parallel: int = 1  # concurrent sub ranges per chunk
+        prefetch_window: int = 4  # chunks read ahead of a stream, 0 disables
+        index_prefetch: bool = True  # fetch mp4 moov / mkv cues with the head
+        background_share: float = 0.5  # worker share for chat sync while streaming
+        stripe_download: bool = True  # share chunk downloads with other accounts
     clients: list[ClientConfigPatameter]
 
     class ApiParameter(BaseModel):
@@ -39,6 +44,26 @@ class TgToFileSystemParameter(BaseModel):
         port: int = 2000
     web: TgWebParameter
 
+    class MediaCacheParameter(BaseModel):
+
+        class CacheDirParameter(BaseModel):
+            path: str = ""  # empty is backend/db/cache_media
+            max_size: int = 2 * 1024 * 1024 * 1024
+
+        chunk_size: int = 5 * 1024 * 1024
+        mem_cache_size: int = 256 * 1024 * 1024  # 0 disables the memory tier
+        eviction_policy: str = "slru"  # lru, slru or tinylfu
+        access_trace: str = ""  # chunk access log for replay_eviction.py
+        store: str = "diskcache"  # diskcache or sparse
+        dirs: list[CacheDirParameter] = [CacheDirParameter()]  # fastest first
+        high_watermark: float = 0.95
+        low_watermark: float = 0.9
+        msg_cache_size: int = 4096
+        msg_cache_ttl: float = 3600
+        delivery: str = "stream"  # stream, file, x-accel-redirect or x-sendfile
+        delivery_prefix: str = "/tg_cache"  # nginx internal location for x-accel-redirect
+    cache: MediaCacheParameter = MediaCacheParameter()
+
 @functools.lru_cache
 def get_TgToFileSystemParameter(path: str = f"{os.path.dirname(__file__)}/config.toml", force_reload: bool = False) -> TgToFileSystemParameter:
     if force_reload:
@@ -0,0 +1,20 @@
+import random
+
+from backend.DownloadHedger import DownloadHedger
+
+
+def test_threshold_tracks_the_quantile_of_the_window() -> None:
+    hedger = DownloadHedger()
+    rng = random.Random(1)
+    window = []
+    for _ in range(3 * DownloadHedger.GAP_SAMPLES):
+        gap = rng.expovariate(1.0) * 3
+        hedger.on_chunk_gap(gap)
+        window = (window + [gap])[-DownloadHedger.GAP_SAMPLES :]
+        if len(window) < DownloadHedger.MIN_GAP_SAMPLES:
+            assert hedger.threshold == DownloadHedger.DEFAULT_THRESHOLD
+            continue
+        gaps = sorted(window)
+        quantile = gaps[min(len(gaps) - 1, int(len(gaps) * DownloadHedger.GAP_QUANTILE))]
+        assert hedger.threshold == min(DownloadHedger.MAX_THRESHOLD, max(DownloadHedger.MIN_THRESHOLD, quantile))
+    assert hedger.sorted_gaps == sorted(hedger.gaps)
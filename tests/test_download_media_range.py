@@ -0,0 +1,84 @@
+import asyncio
+import os
+
+import pytest
+from telethon import TelegramClient, functions, types
+from telethon.client.downloads import _DirectDownloadIter
+from telethon.sessions import StringSession
+
+from backend.DownloadHedger import DownloadHedger
+from backend.MediaCacheManager import MediaChunkHolder, MediaChunkHolderManager
+from backend.NetChunkSizer import NetChunkSizer
+from backend.RequestRateLimiter import RequestRateLimiter
+from backend.TgFileSystemClient import TgFileSystemClient
+
+DC_ID = 2
+FILE_SIZE = 3 * 1024 * 1024 + 1000
+
+
+class StubTelegramClient(TelegramClient):
+    """Answers getFile from memory, iter_download itself is telethon's."""
+
+    def __init__(self, data: bytes) -> None:
+        super().__init__(StringSession(), 1, "stub")
+        self.session.set_dc(DC_ID, "127.0.0.1", 443)
+        self.data = data
+        self.streams = []
+        self.served = 0
+
+    def iter_download(self, *args, **kwargs):
+        stream = super().iter_download(*args, **kwargs)
+        self.streams.append(stream)
+        return stream
+
+    async def _call(self, sender, request, ordered=False, flood_sleep_threshold=None):
+        assert isinstance(request, functions.upload.GetFileRequest)
+        data = self.data[request.offset : request.offset + request.limit]
+        self.served += len(data)
+        return types.upload.File(type=types.storage.FileUnknown(), mtime=0, bytes=data)
+
+
+class StubClient(TgFileSystemClient):
+    def __init__(self, tg: StubTelegramClient) -> None:
+        self.session_name = "stub"
+        self.client = tg
+        self.net_sizer = NetChunkSizer()
+        self.limiter = RequestRateLimiter(0)
+        self.hedger = DownloadHedger()
+
+    def __del__(self) -> None:
+        pass
+
+
+def make_message(size: int) -> types.Message:
+    document = types.Document(
+        id=1, access_hash=0, file_reference=b"", date=None, mime_type="video/mp4", size=size, dc_id=DC_ID, attributes=[]
+    )
+    return types.Message(id=1, peer_id=types.PeerUser(0), date=None, message="", media=types.MessageMediaDocument(document=document))
+
+
+@pytest.mark.parametrize(
+    "start,size",
+    [
+        (0, 1024 * 1024),
+        (256 * 1024, 768 * 1024),
+        (1024 * 1024 + 64 * 1024, 512 * 1024 + 4096),
+        (2 * 1024 * 1024, FILE_SIZE - 2 * 1024 * 1024),
+    ],
+)
+def test_download_media_range_takes_direct_path(start: int, size: int) -> None:
+    data = os.urandom(FILE_SIZE)
+
+    async def run() -> tuple[StubTelegramClient, MediaChunkHolder]:
+        tg = StubTelegramClient(data)
+        msg = make_message(FILE_SIZE)
+        holder = MediaChunkHolder(MediaChunkHolderManager.get_media_key(msg), msg.chat_id, msg.id, start, size)
+        holder.add_chunk_requester(object())
+        await StubClient(tg)._download_media_range(msg, holder, start, size)
+        return tg, holder
+
+    tg, holder = asyncio.run(run())
+    assert bytes(holder.get_mem_view(0, holder.length)) == data[start : start + size]
+    assert tg.streams and all(type(stream) is _DirectDownloadIter for stream in tg.streams)
+    # parts past the range are never requested
+    assert tg.served - size < NetChunkSizer.MAX_NET_CHUNK_SIZE
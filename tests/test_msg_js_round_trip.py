@@ -0,0 +1,54 @@
+import json
+import sqlite3
+
+import pytest
+from telethon import types
+
+from backend import apiutils
+from backend.UserManager import UserManager
+
+
+@pytest.fixture
+def user_manager() -> UserManager:
+    # the compact helpers need no table, skip opening backend/db/user.db
+    manager = UserManager.__new__(UserManager)
+    manager.con = sqlite3.connect(":memory:")
+    return manager
+
+
+def make_video_message(supports_streaming: bool) -> types.Message:
+    document = types.Document(
+        id=1,
+        access_hash=2,
+        file_reference=b"\x01\x02",
+        date=None,
+        mime_type="video/mp4",
+        size=100 * 1024 * 1024,
+        dc_id=2,
+        attributes=[
+            types.DocumentAttributeVideo(duration=60, w=1280, h=720, supports_streaming=supports_streaming),
+            types.DocumentAttributeFilename(file_name="a.mp4"),
+        ],
+    )
+    return types.Message(id=3, peer_id=types.PeerChannel(4), date=None, message="", media=types.MessageMediaDocument(document=document))
+
+
+def get_video_attribute(msg: types.Message) -> types.DocumentAttributeVideo:
+    return next(attr for attr in msg.media.document.attributes if isinstance(attr, types.DocumentAttributeVideo))
+
+
+@pytest.mark.parametrize("supports_streaming", [True, False])
+def test_video_attribute_survives_msg_js(user_manager: UserManager, supports_streaming: bool) -> None:
+    msg = make_video_message(supports_streaming)
+    rebuilt = apiutils.get_message_from_dict(json.loads(user_manager._compact_msg_js(msg)))
+    attr = get_video_attribute(rebuilt)
+    assert (attr.duration, attr.w, attr.h) == (60, 1280, 720)
+    assert bool(attr.supports_streaming) is supports_streaming
+    assert rebuilt.media.document.file_reference == msg.media.document.file_reference
+
+
+def test_video_attribute_survives_compact_migration(user_manager: UserManager) -> None:
+    attrs = [attr.to_dict() for attr in make_video_message(True).media.document.attributes]
+    compact = user_manager._compact_attrs_from_dict(attrs)
+    attr = next(attr for attr in apiutils._get_document_attributes_from_dict(compact) if isinstance(attr, types.DocumentAttributeVideo))
+    assert attr.supports_streaming
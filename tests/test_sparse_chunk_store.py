@@ -0,0 +1,121 @@
+import os
+import random
+
+import pytest
+
+from backend.ChunkStore import SparseFileChunkStore
+from backend.MediaCacheManager import ChunkInfo
+
+BLOCK = SparseFileChunkStore.BLOCK_SIZE
+MEDIA_KEY = "doc:1:2"
+
+
+def make_info(id: str, start_block: int, blocks: int) -> ChunkInfo:
+    return ChunkInfo(id, MEDIA_KEY, 1, 2, start_block * BLOCK, blocks * BLOCK)
+
+
+def present_blocks(store: SparseFileChunkStore) -> set[int]:
+    bitmap = store._get_bitmap(MEDIA_KEY)
+    return {block for block in range(len(bitmap) * 8) if bitmap[block // 8] & (1 << (block % 8))}
+
+
+@pytest.fixture
+def store(tmp_path) -> SparseFileChunkStore:
+    store = SparseFileChunkStore(str(tmp_path))
+    yield store
+    store.close()
+
+
+def test_trim_entry_keeps_only_held_blocks(store: SparseFileChunkStore) -> None:
+    rng = random.Random(7)
+    infos = []
+    block = 0
+    # chunks of odd sizes at odd offsets, so runs start and stop inside bitmap bytes
+    for i in range(40):
+        block += rng.randrange(0, 5)
+        size = rng.randrange(1, 20)
+        info = make_info(str(i), block, size)
+        store.set(info, os.urandom(info.length))
+        infos.append(info)
+        block += size
+    held = [info for info in infos if rng.random() < 0.5]
+    expected = set()
+    for info in held:
+        expected.update(store._block_range(info.start, info.length))
+
+    store.trim_entry(MEDIA_KEY, held)
+
+    assert present_blocks(store) == expected
+    # the bitmap on disk matches the one in memory
+    store.bitmaps.clear()
+    assert present_blocks(store) == expected
+    for info in infos:
+        assert store.contains(info) == (info in held)
+
+
+def test_trim_entry_drops_file_without_held_chunks(store: SparseFileChunkStore) -> None:
+    info = make_info("a", 3, 5)
+    store.set(info, os.urandom(info.length))
+
+    store.trim_entry(MEDIA_KEY, [])
+
+    assert not os.path.exists(store._data_path(MEDIA_KEY))
+    assert list(store.entries()) == []
+
+
+def test_delete_keeps_neighbour_blocks(store: SparseFileChunkStore) -> None:
+    first, second = make_info("a", 0, 3), make_info("b", 3, 7)
+    data = os.urandom(second.length)
+    store.set(first, os.urandom(first.length))
+    store.set(second, data)
+
+    assert store.delete(first)
+
+    assert not store.contains(first)
+    assert store.get(second) == data
+    assert present_blocks(store) == set(range(3, 10))
+
+
+def test_rekey_moves_blocks_to_the_new_media_file(store: SparseFileChunkStore) -> None:
+    info = ChunkInfo("a", "msg:1:2", 1, 2, 4 * BLOCK, 6 * BLOCK)
+    data = os.urandom(info.length)
+    store.set(info, data)
+
+    store.rekey(info, MEDIA_KEY)
+
+    assert info.media_key == MEDIA_KEY
+    assert store.get(info) == data
+    assert list(store.entries()) == [MEDIA_KEY]
+
+
+def test_delete_under_reader_waits_for_close(store: SparseFileChunkStore) -> None:
+    first, second = make_info("a", 0, 4), make_info("b", 4, 4)
+    data = os.urandom(first.length)
+    store.set(first, data)
+    store.set(second, os.urandom(second.length))
+    f, base = store.open(first)
+
+    assert store.delete(first)
+    assert not store.contains(first)
+    f.seek(base)
+    assert f.read(first.length) == data
+
+    f.close()
+    if store.fallocate is not None:
+        with open(store._data_path(MEDIA_KEY), "rb") as raw:
+            assert raw.read(first.length) == bytes(first.length)
+    assert store.readers == {} and store.pending_holes == {}
+
+
+def test_chunk_stored_again_under_reader_keeps_its_bytes(store: SparseFileChunkStore) -> None:
+    info = make_info("a", 2, 4)
+    store.set(info, os.urandom(info.length))
+    f, _ = store.open(info)
+    store.delete(info)
+    assert os.path.exists(store._data_path(MEDIA_KEY))
+
+    data = os.urandom(info.length)
+    store.set(info, data)
+    f.close()
+
+    assert store.get(info) == data
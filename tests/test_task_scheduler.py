@@ -0,0 +1,51 @@
+import asyncio
+
+from backend.MediaCacheManager import MediaChunkHolder
+from backend.TaskScheduler import EnumTaskPriority, TaskScheduler
+from backend.TgFileSystemClient import TgFileSystemClient
+
+
+class StubClient(TgFileSystemClient):
+    def __init__(self, scheduler: TaskScheduler) -> None:
+        self.session_name = "stub"
+        self.scheduler = scheduler
+
+    def __del__(self) -> None:
+        pass
+
+
+def test_release_cancels_on_the_scheduler_running_the_task() -> None:
+    async def run() -> None:
+        loop = asyncio.get_running_loop()
+        owner, other = TaskScheduler(loop, 1, 0.5), TaskScheduler(loop, 1, 0.5)
+        gate = asyncio.Event()
+        ran = []
+
+        async def work(name: str) -> None:
+            await gate.wait()
+            ran.append(name)
+
+        # the only worker of owner is busy, the holder's download waits in its queue
+        owner.submit(lambda: work("blocker"), EnumTaskPriority.INTERACTIVE)
+        holder = MediaChunkHolder("doc:1:2", 1, 2, 0, 1024)
+        holder.download_task = owner.submit(lambda: work("shared"), EnumTaskPriority.INTERACTIVE)
+        req = object()
+        holder.add_chunk_requester(req)
+
+        # another client whose stream joined the shared holder leaves it
+        StubClient(other).release_chunk_requester(holder, req)
+
+        assert holder.download_task.cancelled
+        assert owner.get_status()["interactive"]["queued"] == 0
+        assert other.get_status()["interactive"]["queued"] == 0
+        gate.set()
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        # owner keeps dispatching once its queue drained
+        task = owner.submit(lambda: work("after"), EnumTaskPriority.INTERACTIVE)
+        for _ in range(5):
+            await asyncio.sleep(0)
+        assert task.finished
+        assert ran == ["blocker", "after"]
+
+    asyncio.run(run())